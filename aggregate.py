@@ -0,0 +1,96 @@
+from __future__ import with_statement
+import hashlib
+import threading
+
+from debounce import Debouncer
+
+"""
+
+Merges RSVP acknowledgements during a rush.
+
+The first `rsvp yes` in a thread opens a window of `window` seconds. Every
+other yes in that thread during the window is folded into the same reply,
+which goes out when the window closes: "@**A**, @**B**, @**C** and 37 others
+are attending!". Anything that isn't a plain acknowledgement (errors such as
+the attendance limit being reached, summaries, private replies...) is sent
+right away.
+
+"""
+
+AGGREGATED_RESPONSES = {
+  'yes': '%s are attending!',
+  'no': '%s are **not** attending!',
+  'maybe': '%s might be attending. It\'s complicated.',
+}
+
+
+def mention_list(names, shown=3):
+  """
+  "@**A**", "@**A** and @**B**", "@**A**, @**B**, @**C** and 2 others"
+  """
+  mentions = ['@**%s**' % name for name in names[:shown]]
+  hidden = len(names) - len(mentions)
+  if hidden == 1:
+    mentions.append('@**%s**' % names[-1])
+  elif hidden > 1:
+    return '%s and %d others' % (', '.join(mentions), hidden)
+
+  if len(mentions) == 1:
+    return mentions[0]
+  return '%s and %s' % (', '.join(mentions[:-1]), mentions[-1])
+
+
+class ReplyAggregator(object):
+
+  def __init__(self, send_message, window=2):
+    self.send_message = send_message
+    self.window = window
+    self.debouncer = Debouncer(window, self.flush_key)
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.sent = 0
+
+  def start(self):
+    self.debouncer.start()
+    return self
+
+  def send(self, reply):
+    aggregate = reply.get('aggregate')
+    if not self.window or not aggregate or reply['type'] != 'stream':
+      self.sent += 1
+      return self.send_message(reply)
+
+    thread = (reply['display_recipient'], reply['subject'])
+    with self.lock:
+      # Someone changing their mind within the window only counts once, for
+      # their latest decision.
+      for decision in AGGREGATED_RESPONSES:
+        pending = self.pending.get(thread + (decision,))
+        if pending:
+          pending[:] = [queued for queued in pending if queued['aggregate']['name'] != aggregate['name']]
+      self.pending.setdefault(thread + (aggregate['decision'],), []).append(reply)
+    self.debouncer.touch(thread + (aggregate['decision'],))
+
+  def flush_key(self, key):
+    with self.lock:
+      replies = self.pending.pop(key, [])
+    if not replies:
+      return
+
+    if len(replies) == 1:
+      # Keep the original wording (and any VIP fanfare).
+      message = replies[0]
+    else:
+      names = [reply['aggregate']['name'] for reply in replies]
+      message = dict(replies[0], body=AGGREGATED_RESPONSES[key[-1]] % mention_list(names))
+      keys = [reply['dedup_key'] for reply in replies if reply.get('dedup_key')]
+      if keys:
+        message['dedup_key'] = 'merged-' + hashlib.sha1('|'.join(keys)).hexdigest()
+    self.sent += 1
+    self.send_message(message)
+
+  def flush(self):
+    """
+    Sends everything that is waiting, right away.
+    """
+    self.debouncer.flush()
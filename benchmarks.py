@@ -0,0 +1,510 @@
+from __future__ import with_statement
+import argparse
+import bisect
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import cache
+import commands
+import rsvp
+import schema
+import search
+import util
+from storage import MemoryStorage
+from store import EventStore
+
+"""
+
+Microbenchmarks for the hot paths of RSVPBot.
+
+  python benchmarks.py
+
+compares current code paths with the ones they replaced.
+
+  python benchmarks.py suite --save baseline.json
+  python benchmarks.py suite --compare baseline.json --threshold 0.25
+
+times every command's match and execute at several event sizes, plus
+whitespace normalization, narrow URL parsing, and commits and searches at several store
+sizes. --compare exits with status 1 if any case got slower than the
+baseline by more than the threshold.
+
+"""
+
+# The regex RSVPConfirmCommand used before it switched to a bounded scanner,
+# kept here so we can compare the two.
+LEGACY_CONFIRM_REGEX = re.compile(r'^rsvp .*?\b(?P<decision>(yes|no|maybe))\b', flags=re.DOTALL|re.I)
+
+
+def adversarial_confirm_inputs(size):
+  """
+  Messages of roughly `size` characters that start with `rsvp` and make a
+  yes/no/maybe search work as hard as possible.
+  """
+  filler = 'yesterday eyes nose maybes ' * (size // 27 + 1)
+  return {
+    'no decision': 'rsvp ' + filler[:size],
+    'decision at the end': 'rsvp ' + filler[:size] + ' yes',
+    'one long word': 'rsvp ' + 'y' * size,
+    'punctuation': 'rsvp ' + '!?' * (size // 2),
+  }
+
+
+def time_call(func, number):
+  """
+  Best-of-three average seconds per call.
+  """
+  return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def bench_confirm_parsing(sizes=(100 * 1024, 1024 * 1024), number=20):
+  confirm = commands.RSVPConfirmCommand('rsvp')
+  results = []
+
+  for size in sizes:
+    for name, message in sorted(adversarial_confirm_inputs(size).items()):
+      results.append((
+        'confirm match, %s, %dKB' % (name, size // 1024),
+        time_call(lambda: LEGACY_CONFIRM_REGEX.match(message), number),
+        time_call(lambda: confirm.match(message), number),
+      ))
+
+  return results
+
+
+class LegacyConfirmCommand(commands.RSVPConfirmCommand):
+  """
+  RSVPConfirmCommand as it was before events were migrated on load: it
+  patched a missing 'maybe' list into every event it touched.
+  """
+  def confirm(self, event, sender_full_name, decision):
+    if ('maybe' not in event.keys()):
+      event['maybe'] = [];
+    return commands.RSVPConfirmCommand.confirm(self, event, sender_full_name, decision)
+
+
+def mixed_legacy_events(count):
+  """
+  `count` events, every other one written before `maybe` and schema versions existed.
+  """
+  events = {}
+  for idx in range(count):
+    event = {
+      'name': 'topic %d' % idx, 'description': None, 'place': None, 'creator': 1,
+      'yes': ['Person %d' % n for n in range(20)], 'no': [], 'time': None, 'limit': None,
+      'date': '2015-01-01',
+    }
+    if idx % 2:
+      event = schema.new_event(maybe=[], **event)
+    events['stream/topic %d' % idx] = event
+  return events
+
+
+def bench_confirm_legacy_store(count=1000, number=20):
+  legacy_confirm = LegacyConfirmCommand('rsvp')
+  confirm = commands.RSVPConfirmCommand('rsvp')
+  legacy_events = mixed_legacy_events(count)
+  # RSVP does this once, when it loads the events.
+  migrated_events = mixed_legacy_events(count)
+  schema.migrate(migrated_events)
+
+  def confirm_all(command, events):
+    for event in events.values():
+      command.confirm(event, 'Someone', 'maybe')
+      command.confirm(event, 'Someone', 'no')
+
+  return [(
+    'confirm x2 on %d mixed-legacy events' % count,
+    time_call(lambda: confirm_all(legacy_confirm, legacy_events), number),
+    time_call(lambda: confirm_all(confirm, migrated_events), number),
+  )]
+
+
+def read_heavy_replay(count, events=50, read_share=0.9):
+  """
+  `count` messages spread over `events` events, `read_share` of them
+  summaries, help and the like, the rest RSVPs.
+  """
+  reads = ['rsvp summary', 'rsvp help', 'rsvp status', 'rsvp credits']
+  messages = []
+  for idx in range(count):
+    if (idx % 100) < read_share * 100:
+      content = reads[idx % len(reads)]
+    else:
+      content = 'rsvp yes'
+    messages.append({
+      'content': content, 'subject': 'topic %d' % (idx % events), 'display_recipient': 'stream',
+      'sender_id': idx, 'sender_full_name': 'Person %d' % idx,
+      'sender_email': 'person%d@example.com' % idx, 'type': 'stream',
+    })
+  return messages
+
+
+def replay(messages, every_command_commits):
+  workdir = tempfile.mkdtemp(prefix='rsvp-bench-')
+  try:
+    instance = rsvp.RSVP('rsvp', filename=os.path.join(workdir, 'events.json'))
+    if every_command_commits:
+      # How RSVP.route behaved before commands declared whether they mutate.
+      for command in instance.command_list:
+        command.mutates = True
+    for subject in set(message['subject'] for message in messages):
+      instance.process_message(dict(messages[0], content='rsvp init', subject=subject))
+    commits = instance.commits
+
+    started = time.time()
+    for message in messages:
+      instance.process_message(message)
+    return instance.commits - commits, (time.time() - started) / len(messages)
+  finally:
+    shutil.rmtree(workdir)
+
+
+def bench_read_heavy_replay(count=2000):
+  messages = read_heavy_replay(count)
+  legacy_commits, legacy = replay(messages, every_command_commits=True)
+  current_commits, current = replay(messages, every_command_commits=False)
+  return [
+    ('read-heavy replay of %d messages, per message' % count, legacy, current),
+    # Counts, not timings.
+    ('read-heavy replay of %d messages, commits' % count, legacy_commits, current_commits),
+  ]
+
+
+def zipf_replay(count, events, skew=1.1, seed=0):
+  """
+  `count` event ids drawn from `events` events, where the k-th most popular
+  event is picked in proportion to 1 / k ** skew.
+  """
+  rng = random.Random(seed)
+  cumulative = []
+  total = 0.0
+  for rank in range(1, events + 1):
+    total += 1.0 / rank ** skew
+    cumulative.append(total)
+  return [
+    u'stream/topic %d' % bisect.bisect_left(cumulative, rng.random() * total)
+    for _ in range(count)
+  ]
+
+
+def rsvp_to(events, event_id, idx):
+  event = events[event_id]
+  events[event_id] = dict(event, yes=event['yes'][-20:] + ['Person %d' % idx])
+
+
+class UncachedEvents(object):
+  """
+  Lets rsvp_to() work on storage directly, for comparison.
+  """
+  def __init__(self, backing):
+    self.backing = backing
+
+  def __getitem__(self, event_id):
+    return self.backing.get(event_id)
+
+  def __setitem__(self, event_id, event):
+    self.backing.put(event_id, event)
+
+
+def bench_zipf_cache(count=20000, events=5000, capacities=(50, 500)):
+  """
+  RSVPs to a few popular events out of many, straight against dbm storage
+  and through EventCaches of different sizes. Returns timing rows and the
+  hit rate of each cache.
+  """
+  workdir = tempfile.mkdtemp(prefix='rsvp-bench-')
+  try:
+    backing = cache.DbmBacking(os.path.join(workdir, 'events'))
+    for idx in range(events):
+      backing.put(u'stream/topic %d' % idx, schema.new_event(name='topic %d' % idx, yes=[], no=[], maybe=[]))
+    replay = zipf_replay(count, events)
+
+    uncached_events = UncachedEvents(backing)
+    started = time.time()
+    for idx, event_id in enumerate(replay):
+      rsvp_to(uncached_events, event_id, idx)
+    uncached = (time.time() - started) / count
+
+    results = []
+    for capacity in capacities:
+      events_cache = cache.EventCache(backing, max_events=capacity)
+      started = time.time()
+      for idx, event_id in enumerate(replay):
+        rsvp_to(events_cache, event_id, idx)
+      events_cache.flush()
+      cached = (time.time() - started) / count
+      results.append((
+        'zipf replay, %d events, cache of %d, per RSVP' % (events, capacity), uncached, cached,
+        events_cache.hit_rate,
+      ))
+    backing.close()
+    return results
+  finally:
+    shutil.rmtree(workdir)
+
+
+# A message each command in RSVP.command_list answers to.
+COMMAND_SAMPLES = {
+  'RSVPInitCommand': 'rsvp init',
+  'RSVPHelpCommand': 'rsvp help',
+  'RSVPCancelCommand': 'rsvp cancel',
+  'RSVPMoveCommand': 'rsvp move http://testhost/#narrow/stream/bench/subject/Moved',
+  'RSVPSetLimitCommand': 'rsvp set limit 50000',
+  'RSVPSetDateCommand': 'rsvp set date 02/25/2100',
+  'RSVPRepeatCommand': 'rsvp repeat weekly until 12/31/2100',
+  'RSVPSetTimeCommand': 'rsvp set time 12:30',
+  'RSVPSetTimeAllDayCommand': 'rsvp set time allday',
+  'RSVPSetDurationCommand': 'rsvp set duration 1:30',
+  'RSVPSetStringAttributeCommand': 'rsvp set place Hopper, 4th floor',
+  'RSVPSummaryCommand': 'rsvp summary',
+  'RSVPPinSummaryCommand': 'rsvp summary pin',
+  'RSVPPingCommand': 'rsvp ping see you there',
+  'RSVPSearchCommand': 'rsvp search board games',
+  'RSVPStatsCommand': 'rsvp stats',
+  'RSVPCreditsCommand': 'rsvp credits',
+  'RSVPUndoCommand': 'rsvp undo',
+  'RSVPConfirmCommand': 'rsvp yes',
+}
+
+EVENT_SIZES = (0, 100, 10000)
+STORE_SIZES = (10, 1000, 10000)
+BENCH_EVENT_ID = u'bench/Testing'
+BENCH_SENDER_ID = 12345
+
+
+SEARCH_WORDS = (u'board games night lunch talk reading group python haskell rust climbing '
+                u'karaoke movie pairing workshop demo coffee walk dinner hack music').split()
+
+
+def search_events(count, vocabulary=5000, seed=0):
+  """
+  {event_id: event} of count events. Names and descriptions mix SEARCH_WORDS
+  with words from a larger vocabulary, picked with a Zipf-like skew like
+  words in real text.
+  """
+  rng = random.Random(seed)
+  words = [u'word%d' % idx for idx in range(vocabulary)]
+  # Everyday words, but not the most common ones.
+  for idx, word in enumerate(SEARCH_WORDS):
+    words.insert(20 + idx * 10, word)
+  cumulative = []
+  total = 0.0
+  for rank in range(len(words)):
+    total += 1.0 / (rank + 1)
+    cumulative.append(total)
+
+  def pick(n):
+    return u' '.join(words[bisect.bisect(cumulative, rng.random() * total)] for _ in range(n))
+
+  events = {}
+  for idx in range(count):
+    event = bench_event(0)
+    event['name'] = pick(3)
+    event['description'] = pick(8)
+    event['place'] = u'Room %d' % rng.randint(1, 50)
+    event['date'] = u'2100-%02d-%02d' % (rng.randint(1, 12), rng.randint(1, 28))
+    events[u'bench/topic %d' % idx] = event
+  return events
+
+
+def bench_search(count=100000, queries=(u'board games', u'python reading group', u'word1', u'word4000', u'nothing matches')):
+  """
+  Building an index of count events, and searching it.
+  """
+  events = search_events(count)
+  start = time.time()
+  index = search.SearchIndex(events)
+  results = [('index %d events' % count, time.time() - start)]
+  for query in queries:
+    results.append(('search %r, %d events' % (str(query), count), autorange_call(lambda: index.search(query))))
+  return results
+
+
+def autorange_call(func, min_time=0.02):
+  """
+  Like time_call, with the number of calls picked so that each of the three
+  runs takes at least min_time seconds.
+  """
+  number = 1
+  while True:
+    if timeit.timeit(func, number=number) >= min_time:
+      return time_call(func, number)
+    number *= 2
+
+
+def bench_event(attendees):
+  return schema.new_event(
+    name=u'Testing', description=None, place=None, creator=BENCH_SENDER_ID,
+    yes=[u'Person %d' % idx for idx in range(attendees)], no=[], maybe=[],
+    time=None, limit=None, date=u'2100-01-01', user_ids={}, user_group=None,
+    recurrence=None, past_occurrences=[], duration=None, changed_minds={},
+  )
+
+
+def command_cases(instance):
+  """
+  (name, func) pairs timing match() and execute() for every command.
+  """
+  cases = []
+  for command in instance.command_list:
+    name = command.__class__.__name__
+    content = COMMAND_SAMPLES[name]
+    found, matches = instance.find_command(content)
+    if found is not command:
+      raise RuntimeError('%r is answered by %s, not %s' % (content, found.__class__.__name__, name))
+
+    cases.append(('match %s' % name, lambda command=command, content=content: command.match(content)))
+
+    for attendees in EVENT_SIZES:
+      base = bench_event(attendees)
+      kwargs = {
+        'event_id': BENCH_EVENT_ID,
+        'sender_full_name': u'Bench Person',
+        'sender_id': BENCH_SENDER_ID,
+        'subject': u'Testing',
+      }
+      kwargs.update(matches.groupdict())
+
+      def execute(command=command, base=base, kwargs=kwargs):
+        # Every call starts from the same event. Attendee lists are shared
+        # with base, which is fine: commands never change them in place.
+        events = EventStore({BENCH_EVENT_ID: dict(base)})
+        command.execute(events, event=events[BENCH_EVENT_ID], **kwargs)
+
+      cases.append(('execute %s, %d attendees' % (name, attendees), execute))
+  return cases
+
+
+def suite_cases(workdir):
+  instance = rsvp.RSVP('rsvp', storage=MemoryStorage())
+  cases = command_cases(instance)
+
+  for size in (16, 1024, 100 * 1024):
+    content = ('rsvp  \t yes\n' * (size // 13 + 1))[:size]
+    cases.append(('normalize_whitespace, %d bytes' % size, lambda content=content: instance.normalize_whitespace(content)))
+
+  url = 'https://zulip.example.com/#narrow/stream/announce/topic/All.20Hands.20Meeting'
+  cases.append(('narrow_url_to_stream_topic', lambda: util.narrow_url_to_stream_topic(url)))
+
+  for size in STORE_SIZES:
+    store_rsvp = rsvp.RSVP('rsvp', filename=os.path.join(workdir, 'commit-%d.json' % size), events=EventStore(dict(
+      (u'bench/topic %d' % idx, bench_event(10)) for idx in range(size)
+    )))
+    cases.append(('commit_events, %d events' % size, store_rsvp.commit_events))
+    memory_rsvp = rsvp.RSVP('rsvp', storage=MemoryStorage(), events=store_rsvp.events)
+    cases.append(('commit_events in memory, %d events' % size, memory_rsvp.commit_events))
+
+    index = search.SearchIndex(search_events(size))
+    cases.append(('search, %d events' % size, lambda index=index: index.search(u'python reading group')))
+
+  return cases
+
+
+def run_suite(name_filter=None):
+  """
+  Returns {case name: seconds per call}.
+  """
+  workdir = tempfile.mkdtemp(prefix='rsvp-bench-')
+  try:
+    return dict(
+      (name, autorange_call(func))
+      for name, func in suite_cases(workdir)
+      if not name_filter or name_filter in name
+    )
+  finally:
+    shutil.rmtree(workdir)
+
+
+def compare(results, baseline, threshold):
+  """
+  Returns (lines of a report, names of the cases that regressed).
+  """
+  lines = ['%-60s %12s %12s %8s' % ('case', 'base (ms)', 'now (ms)', 'change')]
+  regressed = []
+  for name in sorted(results):
+    now = results[name]
+    if name not in baseline:
+      lines.append('%-60s %12s %12.4f %8s' % (name, '-', now * 1000, 'new'))
+      continue
+    change = now / baseline[name] - 1 if baseline[name] else 0.0
+    flag = ''
+    if change > threshold:
+      regressed.append(name)
+      flag = '  REGRESSED'
+    lines.append('%-60s %12.4f %12.4f %+7.0f%%%s' % (name, baseline[name] * 1000, now * 1000, change * 100, flag))
+  return lines, regressed
+
+
+def save_baseline(filename, results):
+  with open(filename, 'w+') as f:
+    json.dump({'python': platform.python_version(), 'cases': results}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(filename):
+  with open(filename) as f:
+    return json.load(f)['cases']
+
+
+def suite_main(args):
+  results = run_suite(args.filter)
+
+  if args.compare:
+    lines, regressed = compare(results, load_baseline(args.compare), args.threshold)
+    print('\n'.join(lines))
+    if regressed:
+      print('\n%d cases regressed by more than %d%%' % (len(regressed), args.threshold * 100))
+  else:
+    regressed = []
+    for name in sorted(results):
+      print('%-60s %12.4f' % (name, results[name] * 1000))
+
+  if args.save:
+    save_baseline(args.save, results)
+  return 1 if regressed else 0
+
+
+def report_main():
+  print('%-50s %14s %14s' % ('case', 'legacy (ms)', 'current (ms)'))
+  for name, legacy, current in bench_confirm_parsing() + bench_confirm_legacy_store() + bench_read_heavy_replay():
+    if isinstance(legacy, int):
+      print('%-50s %14d %14d' % (name, legacy, current))
+    else:
+      print('%-50s %14.4f %14.4f' % (name, legacy * 1000, current * 1000))
+
+  print('')
+  print('%-50s %14s %14s %9s' % ('case', 'dbm (ms)', 'cached (ms)', 'hit rate'))
+  for name, uncached, cached, hit_rate in bench_zipf_cache():
+    print('%-50s %14.4f %14.4f %8.1f%%' % (name, uncached * 1000, cached * 1000, hit_rate * 100))
+
+  print('')
+  print('%-50s %14s' % ('case', 'time (ms)'))
+  for name, seconds in bench_search():
+    print('%-50s %14.4f' % (name, seconds * 1000))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Microbenchmarks for RSVPBot.')
+  parser.add_argument('mode', nargs='?', default='report', choices=['report', 'suite'])
+  parser.add_argument('--save', help='write suite results to this baseline file')
+  parser.add_argument('--compare', help='compare suite results with this baseline file')
+  parser.add_argument('--threshold', type=float, default=0.25, help='slowdown that counts as a regression')
+  parser.add_argument('--filter', help='only run suite cases whose name contains this')
+  args = parser.parse_args()
+
+  if args.mode == 'suite':
+    return suite_main(args)
+  report_main()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,26 +1,152 @@
 #! /usr/local/bin/python
-import zulip
 import json
-import requests
 import random
 import os
+import signal
+import sys
+import traceback
+import threading
+import time
+import Queue
 
 import rsvp
+import outbox
+import pinned_summary
+import ratelimit
+import aggregate
+import ingress
+import tracing
+import user_groups
+import strings
 
 class bot():
     ''' bot takes a zulip username and api key, a word or phrase to respond to, a search string for giphy,
         an optional caption or list of captions, and a list of the zulip streams it should be active in.
         it then posts a caption and a randomly selected gif in response to zulip messages.
+
+        Subscribing to streams happens in a background thread, in chunks of subscription_chunk_size
+        streams sent by up to subscription_workers concurrent requests, so the bot can start answering
+        before every stream in the realm is subscribed. Streams listed in subscriptions_filename (a
+        snapshot of what we subscribed to last time) are skipped. If subscribing fails, e.g. with a
+        bad API key, main() stops with the error rather than running without subscriptions. A bot
+        following every stream also subscribes to streams created while it runs.
+
+        Pinned summaries are edited at most once every summary_window seconds. With an ack_window,
+        "is attending!" replies to the same event within ack_window seconds are merged into one
+        message (see aggregate.py).
+
+        With a group_window, every event gets a Zulip user group of the people going, synced at most
+        once every group_window seconds, and `rsvp ping` mentions the group (see user_groups.py).
+
+        Events are handled one at a time from a queue of at most ingress_size events, which sheds
+        chatter and read-only commands when the bot falls behind (see ingress.py). With busy_notice,
+        people whose commands are queued behind a backlog are told so, once a minute per thread.
+        Reading events from Zulip never waits more than ingress_timeout seconds for room in the
+        queue: a command that still doesn't fit is dropped, and its thread is told to try again.
+
+        With an outbox_filename, replies are queued on disk and sent, with retries, by a thread of
+        their own (see outbox.py), so a slow or failing Zulip doesn't hold up handling messages.
+
+        With rate_limit, commands flooding in from one sender or one thread are dropped (see
+        ratelimit.py).
+
+        With ambiguous='reject', an RSVP giving conflicting answers (`rsvp yes no`) is turned down
+        instead of going with the first one. Only the first max_scan_length characters of a message
+        are looked at for an answer (see RSVPConfirmCommand).
+
+        Events are saved to filename, or to storage if given one (see storage.py).
+
+        A trace_sample_rate share of messages are traced (see tracing.py) into trace_filename.
+
+        Bots hosted together in one process (see realms.py) pass a shared debounce.Scheduler and
+        ingress.WorkerPool instead of starting threads of their own for them.
+
+        Commands can be reloaded from commands.py without a restart, by a private `rsvp reload`
+        from one of the admins (a list of email addresses) or a signal (see reload_on_signal).
      '''
-    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=[], zulip_site=None):
+    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=[], zulip_site=None,
+                 filename='events.json', subscriptions_filename='subscriptions.json',
+                 subscription_chunk_size=50, subscription_workers=4, events=None, summary_window=10,
+                 ack_window=0, ingress_size=1000, ingress_timeout=1, busy_notice=False, trace_filename=None,
+                 trace_sample_rate=0.01, scheduler=None, pool=None, admins=(),
+                 group_window=None, rate_limit=False, outbox_filename=None, storage=None,
+                 ambiguous=None, max_scan_length=None):
         self.username = zulip_username
         self.api_key = zulip_api_key
         self.site = zulip_site
         self.key_word = key_word.lower()
+        self.admins = set(admins)
+        self.reload_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.main_thread = None
+        self.reload_thread = None
         self.subscribed_streams = subscribed_streams
-        self.client = zulip.Client(zulip_username, zulip_api_key, site=zulip_site)
-        self.subscriptions = self.subscribe_to_streams()
-        self.rsvp = rsvp.RSVP(key_word)
+        self.subscriptions_filename = subscriptions_filename
+        self.subscription_chunk_size = subscription_chunk_size
+        self.subscription_workers = subscription_workers
+        self.snapshot_lock = threading.Lock()
+        self.subscribed = self.load_subscription_snapshot()
+        self.subscription_error = None
+        self.client_lock = threading.Lock()
+        self._client = None
+        self._outbox_client = None
+        self.subscriptions = threading.Thread(target=self.subscribe_to_streams)
+        self.subscriptions.daemon = True
+        self.subscriptions.start()
+        self.tracer = tracing.Tracer(trace_filename, trace_sample_rate)
+        limiter = ratelimit.RateLimiter(key_word) if rate_limit else None
+        self.rsvp = rsvp.RSVP(key_word, filename=filename, events=events, tracer=self.tracer, limiter=limiter,
+                              storage=storage, ambiguous=ambiguous, max_scan_length=max_scan_length)
+        self.pinned_summaries = pinned_summary.PinnedSummaries(self.rsvp, self.update_message, summary_window)
+        self.outbox = None
+        if outbox_filename:
+            self.outbox = outbox.Outbox(outbox_filename, self.post_message, confirm=self.find_sent).start()
+        self.replies = aggregate.ReplyAggregator(self.send_message, ack_window)
+        debouncers = [self.pinned_summaries.debouncer]
+        if ack_window:
+            debouncers.append(self.replies.debouncer)
+        self.user_groups = None
+        if group_window is not None:
+            self.user_groups = user_groups.UserGroups(self.rsvp, self.api_query, group_window)
+            debouncers.append(self.user_groups.debouncer)
+        # The debouncers and ingress thread this bot started itself, rather than handed to a shared
+        # scheduler or pool, and so has to stop.
+        self.debouncers = []
+        for debouncer in debouncers:
+            if scheduler:
+                scheduler.add(debouncer)
+            else:
+                self.debouncers.append(debouncer.start())
+        self.busy_notified = {}
+        self.ingress = ingress.IngressQueue(key_word, ingress_size,
+                                            on_overload=self.send_busy_notice if busy_notice else None,
+                                            put_timeout=ingress_timeout, on_drop=self.send_dropped_notice)
+        if pool:
+            self.ingress.attach(pool, self.handle_event)
+        else:
+            self.ingress.start(self.handle_event)
+
+    @property
+    def client(self):
+        ''' The zulip client, created (and zulip imported) on first use.
+        '''
+        with self.client_lock:
+            if self._client is None:
+                import zulip
+                self._client = zulip.Client(self.username, self.api_key, site=self.site)
+            return self._client
+
+    @property
+    def outbox_client(self):
+        ''' A second client for the outbox, which doesn't retry failed calls itself: the outbox
+            does, and checks first whether a reply that may have gone out did.
+        '''
+        with self.client_lock:
+            if self._outbox_client is None:
+                import zulip
+                self._outbox_client = zulip.Client(self.username, self.api_key, site=self.site,
+                                                   retry_on_errors=False)
+            return self._outbox_client
 
     @property
     def streams(self):
@@ -37,6 +163,7 @@ class bot():
     def get_all_zulip_streams(self):
         ''' Call Zulip API to get a list of all streams
         '''
+        import requests
         response = requests.get(self.client.base_url + 'v1/streams', auth=(self.username, self.api_key))
         if response.status_code == 200:
             return response.json()['streams']
@@ -46,10 +173,68 @@ class bot():
             raise RuntimeError(':( we failed to GET streams.\n(%s)' % response)
 
 
+    def load_subscription_snapshot(self):
+        ''' Returns the set of stream names we know we are already subscribed to.
+        '''
+        try:
+            with open(self.subscriptions_filename, 'r') as f:
+                return set(json.load(f))
+        except (IOError, ValueError):
+            return set()
+
+    def save_subscription_snapshot(self, subscribed):
+        with open(self.subscriptions_filename, 'w+') as f:
+            json.dump(sorted(subscribed), f)
+
+
     def subscribe_to_streams(self):
-        ''' Subscribes to zulip streams
+        ''' Subscribes to every stream the bot should be in. Run by the subscriptions thread, which
+            leaves any failure in self.subscription_error for main() to stop with.
+        '''
+        try:
+            self.subscribe(self.streams)
+        except Exception as e:
+            self.subscription_error = e
+
+    def subscribe(self, streams):
+        ''' Subscribes to those of streams we are not subscribed to yet, in bounded-size chunks
+            issued concurrently. Blocks until every chunk has been tried, and raises RuntimeError
+            if any of them failed.
         '''
-        self.client.add_subscriptions(self.streams)
+        with self.snapshot_lock:
+            pending = [stream for stream in streams if stream['name'] not in self.subscribed]
+        failures = []
+
+        size = self.subscription_chunk_size
+        chunks = Queue.Queue()
+        for idx in range(0, len(pending), size):
+            chunks.put(pending[idx:idx + size])
+        chunks_total = chunks.qsize()
+
+        def worker():
+            while True:
+                try:
+                    chunk = chunks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = self.client.add_subscriptions(chunk)
+                except Exception as e:
+                    result = {'result': 'error', 'msg': str(e)}
+                if result.get('result') == 'success':
+                    with self.snapshot_lock:
+                        self.subscribed.update(stream['name'] for stream in chunk)
+                        self.save_subscription_snapshot(self.subscribed)
+                else:
+                    failures.append(result.get('msg') or result)
+
+        workers = [threading.Thread(target=worker) for _ in range(min(self.subscription_workers, chunks.qsize()))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if failures:
+            raise RuntimeError('%d of %d subscription requests failed: %s' % (len(failures), chunks_total, failures[0]))
 
 
     def respond(self, message):
@@ -58,29 +243,199 @@ class bot():
 
         replies = self.rsvp.process_message(message)
 
-        for reply in replies:
+        for idx, reply in enumerate(replies):
             if reply:
-                self.send_message(reply)
-            
+                if 'id' in message:
+                    # The same message handled twice is only answered once.
+                    reply['dedup_key'] = '%s-%d' % (message['id'], idx)
+                with self.tracer.span('send'):
+                    self.replies.send(reply)
+
     def send_message(self, msg):
-        ''' Sends a message to zulip stream or user 
+        ''' Sends a message to zulip stream or user, through the outbox if there is one
+        '''
+        if self.outbox is not None:
+            self.outbox.put(msg, msg.get('dedup_key'))
+            return None
+        return self.post_message(msg)
+
+    def post_message(self, msg):
+        ''' Actually sends a message, and keeps up any summary it pins. Replies sent by the outbox
+            thread are traced on their own, as 'reply' traces with a 'post' span.
         '''
         msg_to = msg['display_recipient']
         if msg['type'] == 'private':
             msg_to = msg['sender_email']
 
-        self.client.send_message({
-            "type": msg['type'],
-            "subject": msg["subject"],
-            "to": msg_to,
-            "content": msg['body']
-        })
+        client = self.outbox_client if self.outbox is not None else self.client
+        with self.tracer.trace('reply', stream=msg.get('display_recipient'), subject=msg.get('subject')):
+            with self.tracer.span('post'):
+                result = client.send_message({
+                    "type": msg['type'],
+                    "subject": msg["subject"],
+                    "to": msg_to,
+                    "content": msg['body']
+                })
+        if msg.get('pin') and result and result.get('result') == 'success':
+            self.pinned_summaries.pinned(msg['pin'], result['id'], msg['body'])
+        return result
+
+    def find_sent(self, msg, since):
+        ''' Whether we posted msg at or after since (a timestamp), for the outbox. None if Zulip
+            couldn't be asked.
+        '''
+        if msg['type'] == 'private':
+            narrow = [['pm-with', msg['sender_email']]]
+        else:
+            narrow = [['stream', msg['display_recipient']], ['topic', msg['subject']]]
+        request = {
+            # The newest messages: older servers want a message id here, not 'newest'.
+            'anchor': 10 ** 15,
+            'num_before': 50,
+            'num_after': 0,
+            'narrow': narrow + [['sender', self.username]],
+            'apply_markdown': False,
+        }
+        result = self.outbox_client.do_api_query(request, 'v1/messages', method='GET')
+        if result.get('result') != 'success':
+            return None
+        return any(message['content'] == msg['body'] and message['timestamp'] >= int(since)
+                   for message in result['messages'])
+
+    def update_message(self, message_id, content):
+        ''' Edits the content of a message the bot sent earlier
+        '''
+        return self.client.do_api_query({'content': content}, 'v1/messages/%d' % message_id, method='PATCH')
+
+
+    def api_query(self, request, url, method='POST'):
+        return self.client.do_api_query(request, url, method=method)
+
 
+    def send_busy_notice(self, message, text=None):
+        ''' Tells the thread a command came from that we are behind, unless we just did.
+        '''
+        text = text or strings.MSG_BUSY
+        thread = ingress.thread_of({'message': message})
+        now = time.time()
+        if now - self.busy_notified.get((thread, text), 0) < 60:
+            return
+        self.busy_notified[(thread, text)] = now
+        reply = self.rsvp.create_message_from_message(message, text)
+        self.send_message(reply)
+
+    def send_dropped_notice(self, message):
+        ''' Tells the thread a command came from that it was dropped, unless we just did.
+        '''
+        self.send_busy_notice(message, strings.ERROR_TOO_BUSY)
+
+    def reload_commands(self, modules=True):
+        ''' Reloads commands.py and strings.py, leaving events, subscriptions, the event queue and
+            any replies waiting to go out alone. Returns a message saying how it went.
+            With modules=False, only rebuilds the commands from the modules already loaded.
+        '''
+        try:
+            count = self.rsvp.reload_commands(modules)
+        except Exception as e:
+            traceback.print_exc()
+            return strings.ERROR_RELOAD_FAILED % e
+        return strings.MSG_COMMANDS_RELOADED % count
+
+    def is_reload_request(self, message):
+        return (message['type'] == 'private' and message.get('sender_email') in self.admins
+                and self.rsvp.normalize_whitespace(message['content']).lower() == self.key_word + ' reload')
+
+    def watch_for_reload(self):
+        ''' Reloads commands whenever self.reload_requested is set, e.g. from a signal handler.
+            The reload itself waits its turn in the ingress queue, so it never happens halfway
+            through handling a message.
+        '''
+        def request_reload():
+            while True:
+                self.reload_requested.wait()
+                self.reload_requested.clear()
+                if self.stopping.is_set():
+                    return
+                self.ingress.put({'type': 'reload_commands'})
+
+        self.reload_thread = threading.Thread(target=request_reload)
+        self.reload_thread.daemon = True
+        self.reload_thread.start()
+
+    def reload_on_signal(self, signum=signal.SIGHUP):
+        ''' Reloads commands whenever the process gets signum. Has to be called from the main thread.
+        '''
+        self.watch_for_reload()
+        signal.signal(signum, lambda *args: self.reload_requested.set())
+
+    def handle_event(self, event):
+        ''' Messages get a response. Renamed streams and topics take their events with them.
+            Admins can reload the commands.
+        '''
+        if event['type'] == 'message' and self.is_reload_request(event['message']):
+            reply = self.rsvp.create_message_from_message(event['message'], self.reload_commands())
+            self.send_message(reply)
+        elif event['type'] == 'reload_commands':
+            sys.stderr.write(self.reload_commands(event.get('modules', True)) + '\n')
+        elif event['type'] == 'message':
+            message = event['message']
+            with self.tracer.trace('message', stream=message.get('display_recipient'),
+                                   subject=message.get('subject')):
+                self.respond(message)
+        elif event['type'] == 'stream' and event.get('op') == 'update' and event.get('property') == 'name':
+            self.rsvp.rename_stream(event['name'], event['value'])
+        elif event['type'] == 'stream' and event.get('op') == 'create' and not self.subscribed_streams:
+            self.subscribe([{'name': stream['name']} for stream in event['streams']])
+        elif event['type'] == 'update_message' and 'orig_subject' in event and 'stream_name' in event:
+            # Moving a single message to another topic doesn't move the event.
+            if event.get('propagate_mode', 'change_all') != 'change_one':
+                self.rsvp.rename_topic(event['stream_name'], event['orig_subject'], event['subject'])
 
     def main(self):
-        ''' Blocking call that runs forever. Calls self.respond() on every event received.
+        ''' Blocking call that runs until stop(). Every event received goes through self.ingress
+            to self.handle_event().
+
+            The same long-poll loop as zulip.Client.call_on_each_event, which never returns.
         '''
-        self.client.call_on_each_message(lambda msg: self.respond(msg))
+        self.main_thread = threading.current_thread()
+        queue_id = None
+        while not self.stopping.is_set():
+            if self.subscription_error is not None:
+                raise RuntimeError('Subscribing to streams failed: %s' % self.subscription_error)
+            if queue_id is None:
+                result = self.client.register(event_types=['message', 'stream', 'update_message'])
+                if 'error' in result.get('result'):
+                    self.stopping.wait(1)
+                    continue
+                queue_id, last_event_id = result['queue_id'], result['last_event_id']
+
+            result = self.client.get_events(queue_id=queue_id, last_event_id=last_event_id)
+            if 'error' in result.get('result'):
+                # Our event queue went away, e.g. the server restarted: get a new one.
+                if result.get('msg', '').startswith('Bad event queue id:'):
+                    queue_id = None
+                self.stopping.wait(1)
+                continue
+
+            for event in result['events']:
+                last_event_id = max(last_event_id, int(event['id']))
+                self.ingress.put(event)
+
+    def stop(self, timeout=5):
+        ''' Stops the threads this bot started: its main loop (once the long-poll in progress
+            returns), event handling, debouncers and outbox. Anything still queued is left alone,
+            and replies in the outbox go out on the next start.
+        '''
+        self.stopping.set()
+        self.reload_requested.set()
+        for thread in (self.main_thread, self.reload_thread, self.subscriptions):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout)
+        self.ingress.stop(timeout)
+        for debouncer in self.debouncers:
+            debouncer.stop(timeout)
+        if self.outbox is not None:
+            self.outbox.stop(timeout)
 
 
 ''' The Customization Part!
@@ -96,13 +451,59 @@ class bot():
 
 '''
 
-zulip_username = os.environ['ZULIP_RSVP_EMAIL']
-zulip_api_key = os.environ['ZULIP_RSVP_KEY']
-zulip_site = os.getenv('ZULIP_RSVP_SITE', None)
-key_word = 'rsvp'
+def bot_from_env(**overrides):
+    ''' A bot set up from the ZULIP_RSVP_* environment variables, the way `python bot.py` runs it.
+        Keyword arguments are passed on to bot() over what the environment says, e.g. the events
+        a standby took over with (see replication.py).
+    '''
+    zulip_username = os.environ['ZULIP_RSVP_EMAIL']
+    zulip_api_key = os.environ['ZULIP_RSVP_KEY']
+    key_word = 'rsvp'
+
+    sandbox_stream =  os.getenv('ZULIP_RSVP_SANDBOX_STREAM', '')
+    subscribed_streams = []
+
+    group_window = os.getenv('ZULIP_RSVP_GROUP_WINDOW')
+    max_scan_length = os.getenv('ZULIP_RSVP_MAX_SCAN_LENGTH')
+    options = dict(
+        zulip_site=os.getenv('ZULIP_RSVP_SITE', None),
+        summary_window=float(os.getenv('ZULIP_RSVP_SUMMARY_WINDOW', 10)),
+        ack_window=float(os.getenv('ZULIP_RSVP_ACK_WINDOW', 0)),
+        ingress_size=int(os.getenv('ZULIP_RSVP_INGRESS_SIZE', 1000)),
+        ingress_timeout=float(os.getenv('ZULIP_RSVP_INGRESS_TIMEOUT', 1)),
+        busy_notice=bool(os.getenv('ZULIP_RSVP_BUSY_NOTICE')),
+        admins=[email for email in os.getenv('ZULIP_RSVP_ADMINS', '').split(',') if email],
+        trace_filename=os.getenv('ZULIP_RSVP_TRACE_FILE'),
+        trace_sample_rate=float(os.getenv('ZULIP_RSVP_TRACE_SAMPLE', 0.01)),
+        group_window=float(group_window) if group_window else None,
+        rate_limit=bool(os.getenv('ZULIP_RSVP_RATE_LIMIT')),
+        outbox_filename=os.getenv('ZULIP_RSVP_OUTBOX', 'outbox.jsonl'),
+        ambiguous=os.getenv('ZULIP_RSVP_AMBIGUOUS'),
+        max_scan_length=int(max_scan_length) if max_scan_length else None,
+    )
+    options.update(overrides)
+    return bot(zulip_username, zulip_api_key, key_word, subscribed_streams, **options)
+
+
+if __name__ == '__main__':
+    new_bot = bot_from_env()
+    # `kill -HUP <pid>` reloads commands.py.
+    new_bot.reload_on_signal()
+
+    # host:port of a `python replication.py standby` to stream every change to.
+    standby = os.getenv('ZULIP_RSVP_STANDBY')
+    if standby:
+        import replication
+        host, port = standby.rsplit(':', 1)
+        replication.JournalPublisher(host, int(port)).attach(new_bot.rsvp)
 
-sandbox_stream =  os.getenv('ZULIP_RSVP_SANDBOX_STREAM', '')
-subscribed_streams = []
+    # Serve .ics feeds of the events on this port, to whoever has a URL made with this secret
+    # (see calendar_feed.py).
+    calendar_port = os.getenv('ZULIP_RSVP_CALENDAR_PORT')
+    if calendar_port:
+        import calendar_feed
+        calendar_feed.CalendarFeedServer(new_bot.rsvp, host=os.getenv('ZULIP_RSVP_CALENDAR_HOST', '127.0.0.1'),
+                                         port=int(calendar_port),
+                                         secret=os.environ['ZULIP_RSVP_CALENDAR_SECRET']).start()
 
-new_bot = bot(zulip_username, zulip_api_key, key_word, subscribed_streams, zulip_site=zulip_site)
-new_bot.main()
\ No newline at end of file
+    new_bot.main()
@@ -0,0 +1,169 @@
+from __future__ import with_statement
+import anydbm
+import collections
+import json
+import threading
+
+"""
+
+A memory-bounded cache of decoded events in front of per-event storage.
+
+RSVP keeps every event in memory today and rewrites events.json on every
+commit. With events kept one per key instead (DbmBacking, or anything with
+the same get/put/delete/keys methods), EventCache holds on to the events
+people are actually talking about:
+
+  - reads of a cached event don't touch storage or decode anything,
+  - writes only mark the event dirty. It goes to storage when it is evicted
+    or on flush(),
+  - so do reads: commands change the events they get in place, and there is
+    no telling afterwards which ones did, so every event handed out is
+    written back as if it had been changed. Its size is measured again then,
+    too,
+  - the least recently used events are evicted once there are more than
+    max_events of them, or once their encoded size passes max_bytes.
+
+stats counts hits, misses, evictions and write-backs.
+
+"""
+
+class DbmBacking(object):
+  """
+  Events stored one per key, as JSON, in a dbm file.
+  """
+
+  def __init__(self, filename):
+    self.db = anydbm.open(filename, 'c')
+    self.lock = threading.Lock()
+    self.reads = 0
+    self.writes = 0
+
+  def get(self, event_id):
+    with self.lock:
+      self.reads += 1
+      data = self.db.get(event_id.encode('utf-8'))
+    if data is None:
+      return None
+    return json.loads(data)
+
+  def put(self, event_id, event):
+    data = json.dumps(event)
+    with self.lock:
+      self.writes += 1
+      self.db[event_id.encode('utf-8')] = data
+
+  def delete(self, event_id):
+    with self.lock:
+      key = event_id.encode('utf-8')
+      if key in self.db:
+        del self.db[key]
+
+  def keys(self):
+    with self.lock:
+      return [key.decode('utf-8') for key in self.db.keys()]
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+
+class EventCache(collections.MutableMapping):
+
+  def __init__(self, backing, max_events=1000, max_bytes=None):
+    self.backing = backing
+    self.max_events = max_events
+    self.max_bytes = max_bytes
+    self.lock = threading.RLock()
+    # Least recently used first.
+    self.entries = collections.OrderedDict()
+    self.sizes = {}
+    self.bytes = 0
+    self.dirty = set()
+    self.stats = collections.Counter()
+
+  @property
+  def hit_rate(self):
+    lookups = self.stats['hits'] + self.stats['misses']
+    return float(self.stats['hits']) / lookups if lookups else None
+
+  def size_of(self, event):
+    # Only worth encoding the event if there is a byte budget to keep to.
+    return len(json.dumps(event)) if self.max_bytes else 0
+
+  def insert(self, event_id, event):
+    self.bytes -= self.sizes.pop(event_id, 0)
+    self.entries.pop(event_id, None)
+    self.entries[event_id] = event
+    self.sizes[event_id] = self.size_of(event)
+    self.bytes += self.sizes[event_id]
+    self.evict()
+
+  def evict(self):
+    while self.entries and (len(self.entries) > self.max_events or
+                            (self.max_bytes and self.bytes > self.max_bytes)):
+      event_id, event = self.entries.popitem(last=False)
+      self.bytes -= self.sizes.pop(event_id)
+      self.stats['evictions'] += 1
+      if event_id in self.dirty:
+        self.dirty.discard(event_id)
+        self.backing.put(event_id, event)
+        self.stats['writebacks'] += 1
+
+  def __getitem__(self, event_id):
+    with self.lock:
+      event = self.entries.pop(event_id, None)
+      if event is not None:
+        self.stats['hits'] += 1
+        # Back to the most recently used end.
+        self.entries[event_id] = event
+        self.dirty.add(event_id)
+        return event
+
+      self.stats['misses'] += 1
+      event = self.backing.get(event_id)
+      if event is None:
+        raise KeyError(event_id)
+      self.dirty.add(event_id)
+      self.insert(event_id, event)
+      return event
+
+  def __setitem__(self, event_id, event):
+    with self.lock:
+      self.dirty.add(event_id)
+      self.insert(event_id, event)
+
+  def __delitem__(self, event_id):
+    with self.lock:
+      cached = event_id in self.entries
+      if cached:
+        del self.entries[event_id]
+        self.bytes -= self.sizes.pop(event_id)
+        self.dirty.discard(event_id)
+      elif self.backing.get(event_id) is None:
+        raise KeyError(event_id)
+      self.backing.delete(event_id)
+
+  def __iter__(self):
+    with self.lock:
+      keys = set(self.entries) | set(self.backing.keys())
+    return iter(keys)
+
+  def __len__(self):
+    with self.lock:
+      return len(set(self.entries) | set(self.backing.keys()))
+
+  def flush(self):
+    """
+    Writes every dirty event back to storage. Returns how many there were.
+    """
+    with self.lock:
+      dirty = [(event_id, self.entries[event_id]) for event_id in self.dirty]
+      self.dirty.clear()
+      for event_id, event in dirty:
+        self.backing.put(event_id, event)
+        self.bytes -= self.sizes[event_id]
+        self.sizes[event_id] = self.size_of(event)
+        self.bytes += self.sizes[event_id]
+      self.evict()
+      self.stats['writebacks'] += len(dirty)
+      return len(dirty)
@@ -0,0 +1,311 @@
+from __future__ import with_statement
+import argparse
+import collections
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from store import EventStore
+
+"""
+
+iCalendar feeds of RSVPBot events, so people can subscribe to them from
+their calendar instead of copying `rsvp summary` by hand.
+
+  /streams/<stream>.ics?token=...   every event in a stream
+  /users/<full name>.ics?token=...  every event someone said yes or maybe to
+
+Feeds show private streams and who is going where, so each one needs its own
+token, an HMAC of its path with the server's secret. Hand people their URL:
+
+  ZULIP_RSVP_CALENDAR_SECRET=... python calendar_feed.py --user 'Ada Lovelace'
+
+The server only listens on 127.0.0.1 unless told otherwise (e.g. to sit
+behind a proxy doing TLS).
+
+Each feed has an ETag built from its body, and a request with a matching
+If-None-Match gets a 304. Rendered events are cached by version, so a feed
+only re-renders the events that changed since the last time it was asked
+for. Who is going to what is indexed as events change, so a user's feed
+doesn't look at anyone else's events.
+
+"""
+
+DEFAULT_DURATION = datetime.timedelta(hours=1)
+
+
+def escape(text):
+  return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n'))
+
+
+def fold(line):
+  """
+  Lines longer than 75 octets have to be folded onto continuation lines.
+  """
+  encoded = line.encode('utf-8')
+  if len(encoded) <= 75:
+    return line
+
+  parts = []
+  while encoded:
+    limit = 75 if not parts else 74
+    chunk = encoded[:limit]
+    # Don't split a multi-byte character in half.
+    while chunk and (ord(encoded[len(chunk):len(chunk) + 1] or '\x00') & 0xC0) == 0x80:
+      chunk = chunk[:-1]
+    parts.append(chunk.decode('utf-8'))
+    encoded = encoded[len(chunk):]
+  return u'\r\n '.join(parts)
+
+
+def event_uid(event_id):
+  return u'%s@rsvpbot' % hashlib.sha1(event_id.encode('utf-8')).hexdigest()
+
+
+def render_event(event_id, event):
+  """
+  Renders one event as a VEVENT block.
+  """
+  date = datetime.datetime.strptime(event.get('date') or '1970-01-01', '%Y-%m-%d')
+  attendees = event['yes'] + event['maybe']
+
+  description = event.get('description') or ''
+  if attendees:
+    description += u'\n\nGoing: ' + u', '.join(attendees)
+
+  lines = [
+    u'BEGIN:VEVENT',
+    u'UID:' + event_uid(event_id),
+    u'SUMMARY:' + escape(event['name']),
+  ]
+
+  if event.get('time'):
+    hours, minutes = [int(part) for part in event['time'].split(':')]
+    start = date.replace(hour=hours, minute=minutes)
+    end = start + (datetime.timedelta(minutes=event['duration']) if event.get('duration') else DEFAULT_DURATION)
+    lines.append(u'DTSTART:' + start.strftime('%Y%m%dT%H%M%S'))
+    lines.append(u'DTEND:' + end.strftime('%Y%m%dT%H%M%S'))
+  else:
+    lines.append(u'DTSTART;VALUE=DATE:' + date.strftime('%Y%m%d'))
+    lines.append(u'DTEND;VALUE=DATE:' + (date + datetime.timedelta(days=1)).strftime('%Y%m%d'))
+
+  rule = event.get('recurrence')
+  if rule:
+    # Calendars expand the series themselves.
+    rrule = u'RRULE:FREQ=' + rule['frequency'].upper()
+    if rule['until']:
+      # UNTIL has to be a DATE-TIME when DTSTART is one: the end of that day.
+      rrule += u';UNTIL=' + rule['until'].replace('-', '') + (u'T235959' if event.get('time') else u'')
+    lines.append(rrule)
+
+  if description:
+    lines.append(u'DESCRIPTION:' + escape(description))
+  if event.get('place'):
+    lines.append(u'LOCATION:' + escape(event['place']))
+  lines.append(u'END:VEVENT')
+
+  return u'\r\n'.join(fold(line) for line in lines)
+
+
+def feed_token(secret, path):
+  """
+  The token that has to come with a request for path (e.g. u'/users/Ada.ics').
+  """
+  return hmac.new(secret, path.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+
+def feed_path(kind, name):
+  """
+  The path of a feed: kind is 'streams' or 'users'.
+  """
+  return u'/%s/%s.ics' % (kind, name)
+
+
+class FeedCache(object):
+  """
+  Rendered VEVENTs keyed by event id, along with the event version they were
+  rendered from, and who said yes or maybe to which events. Kept up to date by
+  listening to the RSVP instance: events that are gone are dropped.
+  """
+
+  def __init__(self, rsvp):
+    self.rsvp = rsvp
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.renders = 0
+    # event id -> who is going, and full name -> ids of the events they are going to.
+    self.attendees = {}
+    self.attending = collections.defaultdict(set)
+    with rsvp.lock:
+      for event_id, event in rsvp.events.to_dict().items():
+        self.index(event_id, event)
+      rsvp.add_listener(self.changed)
+
+  def index(self, event_id, event):
+    with self.lock:
+      for name in self.attendees.pop(event_id, ()):
+        self.attending[name].discard(event_id)
+        if not self.attending[name]:
+          del self.attending[name]
+      if event is None:
+        self.entries.pop(event_id, None)
+        return
+      names = frozenset(event['yes'] + event['maybe'])
+      self.attendees[event_id] = names
+      for name in names:
+        self.attending[name].add(event_id)
+
+  def changed(self, changes):
+    for change in changes:
+      op = change['op']
+      if op == 'put':
+        self.index(change['id'], change['event'])
+      elif op == 'delete':
+        self.index(change['id'], None)
+      elif op == 'rename_topic':
+        self.moved([(EventStore.join_id(change['stream'], change['old']),
+                     EventStore.join_id(change['stream'], change['new']))])
+      elif op == 'rename_stream':
+        with self.lock:
+          old_ids = [event_id for event_id in self.attendees
+                     if EventStore.split_id(event_id)[0] == change['old']]
+        self.moved([(event_id, EventStore.join_id(change['new'], EventStore.split_id(event_id)[1]))
+                    for event_id in old_ids])
+
+  def moved(self, renames):
+    # Listeners run under the RSVP lock, so the events can be looked at here.
+    for old_id, new_id in renames:
+      self.index(old_id, None)
+      self.index(new_id, self.rsvp.events.get(new_id))
+
+  def entry(self, event_id, event):
+    version = self.rsvp.events.version(event_id)
+    with self.lock:
+      cached = self.entries.get(event_id)
+    if cached and cached[0] == version:
+      return cached
+
+    cached = (version, render_event(event_id, dict(event)))
+    with self.lock:
+      self.entries[event_id] = cached
+      self.renders += 1
+    return cached
+
+  def stream_feed(self, stream):
+    events = self.rsvp.events
+    return [
+      (events.join_id(stream, topic), event)
+      for topic, event in events.stream_events(stream).items()
+    ]
+
+  def user_feed(self, name):
+    with self.lock:
+      event_ids = list(self.attending.get(name, ()))
+    feed = [(event_id, self.rsvp.events.snapshot(event_id)) for event_id in event_ids]
+    return [(event_id, event) for event_id, event in feed if event is not None]
+
+  def render(self, feed):
+    """
+    Returns (etag, body) for a list of (event_id, event) pairs.
+    """
+    blocks = [self.entry(event_id, event)[1] for event_id, event in sorted(feed)]
+    body = u'\r\n'.join(
+      [u'BEGIN:VCALENDAR', u'VERSION:2.0', u'PRODID:-//RSVPBot//EN'] + blocks + [u'END:VCALENDAR']
+    ) + u'\r\n'
+    # Versions start over when the bot restarts, so the tag comes from what is sent.
+    etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return etag, body
+
+
+class CalendarFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    path, _, query = self.path.partition('?')
+    path = urllib.unquote(path).decode('utf-8')
+    token = urlparse.parse_qs(query).get('token', [''])[0]
+    cache = self.server.cache
+
+    if not hmac.compare_digest(feed_token(self.server.secret, path), token):
+      self.send_error(403)
+      return
+
+    if path.startswith(u'/streams/') and path.endswith(u'.ics'):
+      feed = cache.stream_feed(path[len(u'/streams/'):-len(u'.ics')])
+    elif path.startswith(u'/users/') and path.endswith(u'.ics'):
+      feed = cache.user_feed(path[len(u'/users/'):-len(u'.ics')])
+    else:
+      self.send_error(404)
+      return
+
+    etag, body = cache.render(feed)
+    if self.headers.getheader('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+
+    body = body.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', etag)
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class CalendarFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  Serves feeds to whoever has their URL. Without a secret, a random one is
+  made up, and URLs handed out stop working when the server restarts.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, rsvp, host='127.0.0.1', port=0, secret=None):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), CalendarFeedHandler)
+    self.secret = secret or os.urandom(32)
+    self.cache = FeedCache(rsvp)
+
+  @property
+  def url(self):
+    return 'http://%s:%d' % self.server_address
+
+  def feed_url(self, kind, name, base_url=None):
+    return feed_url(self.secret, kind, name, base_url or self.url)
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    return self
+
+
+def feed_url(secret, kind, name, base_url):
+  path = feed_path(kind, name)
+  return u'%s%s?token=%s' % (base_url, urllib.quote(path.encode('utf-8')), feed_token(secret, path))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Print the URL of a calendar feed.')
+  group = parser.add_mutually_exclusive_group(required=True)
+  group.add_argument('--user', help='full name of someone to print the URL of their feed for')
+  group.add_argument('--stream', help='stream to print the URL of its feed for')
+  parser.add_argument('--base-url', default='http://127.0.0.1:%s' % os.getenv('ZULIP_RSVP_CALENDAR_PORT', '8080'),
+                      help='where the feeds are served from')
+  args = parser.parse_args()
+
+  kind, name = ('users', args.user) if args.user else ('streams', args.stream)
+  print(feed_url(os.environ['ZULIP_RSVP_CALENDAR_SECRET'], kind, name.decode('utf-8'), args.base_url))
+
+
+if __name__ == '__main__':
+  main()
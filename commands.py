@@ -7,8 +7,20 @@ import urlparse
 import urllib
 
 from strings import *
+import recurrence
+import schema
+import search
+import stats
 import util
 
+def describe_event(events, event_id):
+  """
+  An event's name with a link to its thread.
+  """
+  stream, topic = events.split_id(event_id)
+  return '**%s** (#**%s>%s**)' % (events[event_id]['name'], stream, topic)
+
+
 """
 
 Class that represents a response from an RSVPCommand.
@@ -17,11 +29,16 @@ of this class.
 
 """
 class RSVPMessage(object):
-  def __init__(self, msg_type, body, to=None, subject=None):
+  def __init__(self, msg_type, body, to=None, subject=None, pin=None, aggregate=None):
     self.type = msg_type
     self.body = body
     self.to = to
     self.subject = subject
+    # The id of the event this message is the pinned summary of, if any.
+    self.pin = pin
+    # {'decision': ..., 'name': ...} for acknowledgements that can be merged
+    # with others for the same event (see aggregate.py).
+    self.aggregate = aggregate
 
   def __getitem__(self, attr):
     self.__dict__[attr]
@@ -46,6 +63,14 @@ Base class for an RSVPCommand
 """
 class RSVPCommand(object):
   regex = None
+  # Whether the changes this command makes to its event can be undone.
+  records_history = True
+  # Whether this command can change anything at all. Commands that don't are
+  # handed a snapshot of their event and nothing is committed after them.
+  mutates = True
+  # Whether this command makes a new event in its thread. It is handed the
+  # thread's own id rather than the event an old name of it leads to.
+  creates_event = False
 
   def __init__(self, prefix, *args, **kwargs):
     # prefix is the command start the bot listens to, typically 'rsvp'
@@ -75,6 +100,7 @@ class RSVPEventNeededCommand(RSVPCommand):
 
 class RSVPInitCommand(RSVPCommand):
   regex = r'init$'
+  creates_event = True
 
   def run(self, events, *args, **kwargs):
     sender_id   = kwargs.pop('sender_id')
@@ -90,18 +116,24 @@ class RSVPInitCommand(RSVPCommand):
       # Update the dictionary with the new event and commit.
       events.update(
         {
-          event_id: {
-            'name': subject,
-            'description': None,
-            'place': None,
-            'creator': sender_id,
-            'yes': [],
-            'no': [],
-            'maybe': [],
-            'time': None,
-            'limit': None,
-            'date': '%s' % datetime.date.today(),
-          }
+          event_id: schema.new_event(
+            name=subject,
+            description=None,
+            place=None,
+            creator=sender_id,
+            yes=[],
+            no=[],
+            maybe=[],
+            time=None,
+            limit=None,
+            date='%s' % datetime.date.today(),
+            user_ids={},
+            user_group=None,
+            recurrence=None,
+            past_occurrences=[],
+            duration=None,
+            changed_minds={},
+          )
         }
       )
 
@@ -110,6 +142,7 @@ class RSVPInitCommand(RSVPCommand):
 
 class RSVPHelpCommand(RSVPCommand):
   regex = r'help$'
+  mutates = False
 
 
   def run(self, events, *args, **kwargs):
@@ -121,13 +154,19 @@ class RSVPHelpCommand(RSVPCommand):
     body += "`rsvp help`|Shows this handy table.\n"
     body += "`rsvp ping <message>`|Pings everyone that has RSVP'd so far. Optionally, sends a message, if provided.\n"
     body += "`rsvp set time HH:mm`|Sets the time for this event (24-hour format) (optional)\n"
+    body += "`rsvp set duration H:mm`|Sets how long this event lasts (optional, an hour by default)\n"
     body += "`rsvp set date mm/dd/yyyy`|Sets the date for this event (optional, if not explicitly set, the date for the event is the date of the creation of the event, i.e. the call to `rsvp init`)\n"
+    body += "`rsvp repeat daily|weekly|monthly [until mm/dd/yyyy]`|Makes this event repeat. RSVPs start over for every occurrence. `rsvp repeat never` stops it.\n"
     body += "`rsvp set description DESCRIPTION`|Sets this event's description to DESCRIPTION (optional)\n"
     body += "`rsvp set place PLACE_NAME`|Sets the place for this event to PLACE_NAME (optional)\n"
     body += "`rsvp set limit LIMIT`|Set the attendance limit for this event to LIMIT. Set LIMIT as 0 for infinite attendees.\n"
     body += "`rsvp cancel`|Cancels this event (can only be called by the caller of `rsvp init`)\n"
+    body += "`rsvp undo`|Undoes the last change to this event, including canceling it (can only be called by the caller of `rsvp init`)\n"
     body += "`rsvp move <destination_url>`|Moves this event to another stream/topic. Requires full URL for the destination (e.g.'https://zulip.com/#narrow/stream/announce/topic/All.20Hands.20Meeting') (can only be called by the caller of `rsvp init`)\n"
     body += "`rsvp summary`|Displays a summary of this event, including the description, and list of attendees.\n"
+    body += "`rsvp summary pin`|Displays a summary that keeps itself up to date as people RSVP. `rsvp summary unpin` stops the updates.\n"
+    body += "`rsvp search TERMS`|Finds events in this stream by their name, description or place, upcoming ones first.\n"
+    body += "`rsvp stats`|Shows turnout, how often people change their minds and the most popular times in this stream.\n"
     body += "`rsvp credits`|Lists all the awesome people that made RSVPBot a reality.\n"
 
     return RSVPCommandResponse(events, RSVPMessage('private', body))
@@ -156,6 +195,7 @@ class RSVPCancelCommand(RSVPEventNeededCommand):
 
 class RSVPMoveCommand(RSVPEventNeededCommand):
   regex = r'move (?P<destination>.+)$'
+  records_history = False
 
   def run(self, events, *args, **kwargs):
     event_id = kwargs.pop('event_id')
@@ -187,21 +227,14 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
         else:
           body = MSG_EVENT_MOVED % (new_event_id, destination)
 
-          old_event = events.pop(event_id)
-
           # need to make sure that there's no duplicate here!
           # also, ideally we'd make sure the stream/topic existed & create it if not.
           # AND send an 'init' notification to that new stream/toipic. Hm. what's the 
           # best way to do that? Allow for a parameterized init? It's always a reply, not a push. 
           # Can we return MULTIPLE messages instead of just one?
 
-          old_event.update({'name': topic})
-
-          events.update(
-            { 
-              new_event_id: old_event
-            }
-          )
+          events.move(event_id, new_event_id)
+          events[new_event_id].update({'name': topic})
 
           success_msg = RSVPMessage('stream', MSG_INIT_SUCCESSFUL, stream, topic)
 
@@ -210,8 +243,35 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
 class LimitReachedException(Exception):
   pass
 
+class RSVPScanMatch(object):
+  """
+  Stands in for a regex match object for commands that parse their input by hand.
+  """
+  def __init__(self, **groups):
+    self.groups = groups
+
+  def groupdict(self):
+    return dict(self.groups)
+
+
 class RSVPConfirmCommand(RSVPEventNeededCommand):
+  """
+  Fuzzy yes/no/maybe detection: the first standalone yes, no or maybe after the
+  prefix is the decision, so `rsvp hell yes` works but `rsvp yesterday` doesn't.
+
+  Instead of a regex, the message is scanned once, word by word, and only its
+  first max_scan_length characters are looked at. When a message contains
+  conflicting decisions (`rsvp yes no`), ambiguous='first' keeps the first one
+  and ambiguous='reject' asks the sender to make up their mind.
+  """
+  # Same notion of a word as the \b the regex used to rely on.
+  word_regex = re.compile(r'[A-Za-z0-9_]+')
+  word_chars = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+  # What the scan looks for, as a regex. Only match() decides, with scan().
   regex = r'.*?\b(?P<decision>(yes|no|maybe))\b'
+  max_scan_length = 1000
+  ambiguous = 'first'
+  ambiguous_choices = ('first', 'reject')
 
   responses = {
     "yes": '@**%s** is attending!',
@@ -219,6 +279,48 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
     "maybe": '@**%s** might be attending. It\'s complicated.',
   }
 
+  def __init__(self, prefix, max_scan_length=None, ambiguous=None):
+    super(RSVPConfirmCommand, self).__init__(prefix)
+    # The start of a message match() compares against, rather than a regex.
+    self.prefix = prefix.lower() + ' '
+    if max_scan_length is not None:
+      self.max_scan_length = max_scan_length
+    if ambiguous is not None:
+      if ambiguous not in self.ambiguous_choices:
+        raise ValueError('ambiguous must be one of %s, not %r' % (', '.join(self.ambiguous_choices), ambiguous))
+      self.ambiguous = ambiguous
+
+  def scan(self, input_str, start):
+    """
+    Returns the decisions found in input_str[start:start + max_scan_length], in order,
+    stopping early once the answer can't change.
+    """
+    end = min(len(input_str), start + self.max_scan_length)
+    decisions = []
+
+    for word in self.word_regex.finditer(input_str, start, end):
+      # A word cut in half by the scan limit is not a word.
+      if word.end() == end and end < len(input_str) and input_str[end] in self.word_chars:
+        break
+
+      decision = word.group().lower()
+      if decision in self.responses and decision not in decisions:
+        decisions.append(decision)
+        if self.ambiguous == 'first' or len(decisions) > 1:
+          break
+
+    return decisions
+
+  def match(self, input_str):
+    if input_str[:len(self.prefix)].lower() != self.prefix:
+      return None
+
+    decisions = self.scan(input_str, len(self.prefix))
+    if not decisions:
+      return None
+
+    return RSVPScanMatch(decision=decisions[0], ambiguous=len(decisions) > 1)
+
   vips = [
     "James A. Keene (W1'14)",
     "Cole Murphy (SP2'15)",
@@ -299,21 +401,23 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
   ]
 
   def confirm(self, event, sender_full_name, decision):
-    # Temporary kludge to add a 'maybe' array to legacy events. Can be removed after 
-    # all currently logged events have passed.
-    if ('maybe' not in event.keys()):
-      event['maybe'] = [];
-
     # If they're in a different response list, take them out of it.
+    previous = None
     for response in self.responses.keys():
       # prevent duplicates if replying multiple times
       if (response == decision): 
         # if they're already in that list, nothing to do
+        # (never append in place: earlier versions of the event share this list)
         if (sender_full_name not in event[response]):
-          event[response].append(sender_full_name)
+          event[response] = event[response] + [sender_full_name]
       # else, remove all instances of them from other response lists.
       elif sender_full_name in event[response]:
         event[response] = [value for value in event[response] if value != sender_full_name]
+        previous = response
+
+    if previous:
+      change = '%s-%s' % (previous, decision)
+      event['changed_minds'] = dict(event['changed_minds'], **{change: event['changed_minds'].get(change, 0) + 1})
 
     return event
 
@@ -331,18 +435,22 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
     event = kwargs.pop('event')
     decision = kwargs.pop('decision').lower()
     sender_full_name = kwargs.pop('sender_full_name')
+    sender_id = kwargs.pop('sender_id', None)
+    schedule = kwargs.pop('schedule', None)
 
     limit = event['limit']
 
     vip_prefix = ''
     vip_postfix = ''
 
-    # TODO: 
-    # if (this.yes_no_ambigous()):
-    #   return RSVPCommandResponse("Yes no yes_no_ambigous", events)
+    if kwargs.pop('ambiguous', False):
+      return RSVPCommandResponse(events, RSVPMessage('stream', ERROR_AMBIGUOUS_DECISION))
 
     try:
       event = self.attempt_confirm(event, sender_full_name, decision, limit)
+      if sender_id is not None and event['user_ids'].get(sender_full_name) != sender_id:
+        # Kept so the event's user group (see user_groups.py) can be synced.
+        event['user_ids'] = dict(event['user_ids'], **{sender_full_name: sender_id})
 
       if sender_full_name in self.vips:
         if decision == 'yes':
@@ -354,11 +462,49 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
       events[event_id] = event
       response_string = self.responses.get(decision) % sender_full_name
       response_string = vip_prefix + response_string + vip_postfix
-      return RSVPCommandResponse(events, RSVPMessage('stream', response_string))
+      aggregate = {'decision': decision, 'name': sender_full_name}
+      messages = [RSVPMessage('stream', response_string, aggregate=aggregate)]
+
+      if decision == 'yes' and schedule:
+        conflicts = schedule.conflicts(sender_full_name, event, exclude=event_id)
+        if conflicts:
+          messages.append(RSVPMessage('stream', MSG_SCHEDULE_CONFLICT % (
+            sender_full_name, ', '.join(describe_event(events, other) for other in conflicts))))
+
+      return RSVPCommandResponse(events, *messages)
 
     except LimitReachedException:
       return RSVPCommandResponse(events, RSVPMessage('stream', ERROR_LIMIT_REACHED))
 
+class RSVPUndoCommand(RSVPCommand):
+  regex = r'undo$'
+  records_history = False
+
+  def run(self, events, *args, **kwargs):
+    event_id = kwargs.pop('event_id')
+    sender_id = kwargs.pop('sender_id')
+    event = kwargs.pop('event')
+
+    if not events.can_undo(event_id):
+      if event:
+        body = ERROR_NOTHING_TO_UNDO
+      else:
+        body = ERROR_NOT_AN_EVENT
+    else:
+      # A canceled event can be brought back by whoever created it.
+      creator = (event or events.last_snapshot(event_id))['creator']
+      if creator == sender_id:
+        events.undo(event_id, keep=schema.BOT_MANAGED_FIELDS)
+        if event is None and event_id in events:
+          # Its user group was deleted along with it, a new one is made.
+          events[event_id]['user_group'] = None
+        body = MSG_UNDONE
+      else:
+        body = ERROR_NOT_AUTHORIZED_TO_UNDO
+
+    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+
+
 class RSVPSetLimitCommand(RSVPEventNeededCommand):
   regex = r'set limit (?P<limit>\d+)$'
 
@@ -394,6 +540,9 @@ class RSVPSetDateCommand(RSVPEventNeededCommand):
 
     if self.validate_future_date(day, month, year):
       event['date'] = str(datetime.date(year, month, day))
+      if event.get('recurrence'):
+        # A monthly series now falls on this day of the month.
+        event['recurrence'] = dict(event['recurrence'], day=day)
       events[event_id] = event
       body = MSG_DATE_SET % (month, day, year)
     else:
@@ -402,6 +551,41 @@ class RSVPSetDateCommand(RSVPEventNeededCommand):
     return RSVPCommandResponse(events, RSVPMessage('stream', body))
 
 
+class RSVPRepeatCommand(RSVPEventNeededCommand):
+  regex = r'repeat (?P<frequency>daily|weekly|monthly|never)( until (?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4}))?$'
+
+  def run(self, events, *args, **kwargs):
+    event = kwargs.pop('event')
+    event_id = kwargs.pop('event_id')
+    frequency = kwargs.pop('frequency').lower()
+
+    if frequency == 'never':
+      event['recurrence'] = None
+      events[event_id] = event
+      return RSVPCommandResponse(events, RSVPMessage('stream', MSG_REPEAT_OFF))
+
+    if not event['date']:
+      return RSVPCommandResponse(events, RSVPMessage('stream', ERROR_REPEAT_NEEDS_DATE))
+
+    until = None
+    if kwargs.get('year'):
+      day, month, year = int(kwargs.pop('day')), int(kwargs.pop('month')), int(kwargs.pop('year'))
+      try:
+        until = datetime.date(year, month, day)
+      except ValueError:
+        pass
+      if until is None or until < recurrence.parse_date(event['date']):
+        return RSVPCommandResponse(events, RSVPMessage('stream', ERROR_DATE_NOT_VALID % (month, day, year)))
+
+    event['recurrence'] = {
+      'frequency': frequency,
+      'day': recurrence.parse_date(event['date']).day,
+      'until': str(until) if until else None,
+    }
+    events[event_id] = event
+    return RSVPCommandResponse(events, RSVPMessage('stream', MSG_REPEAT_SET % recurrence.describe(event['recurrence'])))
+
+
 class RSVPSetTimeCommand(RSVPEventNeededCommand):
   regex = r'set time (?P<hours>\d{1,2})\:(?P<minutes>\d{1,2})$'
 
@@ -420,6 +604,24 @@ class RSVPSetTimeCommand(RSVPEventNeededCommand):
       
     return RSVPCommandResponse(events, RSVPMessage('stream', body))
 
+class RSVPSetDurationCommand(RSVPEventNeededCommand):
+  regex = r'set duration (?P<hours>\d{1,2})\:(?P<minutes>\d{2})$'
+
+  def run(self, events, *args, **kwargs):
+    event = kwargs.pop('event')
+    event_id = kwargs.pop('event_id')
+    hours, minutes = int(kwargs.pop('hours')), int(kwargs.pop('minutes'))
+
+    if minutes < 60 and (hours or minutes):
+      event['duration'] = hours * 60 + minutes
+      events[event_id] = event
+      body = MSG_DURATION_SET % (hours, minutes)
+    else:
+      body = ERROR_DURATION_NOT_VALID % (hours, minutes)
+
+    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+
+
 class RSVPSetTimeAllDayCommand(RSVPEventNeededCommand):
   regex = r'set time allday$'
 
@@ -444,6 +646,7 @@ class RSVPSetStringAttributeCommand(RSVPEventNeededCommand):
 
 class RSVPPingCommand(RSVPEventNeededCommand):
   regex = r'^({key_word} ping)$|({key_word} ping (?P<message>.+))$'
+  mutates = False
 
   def __init__(self, prefix, *args, **kwargs):
     self.regex = self.regex.format(key_word=prefix)
@@ -454,11 +657,17 @@ class RSVPPingCommand(RSVPEventNeededCommand):
 
     body = "**Pinging all participants who RSVP'd!!**\n"
 
-    for participant in event['yes']:
-      body += "@**%s** " % participant
-
-    for participant in event['maybe']:
-      body += "@**%s** " % participant
+    participants = event['yes'] + event['maybe']
+    group = event.get('user_group')
+    if group:
+      # One group mention instead of one per person. Only those who RSVP'd
+      # since the group was last synced still need mentioning by name.
+      synced = set(group['members'])
+      mentions = ['@*%s*' % group['name']]
+      mentions += ['@**%s**' % participant for participant in participants if participant not in synced]
+    else:
+      mentions = ['@**%s**' % participant for participant in participants]
+    body += ''.join(mention + ' ' for mention in mentions)
 
     if message:
       body += ('\n' + message)
@@ -466,8 +675,62 @@ class RSVPPingCommand(RSVPEventNeededCommand):
     return RSVPCommandResponse(events, RSVPMessage('stream', body))
 
 
+class RSVPSearchCommand(RSVPCommand):
+  regex = r'search (?P<terms>.+)$'
+  mutates = False
+  limit = 10
+
+  def run(self, events, *args, **kwargs):
+    terms = kwargs.pop('terms')
+    index = kwargs.pop('search', None)
+    if index is None:
+      index = search.SearchIndex(events)
+
+    # Only this stream's events: the bot may be in private streams the
+    # sender can't see.
+    stream = events.split_id(kwargs.pop('event_id'))[0]
+    found = index.search(terms, self.limit, stream=stream)
+    if not found:
+      return RSVPCommandResponse(events, RSVPMessage('stream', MSG_NO_SEARCH_RESULTS % terms))
+
+    body = MSG_SEARCH_RESULTS % terms
+    for event_id in found:
+      body += '\n* %s %s' % (describe_event(events, event_id), events[event_id]['date'] or '')
+    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+
+
+class RSVPStatsCommand(RSVPCommand):
+  regex = r'stats$'
+  mutates = False
+
+  @staticmethod
+  def render(stream, report, person):
+    body = '**Stats for** #**%s**\n' % stream
+    body += '\t|\t\n:---:|:---:\n'
+    body += '**Events**|%d\n' % report['events']
+    body += '**Turnout**|%.1f yes, %.1f maybe per event\n' % (report['average_yes'], report['average_maybe'])
+    body += '**Yes then no**|%.0f%%\n' % (report['yes_to_no_rate'] * 100)
+    if report['popular_slots']:
+      body += '**Popular times**|%s\n' % ', '.join(
+        '%s (%d yes)' % (stats.describe_slot(slot), yes) for slot, yes, _ in report['popular_slots'])
+    body += '**Your RSVPs**|%d yes, %d no, %d maybe\n' % (person['yes'], person['no'], person['maybe'])
+    return body
+
+  def run(self, events, *args, **kwargs):
+    event_id = kwargs.pop('event_id')
+    name = kwargs.pop('sender_full_name')
+    counters = kwargs.pop('stats', None)
+    if counters is None:
+      counters = stats.AttendanceStats(events)
+
+    stream = events.split_id(event_id)[0]
+    body = self.render(stream, counters.stream_report(stream), counters.person_report(name))
+    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+
+
 class RSVPCreditsCommand(RSVPEventNeededCommand):
   regex = r'credits$'
+  mutates = False
 
   def run(self, events, *args, **kwargs):
 
@@ -500,10 +763,10 @@ class RSVPCreditsCommand(RSVPEventNeededCommand):
 
 class RSVPSummaryCommand(RSVPEventNeededCommand):
   regex = r'(summary$|status$)'
+  mutates = False
 
-  def run(self, events, *args, **kwargs):
-    event = kwargs.pop('event')
-
+  @staticmethod
+  def summary(event):
     limit_str = 'No Limit!'
 
     if event['limit']:
@@ -518,6 +781,8 @@ class RSVPSummaryCommand(RSVPEventNeededCommand):
       event['place'] or 'N/A',
       limit_str
     )
+    if event.get('recurrence'):
+      summary_table += '**Repeats**|%s\n' % recurrence.describe(event['recurrence'])
 
     confirmation_table = 'YES ({}) |NO ({}) |MAYBE({}) \n:---:|:---:|:---:\n'
 
@@ -534,6 +799,30 @@ class RSVPSummaryCommand(RSVPEventNeededCommand):
     else:
       confirmation_table += '\t|\t'
 
-    body = summary_table + '\n\n' + confirmation_table
-    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+    return summary_table + '\n\n' + confirmation_table
 
+  def run(self, events, *args, **kwargs):
+    event = kwargs.pop('event')
+    return RSVPCommandResponse(events, RSVPMessage('stream', self.summary(event)))
+
+
+class RSVPPinSummaryCommand(RSVPEventNeededCommand):
+  """
+  `rsvp summary pin` posts a summary that the bot keeps editing as people
+  RSVP, instead of everyone asking for a fresh one. `rsvp summary unpin`
+  stops the edits.
+  """
+  regex = r'(summary|status) (?P<pin>pin|unpin)$'
+
+  def run(self, events, *args, **kwargs):
+    event_id = kwargs.pop('event_id')
+    event = kwargs.pop('event')
+    pin = kwargs.pop('pin').lower() == 'pin'
+
+    event['pinned_summary'] = pin
+
+    if pin:
+      message = RSVPMessage('stream', RSVPSummaryCommand.summary(event), pin=event_id)
+    else:
+      message = RSVPMessage('stream', MSG_SUMMARY_UNPINNED)
+    return RSVPCommandResponse(events, message)
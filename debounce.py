@@ -0,0 +1,115 @@
+from __future__ import with_statement
+import threading
+import time
+
+"""
+
+Coalesces bursts of work: touching a key schedules callback(key) to run
+`window` seconds later, and touching it again in the meantime doesn't
+schedule anything new. Under a steady stream of touches each key fires at
+most once per window.
+
+"""
+
+class Debouncer(object):
+
+  def __init__(self, window, callback, clock=time.time):
+    self.window = window
+    self.callback = callback
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.thread = None
+    self.stopping = threading.Event()
+
+  def touch(self, key):
+    with self.lock:
+      if key not in self.pending:
+        self.pending[key] = self.clock() + self.window
+
+  def run_due(self, now=None):
+    """
+    Calls the callback for every key whose window is over. Returns how many there were.
+    """
+    if now is None:
+      now = self.clock()
+    with self.lock:
+      due = [key for key, deadline in self.pending.items() if deadline <= now]
+      for key in due:
+        del self.pending[key]
+
+    for key in due:
+      self.callback(key)
+    return len(due)
+
+  def flush(self):
+    """
+    Calls the callback for every pending key right away.
+    """
+    return self.run_due(now=float('inf'))
+
+  def start(self, interval=None):
+    """
+    Runs due callbacks from a background thread, checking every `interval`
+    seconds (a quarter of the window by default).
+    """
+    interval = interval or max(self.window / 4.0, 0.01)
+
+    def loop():
+      while not self.stopping.wait(interval):
+        self.run_due()
+
+    self.thread = threading.Thread(target=loop)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops the background thread, if there is one. Keys still pending stay
+    pending; flush() them first to have them run.
+    """
+    self.stopping.set()
+    if self.thread is not None:
+      self.thread.join(timeout)
+
+
+class Scheduler(object):
+  """
+  Runs due callbacks for any number of debouncers from a single thread, so
+  bots sharing a process (see realms.py) don't need a thread per debouncer.
+  """
+
+  def __init__(self, interval=0.25):
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.debouncers = []
+    self.thread = None
+    self.stopping = threading.Event()
+
+  def add(self, debouncer):
+    with self.lock:
+      self.debouncers.append(debouncer)
+      # Check often enough for the shortest window.
+      self.interval = min(self.interval, max(debouncer.window / 4.0, 0.01))
+    return debouncer
+
+  def run_due(self):
+    with self.lock:
+      debouncers = list(self.debouncers)
+    return sum(debouncer.run_due() for debouncer in debouncers)
+
+  def start(self):
+    def loop():
+      while not self.stopping.wait(self.interval):
+        self.run_due()
+
+    self.thread = threading.Thread(target=loop)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=5):
+    self.stopping.set()
+    if self.thread is not None:
+      self.thread.join(timeout)
@@ -0,0 +1,426 @@
+from __future__ import with_statement
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+"""
+
+A local stand-in for the parts of the Zulip API that bot.py talks to.
+
+It understands stream listing, subscriptions, event queue registration and
+long polling, sending/updating messages and user groups. Tests and the load driver inject
+incoming messages with inject_message() and inspect what the bot sent through
+the `sent` list. Latency, 5xx errors and 429 rate limiting can be injected on
+every request so we can see how the bot behaves when Zulip is having a bad day,
+and so can replies lost after the request was handled, like a timed out
+gateway in front of a server that did the work.
+
+"""
+
+class FakeZulipState(object):
+  """
+  Everything the fake server knows about: streams, subscriptions, event queues
+  and the messages the bot has sent. Shared between request handler threads.
+  """
+
+  def __init__(self, streams=None):
+    self.lock = threading.Condition()
+    self.streams = [
+      {'name': name, 'stream_id': idx + 1, 'description': ''}
+      for idx, name in enumerate(streams or [])
+    ]
+    self.subscriptions = []
+    self.subscribe_calls = []
+    self.queues = {}
+    self.events = []
+    self.next_event_id = 0
+    self.next_message_id = 1
+    self.sent = []
+    self.edits = []
+    self.user_groups = {}
+    self.next_group_id = 1
+    self.group_calls = []
+
+  def register(self):
+    with self.lock:
+      queue_id = 'fake-queue-%d' % (len(self.queues) + 1)
+      self.queues[queue_id] = self.next_event_id - 1
+      return queue_id, self.next_event_id - 1
+
+  def inject_message(self, content, sender_full_name='Tester', sender_email='tester@example.com',
+      sender_id=12345, stream='test-stream', subject='Testing', message_type='stream'):
+    """
+    Push a message into every registered event queue, as if a user had just sent it.
+    """
+    with self.lock:
+      message_id = self.next_message_id
+      self.next_message_id += 1
+      message = {
+        'id': message_id,
+        'content': content,
+        'sender_full_name': sender_full_name,
+        'sender_email': sender_email,
+        'sender_id': sender_id,
+        'subject': subject,
+        'display_recipient': stream,
+        'type': message_type,
+        'timestamp': time.time(),
+      }
+      self.inject_event({'type': 'message', 'message': message})
+      return message
+
+  def inject_event(self, event):
+    """
+    Push any other kind of event (e.g. a stream rename) into every registered event queue.
+    """
+    with self.lock:
+      event = dict(event, id=self.next_event_id)
+      self.events.append(event)
+      self.next_event_id += 1
+      self.lock.notify_all()
+      return event
+
+  def get_events(self, last_event_id, timeout):
+    deadline = time.time() + timeout
+    with self.lock:
+      while True:
+        pending = self.events[last_event_id + 1:]
+        if pending:
+          return pending
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return [{'type': 'heartbeat', 'id': last_event_id}]
+        self.lock.wait(remaining)
+
+  def record_sent(self, params):
+    with self.lock:
+      message_id = self.next_message_id
+      self.next_message_id += 1
+      sent = dict(params)
+      sent['id'] = message_id
+      sent['received_at'] = time.time()
+      self.sent.append(sent)
+      self.lock.notify_all()
+      return message_id
+
+  def record_edit(self, params):
+    with self.lock:
+      edit = dict(params)
+      edit['received_at'] = time.time()
+      self.edits.append(edit)
+      self.lock.notify_all()
+
+  def create_group(self, name, description, members):
+    with self.lock:
+      if any(group['name'] == name for group in self.user_groups.values()):
+        return None
+      group_id = self.next_group_id
+      self.next_group_id += 1
+      self.user_groups[group_id] = {
+        'id': group_id,
+        'name': name,
+        'description': description,
+        'members': sorted(set(members)),
+      }
+      self.group_calls.append(('create', group_id))
+      return group_id
+
+  def update_group(self, group_id, add, delete):
+    with self.lock:
+      group = self.user_groups.get(group_id)
+      if group is None:
+        return False
+      group['members'] = sorted((set(group['members']) | set(add)) - set(delete))
+      self.group_calls.append(('members', group_id))
+      return True
+
+  def delete_group(self, group_id):
+    with self.lock:
+      if self.user_groups.pop(group_id, None) is None:
+        return False
+      self.group_calls.append(('delete', group_id))
+      return True
+
+  def wait_for_sent(self, count, timeout=5):
+    """
+    Block until at least `count` messages have been sent, or the timeout expires.
+    Returns the number of messages sent so far.
+    """
+    deadline = time.time() + timeout
+    with self.lock:
+      while len(self.sent) < count:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.lock.wait(remaining)
+      return len(self.sent)
+
+
+class FakeZulipHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    # Keep test and load test output clean.
+    pass
+
+  def do_GET(self):
+    self.dispatch('GET')
+
+  def do_POST(self):
+    self.dispatch('POST')
+
+  def do_PATCH(self):
+    self.dispatch('PATCH')
+
+  def do_DELETE(self):
+    self.dispatch('DELETE')
+
+  def read_params(self):
+    parsed = urlparse.urlparse(self.path)
+    params = dict(urlparse.parse_qsl(parsed.query))
+    length = int(self.headers.getheader('content-length') or 0)
+    if length:
+      params.update(urlparse.parse_qsl(self.rfile.read(length)))
+    return parsed.path, params
+
+  def reply(self, status, payload, headers=None):
+    body = json.dumps(payload)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def dispatch(self, method):
+    server = self.server
+    path, params = self.read_params()
+    server.request_count += 1
+
+    if server.latency:
+      time.sleep(server.latency)
+
+    if path.startswith('/api/'):
+      path = path[len('/api'):]
+
+    if server.should_inject(path):
+      fault = server.pick_fault()
+      if fault == 429:
+        server.rate_limited_count += 1
+        return self.reply(429, {
+          'result': 'error',
+          'code': 'RATE_LIMIT_HIT',
+          'msg': 'API usage exceeded rate limit',
+          'retry-after': server.retry_after,
+        }, {'Retry-After': str(server.retry_after)})
+      if fault == 500:
+        server.error_count += 1
+        return self.reply(500, {'result': 'error', 'msg': 'Injected server error'})
+
+    route = server.routes.get((method, path))
+    if route is None:
+      # Endpoints with an id in the path, e.g. PATCH /v1/messages/<id>.
+      for route_method, pattern, handler in server.pattern_routes:
+        match = pattern.match(path)
+        if route_method == method and match:
+          for key, value in match.groupdict().items():
+            params.setdefault(key, value)
+          route = handler
+          break
+
+    if route is None:
+      return self.reply(404, {'result': 'error', 'msg': 'Unknown endpoint %s %s' % (method, path)})
+
+    status, payload = route(server.state, params)
+    if server.should_inject(path) and server.random.random() < server.lost_reply_rate:
+      server.lost_reply_count += 1
+      body = '<html>504 Gateway Time-out</html>'
+      self.send_response(504)
+      self.send_header('Content-Type', 'text/html')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+    self.reply(status, payload)
+
+
+def _get_streams(state, params):
+  return 200, {'result': 'success', 'streams': state.streams}
+
+def _add_subscriptions(state, params):
+  subscriptions = json.loads(params.get('subscriptions', '[]'))
+  names = [subscription['name'] for subscription in subscriptions]
+  if state.per_stream_latency:
+    # Real servers take longer the more streams a single request touches.
+    time.sleep(state.per_stream_latency * len(names))
+  with state.lock:
+    state.subscribe_calls.append(names)
+    new = [name for name in names if name not in state.subscriptions]
+    state.subscriptions.extend(new)
+  return 200, {'result': 'success', 'subscribed': {}, 'already_subscribed': {}}
+
+def _list_subscriptions(state, params):
+  with state.lock:
+    subscriptions = [{'name': name} for name in state.subscriptions]
+  return 200, {'result': 'success', 'subscriptions': subscriptions}
+
+def _register(state, params):
+  queue_id, last_event_id = state.register()
+  return 200, {'result': 'success', 'queue_id': queue_id, 'last_event_id': last_event_id}
+
+def _get_events(state, params):
+  queue_id = params.get('queue_id')
+  if queue_id not in state.queues:
+    return 400, {'result': 'error', 'msg': 'Bad event queue id: %s' % queue_id}
+  last_event_id = int(params.get('last_event_id', -1))
+  events = state.get_events(last_event_id, state.poll_timeout)
+  return 200, {'result': 'success', 'events': events}
+
+def _send_message(state, params):
+  message_id = state.record_sent(params)
+  return 200, {'result': 'success', 'id': message_id}
+
+def _update_message(state, params):
+  state.record_edit(params)
+  return 200, {'result': 'success'}
+
+def _get_messages(state, params):
+  # Only the bot's own messages, newest last, narrowed by stream and topic or
+  # by private message recipient.
+  narrow = dict((operator, operand) for operator, operand in json.loads(params.get('narrow', '[]')))
+  with state.lock:
+    messages = []
+    for sent in state.sent:
+      if 'pm-with' in narrow and (sent['type'] != 'private' or sent['to'] != narrow['pm-with']):
+        continue
+      if 'stream' in narrow and (sent['type'] != 'stream' or sent['to'] != narrow['stream']):
+        continue
+      if 'topic' in narrow and sent.get('subject') != narrow['topic']:
+        continue
+      messages.append({'id': sent['id'], 'content': sent['content'], 'subject': sent.get('subject'),
+                       'timestamp': int(sent['received_at'])})
+  return 200, {'result': 'success', 'messages': messages[-int(params.get('num_before', 100)):]}
+
+def _get_user_groups(state, params):
+  with state.lock:
+    groups = [dict(group) for _, group in sorted(state.user_groups.items())]
+  return 200, {'result': 'success', 'user_groups': groups}
+
+def _create_user_group(state, params):
+  # Like older Zulip servers, this doesn't say what id the new group got.
+  name = params.get('name')
+  members = json.loads(params.get('members', '[]'))
+  if state.create_group(name, params.get('description', ''), members) is None:
+    return 400, {'result': 'error', 'msg': "User group '%s' already exists." % name}
+  return 200, {'result': 'success'}
+
+def _update_user_group_members(state, params):
+  add = json.loads(params.get('add', '[]'))
+  delete = json.loads(params.get('delete', '[]'))
+  if not state.update_group(int(params['group_id']), add, delete):
+    return 400, {'result': 'error', 'msg': 'Invalid user group'}
+  return 200, {'result': 'success'}
+
+def _delete_user_group(state, params):
+  if not state.delete_group(int(params['group_id'])):
+    return 400, {'result': 'error', 'msg': 'Invalid user group'}
+  return 200, {'result': 'success'}
+
+
+class FakeZulipServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  A threaded HTTP server speaking enough of the Zulip API for bot.py.
+
+  latency is added to every request (in seconds), per_stream_latency is added
+  to subscription requests for every stream they contain. error_rate and
+  rate_limit_rate are the probabilities for a request to be answered with a
+  500 or a 429 respectively. lost_reply_rate is the probability for a handled
+  request to be answered with a 504 page instead of its result. fault_paths
+  restricts the fault injection to the given API paths (e.g. ['/v1/messages']);
+  by default every endpoint can fail.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, host='127.0.0.1', port=0, streams=None, latency=0, error_rate=0,
+      rate_limit_rate=0, retry_after=1, fault_paths=None, poll_timeout=1, per_stream_latency=0, seed=None,
+      lost_reply_rate=0):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeZulipHandler)
+    self.state = FakeZulipState(streams)
+    self.state.poll_timeout = poll_timeout
+    self.state.per_stream_latency = per_stream_latency
+    self.latency = latency
+    self.error_rate = error_rate
+    self.rate_limit_rate = rate_limit_rate
+    self.lost_reply_rate = lost_reply_rate
+    self.retry_after = retry_after
+    self.fault_paths = fault_paths
+    self.random = random.Random(seed)
+    self.request_count = 0
+    self.error_count = 0
+    self.rate_limited_count = 0
+    self.lost_reply_count = 0
+    self.thread = None
+    self.routes = {
+      ('GET', '/v1/streams'): _get_streams,
+      ('POST', '/v1/users/me/subscriptions'): _add_subscriptions,
+      ('GET', '/v1/users/me/subscriptions'): _list_subscriptions,
+      ('POST', '/v1/register'): _register,
+      ('GET', '/v1/events'): _get_events,
+      ('POST', '/v1/messages'): _send_message,
+      ('GET', '/v1/messages'): _get_messages,
+      ('PATCH', '/v1/messages'): _update_message,
+      ('GET', '/v1/user_groups'): _get_user_groups,
+      ('POST', '/v1/user_groups/create'): _create_user_group,
+    }
+    self.pattern_routes = [
+      ('PATCH', re.compile(r'^/v1/messages/(?P<message_id>\d+)$'), _update_message),
+      ('POST', re.compile(r'^/v1/user_groups/(?P<group_id>\d+)/members$'), _update_user_group_members),
+      ('DELETE', re.compile(r'^/v1/user_groups/(?P<group_id>\d+)$'), _delete_user_group),
+    ]
+
+  @property
+  def url(self):
+    return 'http://%s:%d' % self.server_address
+
+  @property
+  def sent(self):
+    return self.state.sent
+
+  def inject_message(self, content, **kwargs):
+    return self.state.inject_message(content, **kwargs)
+
+  def inject_event(self, event):
+    return self.state.inject_event(event)
+
+  def should_inject(self, path):
+    if not (self.error_rate or self.rate_limit_rate or self.lost_reply_rate):
+      return False
+    return self.fault_paths is None or path in self.fault_paths
+
+  def pick_fault(self):
+    roll = self.random.random()
+    if roll < self.rate_limit_rate:
+      return 429
+    if roll < self.rate_limit_rate + self.error_rate:
+      return 500
+    return None
+
+  def start(self):
+    """
+    Serve requests from a background thread. Returns self so it can be chained.
+    """
+    self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
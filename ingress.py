@@ -0,0 +1,288 @@
+from __future__ import with_statement
+import collections
+import threading
+import time
+import traceback
+import Queue
+
+"""
+
+A bounded queue between the Zulip event stream and the code that handles it.
+
+The bot reads every message on every stream it is subscribed to, and only a
+few of them are meant for it. Incoming events are classified with a cheap
+look at the start of a message:
+
+  CHATTER    doesn't start with the key word. Never gets a reply, so it is
+             dropped before it takes up a slot at all.
+  READ_ONLY  `rsvp help`, `rsvp credits`, `rsvp summary`... Answering them
+             again later changes nothing, so they are the first to go when
+             the queue is full, and the same one already waiting in a thread
+             makes a second one redundant.
+  COMMAND    everything else, including renames. When the queue is full of
+             them, put() waits up to put_timeout seconds for room, then drops
+             the command and calls on_drop(message) so whoever sent it can be
+             told to try again. put() runs on the thread reading from Zulip,
+             which has to keep polling or the event queue expires, so it never
+             waits for longer than that. Events that aren't messages (renames,
+             reloads) are rare and nobody could be told they were lost, so
+             they are queued even past maxsize.
+
+Once the queue is `overload_ratio` full it counts as overloaded until it
+drains below half of that again. on_overload(message) is called for each
+command queued while overloaded, e.g. to tell people the bot is busy.
+
+A queue is either drained by a thread of its own (start) or by a WorkerPool
+shared with other queues (attach), which still handles each queue's events
+one at a time and in order.
+
+"""
+
+CHATTER, READ_ONLY, COMMAND = range(3)
+
+# Not `rsvp stats`: its answer depends on who asks, so a second one in a
+# thread isn't redundant.
+READ_ONLY_COMMANDS = frozenset(['help', 'credits', 'summary', 'status'])
+
+
+def classify(event, key_word):
+  if event.get('type') != 'message':
+    return COMMAND
+
+  content = event['message']['content'].lstrip().lower()
+  # Same test as RSVP.route: anything starting with the key word gets an answer.
+  if not content.startswith(key_word):
+    return CHATTER
+  words = content.split(None, 2)
+  if len(words) == 2 and words[0] == key_word and words[1] in READ_ONLY_COMMANDS:
+    return READ_ONLY
+  return COMMAND
+
+
+def thread_of(event):
+  message = event['message']
+  if message['type'] == 'private':
+    return ('private', message['sender_email'])
+  return (message['display_recipient'], message['subject'])
+
+
+class IngressQueue(object):
+
+  def __init__(self, key_word, maxsize=1000, overload_ratio=0.8, on_overload=None,
+               put_timeout=1, on_drop=None):
+    self.key_word = key_word.lower()
+    self.maxsize = maxsize
+    self.overload_at = max(int(maxsize * overload_ratio), 1)
+    self.on_overload = on_overload
+    self.put_timeout = put_timeout
+    self.on_drop = on_drop
+    self.items = collections.deque()
+    self.condition = threading.Condition()
+    self.overloaded = False
+    self.stats = collections.Counter()
+    self.pool = None
+    self.handler = None
+    # Whether the pool has this queue lined up or a worker is on it.
+    self.scheduled = False
+    self.thread = None
+    self.stopped = False
+
+  def __len__(self):
+    return len(self.items)
+
+  def shed_read_only(self):
+    """
+    Drops the oldest queued read-only command. Returns False if there isn't one.
+    """
+    for item in self.items:
+      if item[0] == READ_ONLY:
+        self.items.remove(item)
+        self.stats['shed_read_only'] += 1
+        return True
+    return False
+
+  def room_for_command(self, timeout):
+    """
+    Waits up to timeout seconds for a free slot. The caller holds the condition.
+    """
+    deadline = time.time() + timeout
+    while len(self.items) >= self.maxsize and not self.stopped and not self.shed_read_only():
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      self.stats['waited'] += 1
+      self.condition.wait(remaining)
+    return True
+
+  def put(self, event):
+    """
+    Queues event unless it is shed, deduplicated or dropped. Returns whether it was queued.
+    """
+    kind = classify(event, self.key_word)
+    is_message = event.get('type') == 'message'
+    overloaded = dropped = False
+    with self.condition:
+      self.stats['received'] += 1
+      if kind == CHATTER:
+        self.stats['shed_chatter'] += 1
+        return False
+
+      if kind == READ_ONLY:
+        # The same question asked twice in a thread only needs one answer.
+        thread = thread_of(event) + (event['message']['content'].split()[1].lower(),)
+        if any(item[0] == READ_ONLY and item[2] == thread for item in self.items):
+          self.stats['deduplicated'] += 1
+          return False
+        if len(self.items) >= self.maxsize:
+          self.stats['shed_read_only'] += 1
+          return False
+        self.items.append((kind, event, thread))
+      elif is_message and not self.room_for_command(self.put_timeout):
+        self.stats['dropped_commands'] += 1
+        dropped = True
+      else:
+        self.items.append((kind, event, None))
+
+      if not dropped:
+        self.stats['high_watermark'] = max(self.stats['high_watermark'], len(self.items))
+        if len(self.items) >= self.overload_at:
+          if not self.overloaded:
+            self.stats['overloads'] += 1
+          self.overloaded = True
+        overloaded = self.overloaded and kind == COMMAND and is_message
+        self.condition.notify_all()
+        if self.pool and not self.scheduled:
+          self.scheduled = True
+          self.pool.ready.put(self)
+
+    # Outside the lock: telling people may mean a slow call to Zulip.
+    if dropped:
+      if self.on_drop:
+        self.on_drop(event['message'])
+      return False
+    if overloaded and self.on_overload:
+      self.on_overload(event['message'])
+    return True
+
+  def take(self):
+    # The caller holds the condition and has made sure there is an item.
+    _, event, _ = self.items.popleft()
+    if self.overloaded and len(self.items) < self.overload_at // 2:
+      self.overloaded = False
+    self.condition.notify_all()
+    return event
+
+  def get(self):
+    """
+    Blocks until there is something to handle and returns it, or None once
+    the queue is stopped.
+    """
+    with self.condition:
+      while not self.items and not self.stopped:
+        self.condition.wait()
+      if self.stopped:
+        return None
+      return self.take()
+
+  def serve(self, handler):
+    """
+    Calls handler(event) on everything put in the queue, until it is stopped.
+    """
+    while True:
+      event = self.get()
+      if event is None:
+        return
+      handle(handler, event)
+
+  def start(self, handler):
+    self.thread = threading.Thread(target=self.serve, args=(handler,))
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops handling events, leaving whatever is still queued unhandled, and
+    waits for the event being handled to finish.
+    """
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    if self.thread is not None:
+      self.thread.join(timeout)
+
+  def attach(self, pool, handler):
+    """
+    Has pool's workers call handler(event) on everything put in the queue.
+    """
+    with self.condition:
+      self.pool = pool
+      self.handler = handler
+      if self.items and not self.scheduled:
+        self.scheduled = True
+        pool.ready.put(self)
+    return self
+
+  def handle_next(self):
+    """
+    Handles one event for the pool, then lines the queue up again if there
+    is more to do.
+    """
+    with self.condition:
+      if not self.items or self.stopped:
+        self.scheduled = False
+        return
+      event = self.take()
+    handle(self.handler, event)
+    with self.condition:
+      if self.items:
+        self.pool.ready.put(self)
+      else:
+        self.scheduled = False
+
+
+def handle(handler, event):
+  # One bad event doesn't stop the ones behind it.
+  try:
+    handler(event)
+  except Exception:
+    traceback.print_exc()
+
+
+class WorkerPool(object):
+  """
+  `size` threads taking turns on any number of IngressQueues. Each queue is
+  only ever worked on by one thread at a time, so its events stay in order,
+  and a queue goes to the back of the line after every event so a busy one
+  can't starve the others.
+  """
+
+  def __init__(self, size=4):
+    self.size = size
+    self.ready = Queue.Queue()
+    self.threads = []
+
+  def work(self):
+    while True:
+      queue = self.ready.get()
+      if queue is None:
+        return
+      queue.handle_next()
+
+  def start(self):
+    for _ in range(self.size):
+      thread = threading.Thread(target=self.work)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops every worker once it is done with the event in hand.
+    """
+    for _ in self.threads:
+      self.ready.put(None)
+    for thread in self.threads:
+      thread.join(timeout)
+    self.threads = []
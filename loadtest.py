@@ -0,0 +1,316 @@
+from __future__ import with_statement
+import argparse
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import bot
+import realms
+import util
+from fake_zulip import FakeZulipServer
+
+"""
+
+End-to-end load driver: runs a real bot.bot against a local FakeZulipServer,
+pushes `rsvp yes` messages into its event queue at a fixed rate and measures
+how long each reply takes to come back through send_message.
+
+  python loadtest.py --count 5000 --rate 2000 --latency 0.01 --rate-limit-rate 0.05
+
+With --ack-window the bot merges acknowledgements (see aggregate.py); compare
+sent_messages with and without it.
+
+With --startup it instead measures time-to-first-reply of a freshly started bot
+in a realm with many streams, and with --realms N the memory it takes to host
+N bots in one process (see realms.py).
+
+"""
+
+LOAD_STREAM = 'load-test'
+SENDER_PATTERN = re.compile(r'@\*\*(load-user-\d+)\*\*')
+
+
+def wait_for(predicate, timeout=10, interval=0.01):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if predicate():
+      return True
+    time.sleep(interval)
+  return predicate()
+
+
+def start_bot(server, workdir, wait_for_subscriptions=False, **kwargs):
+  """
+  Builds a bot pointed at the fake server and runs its main loop in a daemon thread.
+  Returns once the bot has registered its event queue. With wait_for_subscriptions
+  the main loop only starts once every stream is subscribed, like bot.py used to.
+  """
+  load_bot = bot.bot(
+    'load-bot@example.com', 'fake-api-key', 'rsvp',
+    zulip_site=server.url,
+    filename=os.path.join(workdir, 'events.json'),
+    subscriptions_filename=os.path.join(workdir, 'subscriptions.json'),
+    **kwargs
+  )
+  if wait_for_subscriptions:
+    load_bot.subscriptions.join()
+
+  thread = threading.Thread(target=load_bot.main)
+  thread.daemon = True
+  thread.start()
+
+  if not wait_for(lambda: server.state.queues):
+    raise RuntimeError('The bot never registered an event queue with the fake server.')
+  return load_bot
+
+
+def run_load(count=1000, rate=1000, topics=10, latency=0, error_rate=0, rate_limit_rate=0,
+    reply_timeout=30, ack_window=0, bot_factory=start_bot):
+  """
+  Pushes `count` RSVPs at `rate` messages per second, spread over `topics` events,
+  and returns a dict describing reply latency and send throughput.
+  """
+  workdir = tempfile.mkdtemp(prefix='rsvp-load-')
+  server = FakeZulipServer(
+    streams=[LOAD_STREAM],
+    latency=latency,
+    error_rate=error_rate,
+    rate_limit_rate=rate_limit_rate,
+    fault_paths=['/v1/messages'],
+  ).start()
+
+  load_bot = None
+  try:
+    load_bot = bot_factory(server, workdir, ack_window=ack_window)
+
+    for topic in range(topics):
+      server.inject_message('rsvp init', stream=LOAD_STREAM, subject='load-topic-%d' % topic)
+    server.state.wait_for_sent(topics, timeout=reply_timeout)
+    baseline = len(server.sent)
+
+    injected_at = {}
+    started = time.time()
+    for idx in range(count):
+      # Pace ourselves against the wall clock rather than sleeping a fixed
+      # amount per message, so slow injections don't lower the rate further.
+      due = started + float(idx) / rate
+      delay = due - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+      sender = 'load-user-%d' % idx
+      injected_at[sender] = time.time()
+      server.inject_message(
+        'rsvp yes',
+        sender_full_name=sender,
+        sender_id=idx,
+        stream=LOAD_STREAM,
+        subject='load-topic-%d' % (idx % topics),
+      )
+    injection_seconds = time.time() - started
+
+    if ack_window:
+      # Merged replies mean fewer messages than RSVPs, so wait until the bot goes quiet.
+      deadline = time.time() + reply_timeout
+      seen = -1
+      while seen != len(server.sent) and time.time() < deadline:
+        seen = len(server.sent)
+        time.sleep(ack_window * 2)
+    else:
+      server.state.wait_for_sent(baseline + count, timeout=reply_timeout)
+
+    latencies = []
+    received = []
+    for message in server.sent[baseline:]:
+      # A merged reply names a few of the people it acknowledges.
+      for sender in SENDER_PATTERN.findall(message.get('content', '')):
+        if sender in injected_at:
+          latencies.append(message['received_at'] - injected_at[sender])
+          received.append(message['received_at'])
+
+    send_seconds = (max(received) - started) if received else 0
+
+    report = {
+      'injected': count,
+      'ack_window': ack_window,
+      'injected_per_second': count / injection_seconds if injection_seconds else None,
+      'replies': len(latencies),
+      'sent_messages': len(server.sent) - baseline,
+      'send_per_second': len(received) / send_seconds if send_seconds else None,
+      'latency_p50': util.percentile(latencies, 50),
+      'latency_p90': util.percentile(latencies, 90),
+      'latency_p99': util.percentile(latencies, 99),
+      'latency_max': max(latencies) if latencies else None,
+      'server_errors': server.error_count,
+      'rate_limited': server.rate_limited_count,
+    }
+    # How the ingress queue coped: shed messages, overload episodes, peak depth.
+    for key, value in load_bot.ingress.stats.items():
+      report['ingress_' + key] = value
+    return report
+  finally:
+    if load_bot is not None:
+      load_bot.stop()
+    server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure_startup(streams=500, latency=0.02, per_stream_latency=0.001, chunk_size=50, workers=4,
+    blocking=False, reply_timeout=30):
+  """
+  Starts a bot against a fake realm with `streams` streams and returns how long
+  it took to send its first reply, and to finish subscribing to every stream.
+  """
+  workdir = tempfile.mkdtemp(prefix='rsvp-startup-')
+  server = FakeZulipServer(
+    streams=['stream-%d' % idx for idx in range(streams)],
+    latency=latency,
+    per_stream_latency=per_stream_latency,
+  ).start()
+
+  startup_bot = None
+  try:
+    started = time.time()
+    startup_bot = start_bot(
+      server, workdir,
+      wait_for_subscriptions=blocking,
+      subscription_chunk_size=chunk_size,
+      subscription_workers=workers,
+    )
+    server.inject_message('rsvp init', stream='stream-0', subject='startup')
+    server.state.wait_for_sent(1, timeout=reply_timeout)
+    first_reply = time.time() - started
+
+    startup_bot.subscriptions.join(reply_timeout)
+    subscribed = time.time() - started
+
+    return {
+      'streams': streams,
+      'chunk_size': chunk_size,
+      'workers': workers,
+      'blocking': blocking,
+      'subscribe_requests': len(server.state.subscribe_calls),
+      'time_to_first_reply': first_reply,
+      'time_to_all_subscribed': subscribed,
+    }
+  finally:
+    if startup_bot is not None:
+      startup_bot.stop()
+    server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def max_rss_mb():
+  # ru_maxrss is in kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure_realms(count=50, workers=4, reply_timeout=30):
+  """
+  Hosts `count` bots in this process with a RealmRunner and reports what each
+  one costs once every bot has answered a message.
+  """
+  workdir = tempfile.mkdtemp(prefix='rsvp-realms-')
+  server = FakeZulipServer(streams=[LOAD_STREAM]).start()
+
+  runner = realms.RealmRunner([
+    {'name': 'realm-%d' % idx, 'email': 'bot-%d@example.com' % idx, 'key': 'fake-api-key', 'site': server.url}
+    for idx in range(count)
+  ], datadir=workdir, workers=workers)
+
+  try:
+    rss_before = max_rss_mb()
+    started = time.time()
+
+    runner.start()
+    if not wait_for(lambda: len(server.state.queues) >= count, timeout=reply_timeout):
+      raise RuntimeError('Not every bot registered an event queue with the fake server.')
+
+    # Every bot sees every message on the fake server, so one message gets `count` replies.
+    server.inject_message('rsvp init', stream=LOAD_STREAM, subject='realms')
+    replies = server.state.wait_for_sent(count, timeout=reply_timeout)
+    ready = time.time() - started
+
+    for realm_bot in runner.bots.values():
+      realm_bot.subscriptions.join(reply_timeout)
+    rss = max_rss_mb() - rss_before
+
+    return {
+      'realms': count,
+      'workers': workers,
+      'replies': replies,
+      'time_to_all_replied': ready,
+      'max_rss_mb': rss,
+      'max_rss_mb_per_realm': rss / count,
+    }
+  finally:
+    runner.stop()
+    server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_report(report):
+  lines = []
+  for key in sorted(report):
+    value = report[key]
+    if isinstance(value, float):
+      value = '%.4f' % value
+    lines.append('%-22s %s' % (key, value))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Load test bot.py against a local fake Zulip server.')
+  parser.add_argument('--count', type=int, default=1000, help='number of RSVPs to send')
+  parser.add_argument('--rate', type=float, default=1000, help='messages injected per second')
+  parser.add_argument('--topics', type=int, default=10, help='number of events to spread RSVPs over')
+  parser.add_argument('--latency', type=float, default=0, help='seconds added to every fake API call')
+  parser.add_argument('--error-rate', type=float, default=0, help='probability of a 500 on send')
+  parser.add_argument('--rate-limit-rate', type=float, default=0, help='probability of a 429 on send')
+  parser.add_argument('--reply-timeout', type=float, default=30, help='seconds to wait for replies')
+  parser.add_argument('--ack-window', type=float, default=0, help='seconds to merge acknowledgements over')
+  parser.add_argument('--realms', type=int, default=0, help='measure hosting this many bots in one process instead')
+  parser.add_argument('--startup', action='store_true', help='measure time to first reply instead')
+  parser.add_argument('--streams', type=int, default=500, help='streams in the realm, for --startup')
+  parser.add_argument('--chunk-size', type=int, default=50, help='streams per subscription request, for --startup')
+  parser.add_argument('--workers', type=int, default=4, help='concurrent subscription requests, for --startup')
+  args = parser.parse_args()
+
+  if args.realms:
+    print(format_report(measure_realms(args.realms, args.workers, args.reply_timeout)))
+    return
+
+  if args.startup:
+    # Compare against subscribing to everything with a single blocking request,
+    # which is what the bot used to do before it answered anything.
+    for chunk_size, workers, blocking in ((args.streams, 1, True), (args.chunk_size, args.workers, False)):
+      print(format_report(measure_startup(
+        streams=args.streams,
+        latency=args.latency or 0.02,
+        chunk_size=chunk_size,
+        workers=workers,
+        blocking=blocking,
+        reply_timeout=args.reply_timeout,
+      )))
+      print('')
+    return
+
+  report = run_load(
+    count=args.count,
+    rate=args.rate,
+    topics=args.topics,
+    latency=args.latency,
+    error_rate=args.error_rate,
+    rate_limit_rate=args.rate_limit_rate,
+    reply_timeout=args.reply_timeout,
+    ack_window=args.ack_window,
+  )
+  print(format_report(report))
+
+
+if __name__ == '__main__':
+  main()
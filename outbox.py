@@ -0,0 +1,294 @@
+from __future__ import with_statement
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+"""
+
+A small on-disk queue of replies waiting to be sent to Zulip, and the thread
+sending them.
+
+Handling a message only appends the reply to the queue, so a slow or broken
+Zulip holds up nothing but the sender thread. That thread calls
+deliver(message) until it returns {'result': 'success'}, retrying failures
+after an exponentially growing, jittered delay (or the 'retry-after' the
+server asked for, if that is longer), and drops the reply after max_attempts.
+deliver should make a single attempt: retrying is up to the outbox.
+
+Not every failure means the reply didn't go out. An error result is Zulip
+turning it down. Anything else (a timeout, a dropped connection, a gateway's
+error page, an exception) may have come after Zulip posted it. Such a reply
+is marked as maybe sent, and before sending it again the outbox asks
+confirm(message, since) whether it was posted at or after `since` after
+all. It is only sent again on False; on None (couldn't tell) confirm is
+asked again after the next delay. Without confirm, it is sent again.
+
+Every reply has a key. Queueing a key that is already queued, or that was
+delivered lately, does nothing: the same incoming message handled twice
+(e.g. replayed after a reconnect or a restart) is only answered once.
+
+The queue is a journal of JSON lines, one per queued, maybe sent, delivered
+or dropped reply, synced to disk as it is written and replayed on start so
+replies queued before a restart still go out. It is rewritten without the
+finished entries once they pile up.
+
+"""
+
+class Outbox(object):
+
+  def __init__(self, filename, deliver, max_attempts=8, base_delay=0.5, max_delay=60,
+               remember=10000, clock=time.time, confirm=None):
+    self.filename = filename
+    self.deliver = deliver
+    self.confirm = confirm
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.remember = remember
+    self.clock = clock
+    self.random = random.Random()
+    self.condition = threading.Condition()
+    # key -> {'message': ..., 'attempts': n}, and 'maybe_sent': when the first
+    # attempt that may have gone through started.
+    self.pending = collections.OrderedDict()
+    # (due, seq, key) of everything pending.
+    self.schedule = []
+    self.seq = itertools.count()
+    # Keys delivered or dropped lately, oldest first.
+    self.finished = collections.OrderedDict()
+    self.journal_lines = 0
+    self.stats = collections.Counter()
+    self.thread = None
+    self.stopped = False
+    self.load()
+    self.file = open(self.filename, 'a')
+
+  def __len__(self):
+    return len(self.pending)
+
+  def load(self):
+    if not os.path.exists(self.filename):
+      return
+    with open(self.filename) as f:
+      for line in f:
+        if not line.strip():
+          continue
+        entry = json.loads(line)
+        self.journal_lines += 1
+        if entry['op'] == 'add':
+          self.pending[entry['key']] = {'message': entry['message'], 'attempts': 0}
+        elif entry['op'] == 'maybe':
+          if entry['key'] in self.pending:
+            self.pending[entry['key']]['maybe_sent'] = entry['since']
+        else:
+          self.pending.pop(entry['key'], None)
+          self.finish(entry['key'])
+    now = self.clock()
+    for key in self.pending:
+      heapq.heappush(self.schedule, (now, next(self.seq), key))
+
+  def write(self, entry):
+    # The caller holds the condition.
+    self.file.write(json.dumps(entry) + '\n')
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.journal_lines += 1
+
+  def finish(self, key):
+    self.finished[key] = True
+    while len(self.finished) > self.remember:
+      self.finished.popitem(last=False)
+
+  def compact(self):
+    """
+    Rewrites the journal with only what is still pending (and the keys to
+    remember), once finished entries make up most of it.
+    """
+    # The caller holds the condition.
+    if self.journal_lines < 1000 or self.journal_lines < 4 * (len(self.pending) + len(self.finished)):
+      return
+    lines = [{'op': 'done', 'key': key} for key in self.finished]
+    for key, entry in self.pending.items():
+      lines.append({'op': 'add', 'key': key, 'message': entry['message']})
+      if 'maybe_sent' in entry:
+        lines.append({'op': 'maybe', 'key': key, 'since': entry['maybe_sent']})
+    self.file.close()
+    with open(self.filename + '.tmp', 'w') as f:
+      for entry in lines:
+        f.write(json.dumps(entry) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(self.filename + '.tmp', self.filename)
+    self.file = open(self.filename, 'a')
+    self.journal_lines = len(lines)
+    self.stats['compactions'] += 1
+
+  def put(self, message, key=None):
+    """
+    Queues a reply. Returns its key, or None if it was a duplicate.
+    """
+    key = key or uuid.uuid4().hex
+    with self.condition:
+      if key in self.pending or key in self.finished:
+        self.stats['duplicates'] += 1
+        return None
+      self.write({'op': 'add', 'key': key, 'message': message})
+      self.pending[key] = {'message': message, 'attempts': 0}
+      heapq.heappush(self.schedule, (self.clock(), next(self.seq), key))
+      self.stats['queued'] += 1
+      self.condition.notify_all()
+    return key
+
+  def backoff(self, attempts):
+    # Full jitter: anywhere up to the exponential delay, so a backlog built up
+    # while Zulip was down doesn't all come back at once.
+    return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+
+  def next_due(self, now):
+    """
+    Pops the key of a reply whose time has come, or returns how long until
+    the next one will (None if there is nothing to send).
+    """
+    # The caller holds the condition.
+    while self.schedule:
+      due, _, key = self.schedule[0]
+      if key not in self.pending:
+        heapq.heappop(self.schedule)
+        continue
+      if due > now:
+        return None, due - now
+      heapq.heappop(self.schedule)
+      return key, 0
+    return None, None
+
+  def attempt(self, message):
+    """
+    Sends message once. Returns the result, and whether it may have gone out
+    despite not being a success.
+    """
+    try:
+      result = self.deliver(message)
+    except Exception:
+      traceback.print_exc()
+      return None, True
+    if result and result.get('result') in ('success', 'error'):
+      return result, False
+    return result, True
+
+  def check(self, message, since):
+    """
+    Whether a reply that may have gone out did (True), didn't (False), or
+    None if confirm couldn't tell.
+    """
+    try:
+      return self.confirm(message, since)
+    except Exception:
+      traceback.print_exc()
+      return None
+
+  def send(self, key):
+    with self.condition:
+      entry = self.pending[key]
+      message = entry['message']
+      since = entry.get('maybe_sent')
+
+    # Wall clock time, to compare with when Zulip says a message was posted.
+    started = time.time()
+    maybe = False
+    found = False
+    if since is not None and self.confirm is not None:
+      found = self.check(message, since)
+    if found:
+      result = {'result': 'success'}
+    elif found is None:
+      result = None
+    else:
+      result, maybe = self.attempt(message)
+
+    with self.condition:
+      if result and result.get('result') == 'success':
+        del self.pending[key]
+        self.finish(key)
+        self.write({'op': 'done', 'key': key})
+        self.stats['confirmed' if found else 'delivered'] += 1
+      else:
+        if maybe and since is None:
+          entry['maybe_sent'] = started
+          self.write({'op': 'maybe', 'key': key, 'since': started})
+          self.stats['maybe_sent'] += 1
+        entry['attempts'] += 1
+        if entry['attempts'] >= self.max_attempts:
+          del self.pending[key]
+          self.finish(key)
+          self.write({'op': 'dropped', 'key': key})
+          self.stats['dropped'] += 1
+          sys.stderr.write('Gave up sending a reply after %d attempts: %r\n' % (entry['attempts'], result))
+        else:
+          delay = self.backoff(entry['attempts'])
+          retry_after = result and result.get('retry-after')
+          if retry_after:
+            delay = max(delay, float(retry_after))
+          heapq.heappush(self.schedule, (self.clock() + delay, next(self.seq), key))
+          self.stats['retried'] += 1
+      self.compact()
+
+  def send_due(self):
+    """
+    Sends every reply whose time has come. Returns how many were tried.
+    """
+    tried = 0
+    while True:
+      with self.condition:
+        key, _ = self.next_due(self.clock())
+      if key is None:
+        return tried
+      self.send(key)
+      tried += 1
+
+  def run(self):
+    while True:
+      with self.condition:
+        if self.stopped:
+          return
+        key, wait = self.next_due(self.clock())
+        if key is None:
+          self.condition.wait(wait)
+          continue
+      self.send(key)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops the sender thread once it is done with the reply in hand and
+    closes the journal. Replies still pending go out after the next start.
+    """
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    if self.thread is not None:
+      self.thread.join(timeout)
+    with self.condition:
+      self.file.close()
+
+  def wait_until_empty(self, timeout=5):
+    """
+    Blocks until nothing is pending, or the timeout expires. Returns whether
+    the queue is empty.
+    """
+    deadline = time.time() + timeout
+    while self.pending and time.time() < deadline:
+      time.sleep(0.01)
+    return not self.pending
@@ -0,0 +1,61 @@
+from __future__ import with_statement
+import threading
+
+import commands
+from debounce import Debouncer
+
+"""
+
+Keeps pinned summaries (see RSVPPinSummaryCommand) up to date.
+
+Every commit that changes a pinned event schedules an edit of its summary
+message, debounced over `window` seconds: a signup rush produces one edit per
+window instead of one per RSVP, and none at all if the summary reads the same.
+
+"""
+
+class PinnedSummaries(object):
+
+  def __init__(self, rsvp, update_message, window=10):
+    """
+    update_message(message_id, content) edits a Zulip message.
+    """
+    self.rsvp = rsvp
+    self.update_message = update_message
+    self.debouncer = Debouncer(window, self.edit)
+    self.lock = threading.Lock()
+    self.rendered = {}
+    rsvp.add_listener(self.changed)
+
+  def start(self):
+    self.debouncer.start()
+    return self
+
+  def pinned(self, event_id, message_id, body):
+    """
+    The bot posted `body` as the pinned summary of an event.
+    """
+    with self.lock:
+      self.rendered[message_id] = body
+    self.rsvp.set_summary_message(event_id, message_id)
+
+  def changed(self, changes):
+    for change in changes:
+      if change['op'] != 'put':
+        continue
+      event = change['event']
+      if event.get('pinned_summary') and event.get('summary_message_id'):
+        self.debouncer.touch(change['id'])
+
+  def edit(self, event_id):
+    event = self.rsvp.events.snapshot(event_id)
+    if not event or not event.get('pinned_summary') or not event.get('summary_message_id'):
+      return
+
+    message_id = event['summary_message_id']
+    body = commands.RSVPSummaryCommand.summary(event)
+    with self.lock:
+      if self.rendered.get(message_id) == body:
+        return
+      self.rendered[message_id] = body
+    self.update_message(message_id, body)
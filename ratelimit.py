@@ -0,0 +1,121 @@
+from __future__ import with_statement
+import collections
+import threading
+import time
+
+"""
+
+Token bucket rate limits on commands, per sender and per thread.
+
+Each limit is (tokens per second, burst): a bucket starts with `burst`
+tokens, every command takes one and they come back at `rate` per second.
+Commands are told apart by their first word after the key word, which is
+cheap enough to do before any regular expression runs; words without a limit
+of their own share the None limit. A command has to get a token from both
+its sender's bucket and its thread's bucket, or it is dropped without a
+reply (answering a flood would only make it worse).
+
+A bucket is only a [tokens, last update] pair. Buckets are kept in the order
+they were last used, and those idle long enough to have filled back up are
+dropped: a missing bucket is the same as a full one. Memory stays
+proportional to the people and threads that were active lately.
+
+"""
+
+SENDER_LIMITS = {
+  'ping': (1 / 60.0, 3),
+  'summary': (0.2, 5),
+  'status': (0.2, 5),
+  'stats': (0.2, 5),
+  'help': (0.1, 3),
+  'credits': (0.1, 3),
+  None: (1.0, 10),
+}
+
+# A thread gets more headroom: a signup rush is lots of people in one thread.
+THREAD_LIMITS = {
+  'ping': (1 / 60.0, 3),
+  'summary': (0.5, 10),
+  'status': (0.5, 10),
+  'stats': (0.5, 10),
+  'help': (0.2, 5),
+  'credits': (0.2, 5),
+  None: (10.0, 100),
+}
+
+
+class RateLimiter(object):
+
+  def __init__(self, key_word, sender_limits=SENDER_LIMITS, thread_limits=THREAD_LIMITS, clock=time.time):
+    self.key_word = key_word.lower()
+    self.limits = {'sender': sender_limits, 'thread': thread_limits}
+    self.clock = clock
+    self.lock = threading.Lock()
+    # (scope, key, word) -> [tokens, last update], least recently used first.
+    self.buckets = collections.OrderedDict()
+    # Any bucket left alone this long is full again.
+    self.idle_after = max(burst / float(rate)
+                          for limits in self.limits.values()
+                          for rate, burst in limits.values())
+    self.stats = collections.Counter()
+
+  def __len__(self):
+    return len(self.buckets)
+
+  def command_word(self, content):
+    words = content.lower().split(None, 2)
+    if len(words) < 2 or words[0] != self.key_word:
+      return None
+    return words[1]
+
+  def limit_of(self, scope, word):
+    limits = self.limits[scope]
+    return word if word in limits else None, limits.get(word, limits[None])
+
+  def take(self, scope, key, word, now):
+    # The caller holds the lock.
+    word, (rate, burst) = self.limit_of(scope, word)
+    bucket_key = (scope, key, word)
+    bucket = self.buckets.pop(bucket_key, None)
+    if bucket is None:
+      bucket = [float(burst), now]
+    else:
+      bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+      bucket[1] = now
+    self.buckets[bucket_key] = bucket
+    if bucket[0] < 1:
+      return None
+    return bucket
+
+  def expire(self, now):
+    # The caller holds the lock.
+    while self.buckets:
+      key, bucket = next(self.buckets.iteritems())
+      if now - bucket[1] < self.idle_after:
+        break
+      del self.buckets[key]
+      self.stats['expired'] += 1
+
+  def allow(self, sender_id, thread, content):
+    """
+    Whether a message from sender_id in thread may go ahead. Takes a token from
+    both buckets if so. Anything not starting with the key word is allowed.
+    """
+    if not content.lstrip().lower().startswith(self.key_word):
+      return True
+    word = self.command_word(content)
+    now = self.clock()
+    with self.lock:
+      self.expire(now)
+      sender = self.take('sender', sender_id, word, now)
+      if sender is None:
+        self.stats['limited_sender'] += 1
+        return False
+      thread_bucket = self.take('thread', thread, word, now)
+      if thread_bucket is None:
+        self.stats['limited_thread'] += 1
+        return False
+      sender[0] -= 1
+      thread_bucket[0] -= 1
+      self.stats['allowed'] += 1
+      return True
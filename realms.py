@@ -0,0 +1,181 @@
+from __future__ import with_statement
+import argparse
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import bot
+import rsvp
+import strings
+from debounce import Scheduler
+from ingress import WorkerPool
+
+"""
+
+Hosts many RSVPBot identities, usually one per Zulip realm, in one process.
+
+Each realm gets its own bot.bot, with its own RSVP state and its own files
+under datadir/<name>/. What they share is the interpreter, one WorkerPool
+handling every realm's incoming events and one Scheduler running every
+debounced summary edit and merged reply. The only threads a realm still
+needs of its own are its event long-poll, the one sending its replies (see
+outbox.py) and, while it starts, the one subscribing it to streams.
+
+realms.json is a list of realms:
+
+  [{"name": "recurse", "email": "rsvp-bot@...", "key": "...",
+    "site": "https://recurse.zulipchat.com", "streams": []}]
+
+  python realms.py realms.json --datadir realms --workers 8
+
+`kill -HUP` reloads commands.py for every realm. The modules are shared, so
+they are reloaded once, on one thread for the whole process; then each
+realm rebuilds its commands from them when its turn comes in its queue.
+
+"""
+
+REALM_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Settings a realm may override, passed straight on to bot.bot.
+REALM_OPTIONS = ('summary_window', 'ack_window', 'ingress_size', 'busy_notice', 'group_window',
+                 'rate_limit', 'ambiguous', 'max_scan_length')
+
+
+class RealmRunner(object):
+
+  def __init__(self, realms, datadir='realms', workers=4, **bot_options):
+    self.realms = realms
+    self.datadir = datadir
+    self.bot_options = bot_options
+    self.pool = WorkerPool(workers)
+    self.scheduler = Scheduler()
+    self.bots = {}
+    self.threads = {}
+    self.reload_requested = threading.Event()
+    self.stopping = threading.Event()
+    self.reload_thread = None
+
+  def add(self, realm):
+    """
+    Starts a bot for one realm and returns it.
+    """
+    name = realm['name']
+    if not REALM_NAME.match(name):
+      raise ValueError('Realm names may only contain letters, digits, _, . and -: %r' % name)
+    if name in self.bots:
+      raise ValueError('Realm %r is listed twice.' % name)
+
+    directory = os.path.join(self.datadir, name)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    options = dict(self.bot_options)
+    options.update((key, realm[key]) for key in REALM_OPTIONS if key in realm)
+    realm_bot = bot.bot(
+      realm['email'], realm['key'], realm.get('key_word', 'rsvp'),
+      realm.get('streams', []),
+      zulip_site=realm.get('site'),
+      filename=os.path.join(directory, 'events.json'),
+      subscriptions_filename=os.path.join(directory, 'subscriptions.json'),
+      outbox_filename=os.path.join(directory, 'outbox.jsonl'),
+      scheduler=self.scheduler,
+      pool=self.pool,
+      **options
+    )
+
+    thread = threading.Thread(target=realm_bot.main, name='realm-%s' % name)
+    thread.daemon = True
+    thread.start()
+
+    self.bots[name] = realm_bot
+    self.threads[name] = thread
+    return realm_bot
+
+  def reload_commands(self):
+    """
+    Reloads commands.py and strings.py once, then has every realm rebuild
+    its commands from them. Returns whether the modules loaded; if they
+    didn't, every realm keeps its old commands.
+    """
+    try:
+      rsvp.reload_command_modules()
+    except Exception as e:
+      traceback.print_exc()
+      sys.stderr.write(strings.ERROR_RELOAD_FAILED % e + '\n')
+      return False
+    for realm_bot in self.bots.values():
+      realm_bot.ingress.put({'type': 'reload_commands', 'modules': False})
+    return True
+
+  def watch_for_reload(self):
+    """
+    Reloads every realm's commands whenever self.reload_requested is set,
+    e.g. from a signal handler.
+    """
+    def reload_all():
+      while True:
+        self.reload_requested.wait()
+        self.reload_requested.clear()
+        if self.stopping.is_set():
+          return
+        self.reload_commands()
+
+    self.reload_thread = threading.Thread(target=reload_all, name='realms-reload')
+    self.reload_thread.daemon = True
+    self.reload_thread.start()
+
+  def reload_on_signal(self, signum=signal.SIGHUP):
+    """
+    Reloads every realm's commands whenever the process gets signum. Has to
+    be called from the main thread.
+    """
+    self.watch_for_reload()
+    signal.signal(signum, lambda *args: self.reload_requested.set())
+
+  def start(self):
+    self.pool.start()
+    self.scheduler.start()
+    for realm in self.realms:
+      self.add(realm)
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops every realm's bot, then the threads they share.
+    """
+    self.stopping.set()
+    self.reload_requested.set()
+    if self.reload_thread is not None:
+      self.reload_thread.join(timeout)
+    for realm_bot in self.bots.values():
+      realm_bot.stop(timeout)
+    self.pool.stop(timeout)
+    self.scheduler.stop(timeout)
+
+
+def load_realms(filename):
+  with open(filename) as f:
+    return json.load(f)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run RSVPBot for many realms in one process.')
+  parser.add_argument('config', help='JSON list of realms')
+  parser.add_argument('--datadir', default='realms', help='directory for each realm\'s files')
+  parser.add_argument('--workers', type=int, default=4, help='threads handling events for every realm')
+  args = parser.parse_args()
+
+  runner = RealmRunner(load_realms(args.config), args.datadir, args.workers).start()
+  runner.reload_on_signal()
+  print('Serving %d realms' % len(runner.bots))
+  while True:
+    time.sleep(60)
+
+
+if __name__ == '__main__':
+  main()
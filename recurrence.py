@@ -0,0 +1,101 @@
+import calendar
+import datetime
+
+"""
+
+Repeating events (`rsvp repeat weekly`).
+
+A repeating event is still one event in one topic. It only ever holds its
+current occurrence: once that is over, it is rolled forward to the next
+occurrence on or after today, setting aside who came to the last one in
+past_occurrences. RSVP does that for every repeating event when it starts
+and on the first command of each day (see RSVP.roll_forward_all).
+Occurrences nobody touched are skipped over without ever being created, and
+the next one is worked out arithmetically rather than by stepping through
+the series.
+
+An event's recurrence is None or:
+
+  {'frequency': 'weekly', 'day': 31, 'until': '2016-06-30' or None}
+
+where day is the day of the month monthly events fall on, for months that
+are too short for it. `rsvp set date` moves it along with the date.
+
+"""
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+# How many past occurrences an event keeps the attendees of.
+PAST_OCCURRENCES_KEPT = 52
+
+
+def parse_date(value):
+  return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def add_months(date, months, day):
+  month_index = date.year * 12 + date.month - 1 + months
+  year, month = divmod(month_index, 12)
+  month += 1
+  return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(date, rule, today):
+  """
+  The first occurrence on or after today of a series with an occurrence on date.
+  """
+  if date >= today:
+    return date
+
+  frequency = rule['frequency']
+  if frequency == 'daily':
+    return today
+  if frequency == 'weekly':
+    weeks = -(-(today - date).days // 7)
+    return date + datetime.timedelta(weeks=weeks)
+
+  months = (today.year - date.year) * 12 + today.month - date.month
+  candidate = add_months(date, months, rule['day'])
+  if candidate < today:
+    candidate = add_months(date, months + 1, rule['day'])
+  return candidate
+
+
+def describe(rule):
+  if rule['until']:
+    return '%s until %s' % (rule['frequency'], rule['until'])
+  return rule['frequency']
+
+
+def roll_forward(event, today=None):
+  """
+  A copy of a repeating event moved on to its next occurrence, or None if the
+  event doesn't need to move (it doesn't repeat, its occurrence hasn't
+  happened yet or the series is over).
+  """
+  rule = event.get('recurrence')
+  if not rule or not event.get('date'):
+    return None
+
+  today = today or datetime.date.today()
+  date = parse_date(event['date'])
+  if date >= today:
+    return None
+
+  upcoming = next_occurrence(date, rule, today)
+  if rule['until'] and upcoming > parse_date(rule['until']):
+    return None
+
+  past = {
+    'date': event['date'],
+    'yes': event['yes'],
+    'no': event['no'],
+    'maybe': event['maybe'],
+  }
+  rolled = dict(event)
+  rolled['past_occurrences'] = (event['past_occurrences'] + [past])[-PAST_OCCURRENCES_KEPT:]
+  rolled['yes'] = []
+  rolled['no'] = []
+  rolled['maybe'] = []
+  rolled['date'] = str(upcoming)
+  return rolled
@@ -0,0 +1,281 @@
+from __future__ import with_statement
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+import Queue
+
+from storage import JSONFileStorage
+from store import EventStore
+
+"""
+
+Warm-standby replication.
+
+The primary bot attaches a JournalPublisher to its RSVP instance. After every
+commit it queues the journal entries (see EventStore.drain_changes), and a
+thread of its own streams them to the standby over a local TCP socket. Replies
+only go out once the standby has acknowledged everything committed before
+them, so an RSVP the user has seen confirmed is never only on the primary. The
+waiting happens after the RSVP lock is released (see RSVP.add_reply_gate), so
+a slow standby holds up replies but not the handling of other changes.
+
+The standby keeps its own EventStore up to date. When the primary goes away
+and doesn't come back within failover_timeout seconds, it saves the store to
+its storage (see storage.py) and takes over, running a bot configured the same
+way as bot.py's:
+
+  python bot.py                                        # with ZULIP_RSVP_STANDBY=127.0.0.1:5555
+  python replication.py standby --port 5555            # on the same machine
+
+Undo history is not replicated, only the events themselves.
+
+"""
+
+class JournalPublisher(object):
+  """
+  Sends journal entries to a standby from a thread of its own, and lets
+  replies wait for them to be acknowledged.
+
+  If the standby can't be reached the primary keeps going without it and tries
+  again on the next commit, starting over with a full copy of the store.
+  Replies never wait more than `timeout` seconds for the standby.
+  """
+
+  def __init__(self, host, port, timeout=5):
+    self.address = (host, port)
+    self.timeout = timeout
+    self.rsvp = None
+    self.sock = None
+    self.reader = None
+    self.seq = 0
+    self.queue = Queue.Queue()
+    self.condition = threading.Condition()
+    # Commits queued so far, and how many of them the standby has acknowledged
+    # or we have given up on.
+    self.queued = 0
+    self.finished = 0
+    self.thread = None
+
+  def attach(self, rsvp):
+    self.rsvp = rsvp
+    rsvp.add_listener(self.publish)
+    rsvp.add_reply_gate(self.wait)
+    self.start()
+    # Get the standby up to date right away rather than on the first change.
+    self.publish([])
+    return self
+
+  def connect(self):
+    self.sock = socket.create_connection(self.address, self.timeout)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.reader = self.sock.makefile('r')
+    # Whatever happened while we were apart, this brings the standby up to date.
+    # Events change under the lock, so the copy is taken under it too.
+    with self.rsvp.lock:
+      line = self.line([{'op': 'reset', 'events': self.rsvp.events.dump()}])
+    self.send_line(line)
+
+  def close(self):
+    if self.sock is not None:
+      try:
+        self.sock.close()
+      except socket.error:
+        pass
+    self.sock = None
+    self.reader = None
+
+  def line(self, entries):
+    # One line per batch, acknowledged with its sequence number.
+    self.seq += 1
+    return json.dumps({'seq': self.seq, 'entries': entries}) + '\n'
+
+  def send_line(self, line):
+    self.sock.sendall(line)
+    while True:
+      reply = self.reader.readline()
+      if not reply:
+        raise socket.error('standby closed the connection')
+      if json.loads(reply).get('ack') == self.seq:
+        return
+
+  def publish(self, changes):
+    """
+    The RSVP listener: queues what changed for the sender thread.
+    """
+    with self.condition:
+      self.queued += 1
+    self.queue.put(changes)
+
+  def send_queued(self, changes):
+    """
+    Sends changes, and whatever else is queued behind them, as one batch.
+    """
+    batches = [changes]
+    while True:
+      try:
+        batches.append(self.queue.get_nowait())
+      except Queue.Empty:
+        break
+    if None in batches:
+      # Stopping: the rest isn't sent.
+      batches = batches[:batches.index(None)]
+      self.queue.put(None)
+
+    try:
+      if self.sock is None:
+        self.connect()
+      else:
+        self.send_line(self.line([entry for batch in batches for entry in batch]))
+    except (socket.error, ValueError) as e:
+      sys.stderr.write('Replication to standby %s:%d failed: %s\n' % (self.address + (e,)))
+      self.close()
+
+    with self.condition:
+      self.finished += len(batches)
+      self.condition.notify_all()
+
+  def run(self):
+    while True:
+      changes = self.queue.get()
+      if changes is None:
+        return
+      self.send_queued(changes)
+
+  def wait(self):
+    """
+    Blocks until everything committed so far has been acknowledged by the
+    standby (or given up on), for at most `timeout` seconds.
+    """
+    deadline = time.time() + self.timeout
+    with self.condition:
+      target = self.queued
+      while self.finished < target:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.condition.wait(remaining)
+    return True
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=5):
+    """
+    Stops the sender thread once the batch in hand is sent, and disconnects.
+    """
+    self.queue.put(None)
+    if self.thread is not None:
+      self.thread.join(timeout)
+    self.close()
+
+
+class Standby(object):
+  """
+  Receives journal entries from a primary and applies them to its own store.
+
+  Once a primary has connected, losing it for longer than failover_timeout
+  seconds triggers a takeover: the store is saved to storage (by default the
+  JSON file at filename) and on_takeover(events) is called from the standby's
+  thread.
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, filename='events.json', failover_timeout=3, on_takeover=None,
+               storage=None):
+    self.events = EventStore()
+    self.filename = filename
+    self.storage = storage if storage is not None else JSONFileStorage(filename)
+    self.failover_timeout = failover_timeout
+    self.on_takeover = on_takeover
+    self.lock = threading.Lock()
+    self.took_over = threading.Event()
+    self.applied = 0
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind((host, port))
+    self.server.listen(1)
+    self.address = self.server.getsockname()
+    self.thread = None
+
+  def apply(self, entry):
+    with self.lock:
+      if entry['op'] == 'reset':
+        self.events = EventStore(entry['events'])
+      else:
+        self.events.apply(entry)
+      self.applied += 1
+
+  def follow(self, conn):
+    """
+    Applies everything the primary sends until it disconnects.
+    """
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = conn.makefile('r')
+    try:
+      while True:
+        line = reader.readline()
+        if not line:
+          return
+        batch = json.loads(line)
+        for entry in batch['entries']:
+          self.apply(entry)
+        conn.sendall(json.dumps({'ack': batch['seq']}) + '\n')
+    except (socket.error, ValueError):
+      return
+    finally:
+      conn.close()
+
+  def serve(self):
+    connected_once = False
+    while not self.took_over.is_set():
+      self.server.settimeout(self.failover_timeout if connected_once else None)
+      try:
+        conn, _ = self.server.accept()
+      except socket.timeout:
+        self.take_over()
+        return
+      connected_once = True
+      self.follow(conn)
+
+  def take_over(self):
+    self.server.close()
+    with self.lock:
+      self.storage.save(self.events.dump())
+    self.took_over.set()
+    if self.on_takeover:
+      self.on_takeover(self.events)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run a warm standby for RSVPBot.')
+  parser.add_argument('mode', choices=['standby'])
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=5555)
+  parser.add_argument('--filename', default='events.json')
+  parser.add_argument('--failover-timeout', type=float, default=3)
+  args = parser.parse_args()
+
+  def run_bot(events):
+    import bot
+    new_bot = bot.bot_from_env(filename=args.filename, events=events)
+    new_bot.reload_on_signal()
+    new_bot.main()
+
+  standby = Standby(args.host, args.port, args.filename, args.failover_timeout, on_takeover=run_bot)
+  print('Standing by on %s:%d' % standby.address)
+  standby.serve()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,54 +1,217 @@
 from __future__ import with_statement
 import re
-import json
+import threading
 import time
 import datetime
 
 import commands
+import recurrence
+import schedule
+import schema
+import search
+import stats
+import strings
+import tracing
+from storage import JSONFileStorage
+from store import EventStore
 from strings import *
 
+
+# The modules are shared by every RSVP in the process. Held while they are
+# reloaded and while commands are built from them, so no RSVP builds its
+# commands from a module that is half-way through reloading.
+module_lock = threading.Lock()
+
+
+def reload_command_modules():
+  """
+  Re-reads strings.py and commands.py from disk. RSVP instances keep using
+  the commands they have until their reload_commands() is called.
+  """
+  with module_lock:
+    reload(strings)
+    reload(commands)
+    globals().update((name, value) for name, value in vars(strings).items() if name.isupper())
+
+
 class RSVP(object):
 
-  def __init__(self, key_word, filename='events.json'):
+  def __init__(self, key_word, filename='events.json', events=None, tracer=None, limiter=None,
+               storage=None, ambiguous=None, max_scan_length=None):
     """
-    When created, this instance will try to open self.filename. It will always
-    keep a copy in memory of the whole events dictionary and commit it when necessary.
+    When created, this instance will load its events from storage (see
+    storage.py; by default the JSON file at filename), unless it's given an
+    EventStore to start from. It will always keep a copy in memory of the
+    whole events dictionary (as an EventStore) and save it to storage when
+    necessary.
+
+    Events written by older versions are migrated to the current schema (see
+    schema.py) once, here, and written back.
+
+    With a tracer (see tracing.py), routing, executing and committing are
+    timed for sampled messages.
+
+    With a limiter (see ratelimit.py), commands over their sender's or
+    thread's rate limit are dropped before anything else is done with them.
+
+    Messages are handled on the ingress thread, but pinned summaries, user
+    groups and renames change events from other threads too. Everything that
+    changes events or commits them holds self.lock, so only one change and
+    one commit happen at a time.
+
+    ambiguous and max_scan_length are handed to RSVPConfirmCommand: whether
+    `rsvp yes no` keeps the first decision ('first', the default) or is
+    turned down ('reject'), and how much of a message is scanned for one.
     """
     self.key_word = key_word
     self.filename = filename
-    self.command_list = (
+    self.storage = storage if storage is not None else JSONFileStorage(filename)
+    self.tracer = tracer or tracing.Tracer()
+    self.limiter = limiter
+    self.ambiguous = ambiguous
+    self.max_scan_length = max_scan_length
+    self.lock = threading.RLock()
+    self.listeners = []
+    self.reply_gates = []
+    self.commits = 0
+    self.command_list = self.build_command_list()
+
+    if events is not None:
+      self.events = events
+    else:
+      self.events = EventStore(self.load_events())
+
+    if schema.migrate(self.events):
+      self.commit_events()
+
+    # The day every repeating event was last rolled forward on.
+    self.rolled_on = None
+    self.roll_forward_all()
+
+    self.schedule = schedule.ScheduleIndex(self.events)
+    self.add_listener(self.schedule.changed)
+    self.search = search.SearchIndex(self.events)
+    self.add_listener(self.search.changed)
+    self.stats = stats.AttendanceStats(self.events)
+    self.add_listener(self.stats.changed)
+
+  def build_command_list(self):
+    with module_lock:
+      return self.new_command_list()
+
+  def new_command_list(self):
+    key_word = self.key_word
+    return (
       commands.RSVPInitCommand(key_word),
       commands.RSVPHelpCommand(key_word),
       commands.RSVPCancelCommand(key_word),
       commands.RSVPMoveCommand(key_word),
       commands.RSVPSetLimitCommand(key_word),
       commands.RSVPSetDateCommand(key_word),
+      commands.RSVPRepeatCommand(key_word),
       commands.RSVPSetTimeCommand(key_word),
       commands.RSVPSetTimeAllDayCommand(key_word),
+      commands.RSVPSetDurationCommand(key_word),
       commands.RSVPSetStringAttributeCommand(key_word),
       commands.RSVPSummaryCommand(key_word),
+      commands.RSVPPinSummaryCommand(key_word),
       commands.RSVPPingCommand(key_word),
+      commands.RSVPSearchCommand(key_word),
+      commands.RSVPStatsCommand(key_word),
       commands.RSVPCreditsCommand(key_word),
+      commands.RSVPUndoCommand(key_word),
 
       # This needs to be at last for fuzzy yes|no checking
-      commands.RSVPConfirmCommand(key_word)
+      commands.RSVPConfirmCommand(key_word, max_scan_length=self.max_scan_length, ambiguous=self.ambiguous)
     )
 
-    try:
-      with open(self.filename, "r") as f:
-        try:
-          self.events = json.load(f)
-        except ValueError:
-          self.events = {}
-    except IOError:
-      self.events = {}
+  def reload_commands(self, modules=True):
+    """
+    Swaps in commands freshly loaded from commands.py, keeping everything
+    else (events, listeners...) as it is. If loading fails, the exception
+    is raised and the old commands stay.
+
+    With modules=False, commands.py isn't read again: the commands are
+    rebuilt from whatever reload_command_modules() last loaded, e.g. once
+    for every RSVP in the process (see realms.py).
+    """
+    if modules:
+      reload_command_modules()
+    self.command_list = self.build_command_list()
+    return len(self.command_list)
+
+  def load_events(self):
+    return self.storage.load()
 
   def commit_events(self):
     """
-    Write the whole events dictionary to the filename file.
+    Save the whole events dictionary to storage, then tell every listener
+    what changed.
+    """
+    with self.lock:
+      self.storage.save(self.events.dump())
+      self.commits += 1
+
+      changes = self.events.drain_changes()
+      if changes:
+        for listener in self.listeners:
+          listener(changes)
+
+  def set_summary_message(self, event_id, message_id):
+    """
+    Remembers which Zulip message is the pinned summary of an event.
+    """
+    with self.lock:
+      event = self.events.get(event_id)
+      if event is not None:
+        event['summary_message_id'] = message_id
+        self.events[event_id] = event
+        self.commit_events()
+
+  def set_user_group(self, event_id, group):
+    """
+    Remembers the Zulip user group `rsvp ping` mentions for an event, and who
+    was in it when it was last synced.
+    """
+    with self.lock:
+      event = self.events.get(event_id)
+      if event is not None:
+        event['user_group'] = group
+        self.events[event_id] = event
+        self.commit_events()
+
+  def add_listener(self, listener):
+    """
+    listener(changes) will be called after every commit that changed anything,
+    with the journal entries from EventStore.drain_changes(). Listeners run
+    under self.lock, so they shouldn't block: replies are only sent once every
+    listener has returned.
+    """
+    self.listeners.append(listener)
+
+  def add_reply_gate(self, gate):
+    """
+    gate() will be called before process_message() hands back its replies,
+    once self.lock is released, e.g. to wait until a standby has what they
+    confirm (see replication.py).
+    """
+    self.reply_gates.append(gate)
+
+  def rename_stream(self, old_name, new_name):
     """
-    with open(self.filename, 'w+') as f:
-      json.dump(self.events, f)
+    A Zulip stream was renamed: bring every event in it along.
+    """
+    with self.lock:
+      self.events.rename_stream(old_name, new_name)
+      self.commit_events()
+
+  def rename_topic(self, stream, old_topic, new_topic):
+    """
+    A Zulip topic was renamed: bring its event along.
+    """
+    with self.lock:
+      self.events.rename_topic(stream, old_topic, new_topic)
+      self.commit_events()
 
   def __exit__(self, type, value, traceback):
     """
@@ -70,7 +233,10 @@ class RSVP(object):
     """
 
     # adding handling of mulitples, dammit.
-    replies = self.route(message)
+    with self.lock:
+      replies = self.route(message)
+    for gate in self.reply_gates:
+      gate()
     messages = []
 
     for idx, reply in enumerate(replies):
@@ -85,6 +251,11 @@ class RSVP(object):
         # this is sending to a stream other than the one the incoming message
         messages.append(self.format_message(reply))
 
+      if reply.pin and messages[-1]:
+        messages[-1]['pin'] = reply.pin
+      if reply.aggregate and messages[-1]:
+        messages[-1]['aggregate'] = reply.aggregate
+
     return messages
 
   def route(self, message):
@@ -96,41 +267,112 @@ class RSVP(object):
     means no reply.
     """
     content = message['content']
-    content = self.normalize_whitespace(content)
+    # Messages in a renamed stream or topic may still carry the old name.
+    thread_id = self.event_id(message)
+    event_id = self.events.canonical_id(thread_id)
 
-    event_id = self.event_id(message)
+    if self.limiter is not None and not self.limiter.allow(message['sender_id'], event_id, content):
+      return []
+
+    content = self.normalize_whitespace(content)
 
     regex = r'^{}'.format(self.key_word)
 
     if re.match(regex, content, flags=re.I):
-      for command in self.command_list:
-        matches = command.match(content)
-        if matches:
-          kwargs = {
-            'event': self.events.get(event_id),
-            'event_id': event_id,
-            'sender_full_name': message['sender_full_name'],
-            'sender_id': message['sender_id'],
-            'subject': message['subject'],
-          }
-
-          if matches.groupdict():
-            kwargs.update(matches.groupdict())
+      with self.tracer.span('route'):
+        command, matches = self.find_command(content)
+
+      if command:
+        if command.creates_event:
+          # A new event goes in this very thread, even if it is named like
+          # a thread that was renamed.
+          self.events.claim(thread_id)
+          event_id = thread_id
+        self.roll_forward_all()
+        self.roll_forward(event_id)
+        kwargs = {
+          # Read-only commands get a copy, so they can't change anything by accident.
+          'event': self.events.get(event_id) if command.mutates else self.events.snapshot(event_id),
+          'event_id': event_id,
+          'sender_full_name': message['sender_full_name'],
+          'sender_id': message['sender_id'],
+          'subject': message['subject'],
+          'schedule': self.schedule,
+          'search': self.search,
+          'stats': self.stats,
+        }
+
+        if matches.groupdict():
+          kwargs.update(matches.groupdict())
 
+        if not command.mutates:
+          # Nothing changed, so there's nothing to record or commit.
+          with self.tracer.span('execute', command=command.__class__.__name__):
+            return command.execute(self.events, **kwargs).messages
+
+        before = self.events.snapshot(event_id)
+        with self.tracer.span('execute', command=command.__class__.__name__):
           response = command.execute(self.events, **kwargs)
 
-          # Allow for a single events object but multiple messaages to send
-          self.events = response.events
+        # Allow for a single events object but multiple messaages to send
+        self.events = response.events
+        if command.records_history:
+          self.events.record(event_id, before)
+        with self.tracer.span('commit'):
           self.commit_events()
 
-          # if it has multiple messages to send, then return that instead of 
-          # the pair
-          return response.messages
+        # if it has multiple messages to send, then return that instead of 
+        # the pair
+        return response.messages
 
       return [commands.RSVPMessage('stream', ERROR_INVALID_COMMAND % (content))]
     return [commands.RSVPMessage('private', None)]
 
 
+  def roll_forward(self, event_id, today=None, commit=True):
+    """
+    Moves a repeating event on to its next occurrence if the current one is
+    over. Returns whether it moved.
+    """
+    event = self.events.get(event_id)
+    rolled = event and recurrence.roll_forward(event, today)
+    if not rolled:
+      return False
+    before = self.events.snapshot(event_id)
+    self.events[event_id] = rolled
+    # A new version, so anything cached by version (e.g. calendar feeds)
+    # sees the new occurrence.
+    self.events.record(event_id, before)
+    if commit:
+      self.commit_events()
+    return True
+
+  def roll_forward_all(self, today=None):
+    """
+    Moves every repeating event whose occurrence is over on to its next
+    one, on the first command of each day. Occurrences only go out of date
+    when the day changes, so the schedule and search indexes never show a
+    past occurrence of a series nobody has used since.
+    """
+    today = today or datetime.date.today()
+    if self.rolled_on == today:
+      return
+    with self.lock:
+      rolled = [event_id for event_id in list(self.events) if self.roll_forward(event_id, today, commit=False)]
+      if rolled:
+        self.commit_events()
+      self.rolled_on = today
+
+  def find_command(self, content):
+    """
+    Returns the first command matching content, and its match, or (None, None).
+    """
+    for command in self.command_list:
+      matches = command.match(content)
+      if matches:
+        return command, matches
+    return None, None
+
   def create_message_from_message(self, message, body):
     """
     Convenience method for creating a zulip response message from a given zulip input message.
@@ -0,0 +1,145 @@
+from __future__ import with_statement
+import bisect
+import datetime
+import threading
+
+from store import EventStore
+
+"""
+
+Who said yes to what, and when: an index of every attendee's events by time,
+so `rsvp yes` can point out that someone is already going to something else
+at the same time without looking at every other event.
+
+Each person has a list of (start, end, event_id) intervals sorted by start,
+and the longest interval they have. Events overlapping [start, end) can only
+start between start - longest and end, so finding them is two bisections and
+a look at each of the k intervals in between: O(log n + k).
+
+The index follows the commit journal (see EventStore.drain_changes) as an
+RSVP listener, so every command that changes who is going or when (rsvp yes,
+set date, set time, set duration, cancel, move, renames...) keeps it current.
+
+"""
+
+# Events without a duration are assumed to take this long.
+DEFAULT_DURATION = datetime.timedelta(hours=1)
+
+
+def event_interval(event):
+  """
+  (start, end) datetimes of an event, or None if it has no date. All day
+  events take the whole day.
+  """
+  if not event.get('date'):
+    return None
+  start = datetime.datetime.strptime(event['date'], '%Y-%m-%d')
+  if not event.get('time'):
+    return start, start + datetime.timedelta(days=1)
+
+  hours, minutes = [int(part) for part in event['time'].split(':')]
+  start = start.replace(hour=hours, minute=minutes)
+  duration = event.get('duration')
+  return start, start + (datetime.timedelta(minutes=duration) if duration else DEFAULT_DURATION)
+
+
+class ScheduleIndex(object):
+
+  def __init__(self, events=None):
+    self.lock = threading.Lock()
+    # person -> sorted [(start, end, event_id)]
+    self.intervals = {}
+    # person -> longest end - start among their intervals. Only ever grows,
+    # which keeps it a safe bound.
+    self.longest = {}
+    # event_id -> (interval, attendees) as indexed, for every event.
+    self.indexed = {}
+    if events is not None:
+      for event_id in list(events):
+        self.put(event_id, events[event_id])
+
+  def add(self, person, start, end, event_id):
+    entries = self.intervals.setdefault(person, [])
+    bisect.insort(entries, (start, end, event_id))
+    self.longest[person] = max(self.longest.get(person, end - start), end - start)
+
+  def remove(self, person, start, end, event_id):
+    entries = self.intervals.get(person, [])
+    idx = bisect.bisect_left(entries, (start, end, event_id))
+    if idx < len(entries) and entries[idx] == (start, end, event_id):
+      del entries[idx]
+    if not entries:
+      self.intervals.pop(person, None)
+      self.longest.pop(person, None)
+
+  def put(self, event_id, event):
+    with self.lock:
+      self.discard(event_id)
+      interval = event_interval(event)
+      # Undated events are indexed too, without anyone, so moves know they are there.
+      attendees = frozenset(event['yes']) if interval else frozenset()
+      for person in attendees:
+        self.add(person, interval[0], interval[1], event_id)
+      self.indexed[event_id] = (interval, attendees)
+
+  def discard(self, event_id):
+    # The caller holds the lock.
+    interval, attendees = self.indexed.pop(event_id, (None, ()))
+    for person in attendees:
+      self.remove(person, interval[0], interval[1], event_id)
+
+  def delete(self, event_id):
+    with self.lock:
+      self.discard(event_id)
+
+  def move(self, old_id, new_id):
+    with self.lock:
+      if new_id in self.indexed:
+        # A stream renamed onto one with the same topic: like the store, keep
+        # the event that was already there.
+        self.discard(old_id)
+        return
+      if old_id not in self.indexed:
+        return
+      interval, attendees = self.indexed.pop(old_id)
+      for person in attendees:
+        self.remove(person, interval[0], interval[1], old_id)
+        self.add(person, interval[0], interval[1], new_id)
+      self.indexed[new_id] = (interval, attendees)
+
+  def conflicts(self, person, event, exclude=None):
+    """
+    Ids of the events person said yes to that overlap event, in order.
+    """
+    interval = event_interval(event)
+    if interval is None:
+      return []
+    start, end = interval
+    with self.lock:
+      entries = self.intervals.get(person)
+      if not entries:
+        return []
+      lo = bisect.bisect_left(entries, (start - self.longest[person],))
+      hi = bisect.bisect_left(entries, (end,))
+      return [event_id for other_start, other_end, event_id in entries[lo:hi]
+              if other_end > start and event_id != exclude]
+
+  def changed(self, changes):
+    """
+    Brings the index up to date with journal entries, as an RSVP listener.
+    """
+    for change in changes:
+      op = change['op']
+      if op == 'put':
+        self.put(change['id'], change['event'])
+      elif op == 'delete':
+        self.delete(change['id'])
+      elif op == 'rename_topic':
+        self.move(EventStore.join_id(change['stream'], change['old']),
+                  EventStore.join_id(change['stream'], change['new']))
+      elif op == 'rename_stream':
+        with self.lock:
+          old_ids = [event_id for event_id in self.indexed
+                     if EventStore.split_id(event_id)[0] == change['old']]
+        for event_id in old_ids:
+          self.move(event_id, EventStore.join_id(change['new'], EventStore.split_id(event_id)[1]))
@@ -0,0 +1,109 @@
+"""
+
+The shape of an event on disk, and how to bring old events up to date.
+
+Every event carries a schema_version. Events written before there was one
+count as version 0. migrate() runs once when events are loaded and upgrades
+whatever it finds to SCHEMA_VERSION, so commands can count on every field
+being there instead of checking for it each time they run.
+
+To change the schema, bump SCHEMA_VERSION and add a function to MIGRATIONS
+that takes an event from the previous version to the new one.
+
+"""
+
+SCHEMA_VERSION = 5
+
+
+def upgrade_to_1(event_id, event):
+  # Events from before `rsvp maybe` (and other fields added since) are missing
+  # some keys altogether.
+  defaults = {
+    'name': event_id.partition('/')[2] or event_id,
+    'description': None,
+    'place': None,
+    'creator': None,
+    'yes': [],
+    'no': [],
+    'maybe': [],
+    'time': None,
+    'limit': None,
+    'date': None,
+  }
+  for key, value in defaults.items():
+    event.setdefault(key, value)
+
+
+def upgrade_to_2(event_id, event):
+  # Zulip user ids of the people who RSVP'd, by full name, and the user group
+  # `rsvp ping` mentions (see user_groups.py). People who RSVP'd before ids
+  # were kept are simply missing from user_ids.
+  event.setdefault('user_ids', {})
+  event.setdefault('user_group', None)
+
+
+def upgrade_to_3(event_id, event):
+  # How the event repeats, and who came to its past occurrences (see
+  # recurrence.py).
+  event.setdefault('recurrence', None)
+  event.setdefault('past_occurrences', [])
+
+
+def upgrade_to_4(event_id, event):
+  # How long the event lasts, in minutes. None means the default (see
+  # schedule.py).
+  event.setdefault('duration', None)
+
+
+def upgrade_to_5(event_id, event):
+  # How many times people switched from one response to another, e.g.
+  # {'yes-no': 2} (see stats.py). Nobody counted before.
+  event.setdefault('changed_minds', {})
+
+
+# Fields the bot keeps in step with Zulip: the pinned summary's message, the
+# event's user group and the user ids its members are synced by. `rsvp undo`
+# leaves them as they are. Putting back an old value wouldn't change Zulip to
+# match, and would leave the bot unable to tell what to sync.
+BOT_MANAGED_FIELDS = ('summary_message_id', 'user_group', 'user_ids')
+
+
+# MIGRATIONS[n] upgrades an event from version n to version n + 1.
+MIGRATIONS = [
+  upgrade_to_1,
+  upgrade_to_2,
+  upgrade_to_3,
+  upgrade_to_4,
+  upgrade_to_5,
+]
+
+
+def new_event(**fields):
+  """
+  A fresh event at the current schema version.
+  """
+  event = {'schema_version': SCHEMA_VERSION}
+  event.update(fields)
+  return event
+
+
+def migrate_event(event_id, event):
+  """
+  Upgrades one event in place. Returns True if anything had to be done.
+  """
+  version = event.get('schema_version', 0)
+  if version >= SCHEMA_VERSION:
+    return False
+
+  for migration in MIGRATIONS[version:]:
+    migration(event_id, event)
+  event['schema_version'] = SCHEMA_VERSION
+  return True
+
+
+def migrate(events):
+  """
+  Upgrades every event of a {event_id: event} dictionary in place. Returns how
+  many events were upgraded.
+  """
+  return sum(1 for event_id, event in events.items() if migrate_event(event_id, event))
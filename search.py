@@ -0,0 +1,212 @@
+from __future__ import with_statement
+import bisect
+import datetime
+import heapq
+import itertools
+import re
+import threading
+
+from store import EventStore
+
+"""
+
+An inverted index of the words in every event's name, description and place,
+for `rsvp search`.
+
+Each word maps to the events it appears in, along with how much it counts
+for there: words in an event's name count twice as much as words in its
+description or place. A search only looks at the postings of its own words,
+so it costs about the number of events matching them, however many events
+there are in total.
+
+Results are ranked by how well they match, then upcoming events soonest
+first, then past events most recent first. When lots of events tie, walking
+all events in date order and picking out the tied ones finds the first few
+sooner than sorting the tied ones would, so that is done instead.
+
+Like schedule.ScheduleIndex, the index follows the commit journal as an RSVP
+listener, so init, set description/place, move, cancel and renames all keep
+it current.
+
+"""
+
+FIELD_WEIGHTS = {'name': 2, 'description': 1, 'place': 1}
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def date_key(date):
+  # '2016-03-10' -> 20160310, so dates compare as numbers.
+  return int(date.replace('-', '')) if date else None
+
+
+def tokenize(text):
+  return WORD.findall(text.lower()) if text else []
+
+
+def event_terms(event):
+  """
+  {word: weight} for an event.
+  """
+  terms = {}
+  for field, weight in FIELD_WEIGHTS.items():
+    for word in set(tokenize(event.get(field))):
+      terms[word] = terms.get(word, 0) + weight
+  return terms
+
+
+class SearchIndex(object):
+
+  def __init__(self, events=None):
+    self.lock = threading.Lock()
+    # word -> {event_id: weight}
+    self.postings = {}
+    # event_id -> ({word: weight}, date key) as indexed.
+    self.indexed = {}
+    # (date key, event_id) of every dated event, sorted.
+    self.by_date = []
+    if events is not None:
+      for event_id in list(events):
+        self.put(event_id, events[event_id], sort=False)
+      self.by_date.sort()
+
+  def __len__(self):
+    return len(self.indexed)
+
+  def put(self, event_id, event, sort=True):
+    terms = event_terms(event)
+    date = date_key(event.get('date'))
+    with self.lock:
+      old = self.indexed.get(event_id)
+      if old == (terms, date):
+        # Attendance changed, the words didn't: the usual case.
+        return
+      self.discard(event_id)
+      for word, weight in terms.items():
+        self.postings.setdefault(word, {})[event_id] = weight
+      self.indexed[event_id] = (terms, date)
+      if date is None:
+        pass
+      elif sort:
+        bisect.insort(self.by_date, (date, event_id))
+      else:
+        # Loading: sorted once at the end.
+        self.by_date.append((date, event_id))
+
+  def discard(self, event_id):
+    # The caller holds the lock.
+    words, date = self.indexed.pop(event_id, ({}, None))
+    for word in words:
+      postings = self.postings[word]
+      del postings[event_id]
+      if not postings:
+        del self.postings[word]
+    if date is not None:
+      del self.by_date[bisect.bisect_left(self.by_date, (date, event_id))]
+
+  def delete(self, event_id):
+    with self.lock:
+      self.discard(event_id)
+
+  def move(self, old_id, new_id):
+    with self.lock:
+      if new_id in self.indexed:
+        # A stream renamed onto one with the same topic: like the store, keep
+        # the event that was already there.
+        self.discard(old_id)
+        return
+      if old_id not in self.indexed:
+        return
+      terms, date = self.indexed[old_id]
+      self.discard(old_id)
+      for word, weight in terms.items():
+        self.postings.setdefault(word, {})[new_id] = weight
+      self.indexed[new_id] = (terms, date)
+      if date is not None:
+        bisect.insort(self.by_date, (date, new_id))
+
+  def search(self, query, limit=10, today=None, stream=None):
+    """
+    Ids of the best matches for query, best first. With a stream, only events
+    in that stream count.
+    """
+    words = set(tokenize(query))
+    today = date_key(str(today or datetime.date.today()))
+    with self.lock:
+      scores = None
+      for word in words:
+        postings = self.postings.get(word)
+        if not postings:
+          continue
+        if scores is None:
+          scores = dict(postings)
+        else:
+          for event_id, weight in postings.iteritems():
+            scores[event_id] = scores.get(event_id, 0) + weight
+      if scores and stream is not None:
+        scores = dict((event_id, score) for event_id, score in scores.iteritems()
+                      if EventStore.split_id(event_id)[0] == stream)
+      if not scores:
+        return []
+
+      found = []
+      # Best scores first. There are only a handful of different ones.
+      for score in sorted(set(scores.itervalues()), reverse=True):
+        tied = set(event_id for event_id, other in scores.iteritems() if other == score)
+        found += self.by_when(tied, limit - len(found), today)
+        if len(found) >= limit:
+          break
+      return found
+
+  def by_when(self, event_ids, limit, today):
+    """
+    The first limit of event_ids: upcoming ones soonest first, then past ones
+    most recent first, then undated ones.
+    """
+    # The caller holds the lock.
+    if len(event_ids) * len(event_ids) < len(self.by_date) * limit:
+      # Few enough to just rank them all.
+      indexed = self.indexed
+
+      def when(event_id):
+        date = indexed[event_id][1]
+        if date is None:
+          return (2, 0, event_id)
+        if date >= today:
+          return (0, date, event_id)
+        return (1, -date, event_id)
+
+      return heapq.nsmallest(limit, event_ids, key=when)
+
+    # So many that walking every event by date, picking theirs out, gets to
+    # limit of them sooner.
+    found = []
+    split = bisect.bisect_left(self.by_date, (today,))
+    for _, event_id in itertools.chain(itertools.islice(self.by_date, split, None),
+                                       reversed(self.by_date[:split])):
+      if event_id in event_ids:
+        found.append(event_id)
+        if len(found) == limit:
+          return found
+    undated = sorted(event_id for event_id in event_ids if self.indexed[event_id][1] is None)
+    return found + undated[:limit - len(found)]
+
+  def changed(self, changes):
+    """
+    Brings the index up to date with journal entries, as an RSVP listener.
+    """
+    for change in changes:
+      op = change['op']
+      if op == 'put':
+        self.put(change['id'], change['event'])
+      elif op == 'delete':
+        self.delete(change['id'])
+      elif op == 'rename_topic':
+        self.move(EventStore.join_id(change['stream'], change['old']),
+                  EventStore.join_id(change['stream'], change['new']))
+      elif op == 'rename_stream':
+        with self.lock:
+          old_ids = [event_id for event_id in self.indexed
+                     if EventStore.split_id(event_id)[0] == change['old']]
+        for event_id in old_ids:
+          self.move(event_id, EventStore.join_id(change['new'], EventStore.split_id(event_id)[1]))
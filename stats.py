@@ -0,0 +1,279 @@
+from __future__ import with_statement
+import argparse
+import collections
+import datetime
+import threading
+
+import schema
+from storage import JSONFileStorage
+import store
+from store import EventStore
+
+"""
+
+Attendance numbers for `rsvp stats`: turnout per stream, how often people
+change their minds, which times are popular and how often each person RSVPs.
+
+Counters are kept per stream, per (weekday, hour) slot and per person, and
+moved along as events change: every put takes the event's previous
+contribution back out and adds the new one, so keeping up costs the same
+however many events there are. Attendee lists are never changed in place,
+so an unchanged list is spotted by identity and a new RSVP (a list one
+longer, with the newcomer at the end) with a single comparison done in C.
+
+Every occurrence of a repeating event counts: the past ones it keeps in
+past_occurrences (see recurrence.py) as well as the current one. Rolling an
+event forward empties its attendee lists and archives them, so those people
+move from the current occurrence to a past one rather than disappearing.
+The past occurrences are only counted again when that list changes.
+
+People changing their minds are counted on the events themselves, in
+changed_minds ({'yes-no': 2, ...}), so they survive restarts and a rebuild
+from the store sees them too.
+
+Like the search and schedule indexes, this follows the commit journal as an
+RSVP listener. It is rebuilt from the store in a single pass on start, or
+from the command line, reading events.json one event at a time:
+
+  python stats.py events.json [--stream STREAM]
+
+"""
+
+RESPONSES = ('yes', 'no', 'maybe')
+
+# What an event contributed to the counters: its current occurrence's slot and
+# attendee lists, its changed_minds, and its past_occurrences list along with
+# the (slot, occurrence) of each past occurrence.
+Counted = collections.namedtuple('Counted', 'stream slot lists changed_minds past_occurrences past')
+
+WEEKDAYS = ('Mondays', 'Tuesdays', 'Wednesdays', 'Thursdays', 'Fridays', 'Saturdays', 'Sundays')
+
+
+def slot_of(event):
+  """
+  (weekday, hour) an event happens at, hour None for all day events, or None
+  if it has no date.
+  """
+  if not event.get('date'):
+    return None
+  weekday = datetime.datetime.strptime(event['date'], '%Y-%m-%d').weekday()
+  hour = int(event['time'].split(':')[0]) if event.get('time') else None
+  return weekday, hour
+
+
+def describe_slot(slot):
+  weekday, hour = slot
+  return '%s %s' % (WEEKDAYS[weekday], 'all day' if hour is None else '%02d:00' % hour)
+
+
+def list_change(old, new):
+  """
+  (added, removed) between two versions of an attendee list.
+  """
+  if old is new:
+    return (), ()
+  if len(new) == len(old) + 1 and new[:-1] == old:
+    return (new[-1],), ()
+  old_set, new_set = set(old), set(new)
+  return new_set - old_set, old_set - new_set
+
+
+class AttendanceStats(object):
+
+  def __init__(self, events=None):
+    self.lock = threading.Lock()
+    # stream -> Counter of events, yes, no, maybe and changed minds ('yes-no'...)
+    self.streams = collections.defaultdict(collections.Counter)
+    # stream -> (weekday, hour) -> Counter of events and yes
+    self.slots = collections.defaultdict(lambda: collections.defaultdict(collections.Counter))
+    # name -> Counter of yes, no and maybe
+    self.people = collections.defaultdict(collections.Counter)
+    # event_id -> Counted, as counted.
+    self.counted = {}
+    if events is not None:
+      for event_id in list(events):
+        self.put(event_id, events[event_id])
+
+  def add_occurrence(self, stream, slot, lists, sign):
+    # The caller holds the lock.
+    totals = self.streams[stream]
+    totals['events'] += sign
+    for response in RESPONSES:
+      totals[response] += sign * len(lists[response])
+    if slot is not None:
+      slot_totals = self.slots[stream][slot]
+      slot_totals['events'] += sign
+      slot_totals['yes'] += sign * len(lists['yes'])
+
+  def add_changed_minds(self, stream, changed_minds, sign):
+    # The caller holds the lock.
+    totals = self.streams[stream]
+    for change, count in changed_minds.items():
+      totals[change] += sign * count
+
+  def add_past(self, stream, past, sign):
+    # The caller holds the lock.
+    for slot, occurrence in past:
+      self.add_occurrence(stream, slot, occurrence, sign)
+      self.add_people(occurrence, sign)
+
+  def add_people(self, lists, sign):
+    # The caller holds the lock.
+    for response in RESPONSES:
+      for name in lists[response]:
+        self.people[name][response] += sign
+
+  def add_stream_totals(self, counted, sign):
+    # Everything an event adds to its stream's counters, but not to people's.
+    # The caller holds the lock.
+    self.add_occurrence(counted.stream, counted.slot, counted.lists, sign)
+    self.add_changed_minds(counted.stream, counted.changed_minds, sign)
+    for slot, occurrence in counted.past:
+      self.add_occurrence(counted.stream, slot, occurrence, sign)
+
+  def put(self, event_id, event):
+    stream = EventStore.split_id(event_id)[0]
+    slot = slot_of(event)
+    lists = dict((response, event[response]) for response in RESPONSES)
+    changed_minds = dict(event.get('changed_minds') or {})
+    past_occurrences = event.get('past_occurrences') or []
+    with self.lock:
+      old = self.counted.get(event_id)
+      if old is None:
+        old = Counted(stream, None, dict((response, []) for response in RESPONSES), {}, None, [])
+      else:
+        self.add_occurrence(old.stream, old.slot, old.lists, -1)
+        self.add_changed_minds(old.stream, old.changed_minds, -1)
+
+      self.add_occurrence(stream, slot, lists, 1)
+      self.add_changed_minds(stream, changed_minds, 1)
+      for response in RESPONSES:
+        added, removed = list_change(old.lists[response], lists[response])
+        for name in added:
+          self.people[name][response] += 1
+        for name in removed:
+          self.people[name][response] -= 1
+
+      # Only rolling forward changes past occurrences, and it replaces the list.
+      if past_occurrences is old.past_occurrences:
+        past = old.past
+      else:
+        self.add_past(old.stream, old.past, -1)
+        past = [(slot_of(dict(occurrence, time=event.get('time'))), occurrence)
+                for occurrence in past_occurrences]
+        self.add_past(stream, past, 1)
+      self.counted[event_id] = Counted(stream, slot, lists, changed_minds, past_occurrences, past)
+
+  def delete(self, event_id):
+    with self.lock:
+      old = self.counted.pop(event_id, None)
+      if old:
+        self.add_stream_totals(old, -1)
+        self.add_people(old.lists, -1)
+        for _, occurrence in old.past:
+          self.add_people(occurrence, -1)
+
+  def move(self, old_id, new_id):
+    with self.lock:
+      old = self.counted.pop(old_id, None)
+      if old is None:
+        return
+      stream = EventStore.split_id(new_id)[0]
+      if stream != old.stream:
+        self.add_stream_totals(old, -1)
+        old = old._replace(stream=stream)
+        self.add_stream_totals(old, 1)
+      self.counted[new_id] = old
+
+  def stream_report(self, stream, popular=3):
+    """
+    The numbers `rsvp stats` shows for a stream.
+    """
+    with self.lock:
+      totals = collections.Counter(self.streams.get(stream, {}))
+      slots = sorted(self.slots.get(stream, {}).items(), key=lambda item: (-item[1]['yes'], item[0]))
+    events = totals['events']
+    said_yes = totals['yes'] + totals['yes-no'] + totals['yes-maybe']
+    return {
+      'events': events,
+      'yes': totals['yes'],
+      'no': totals['no'],
+      'maybe': totals['maybe'],
+      'average_yes': float(totals['yes']) / events if events else 0.0,
+      'average_maybe': float(totals['maybe']) / events if events else 0.0,
+      'changed_minds': dict((change, count) for change, count in totals.items() if '-' in change and count),
+      # Of the yeses ever given, how many turned into a no.
+      'yes_to_no_rate': float(totals['yes-no']) / said_yes if said_yes else 0.0,
+      'popular_slots': [(slot, counts['yes'], counts['events']) for slot, counts in slots[:popular] if counts['events']],
+    }
+
+  def person_report(self, name):
+    with self.lock:
+      counts = self.people.get(name, {})
+      return dict((response, counts.get(response, 0)) for response in RESPONSES)
+
+  def changed(self, changes):
+    """
+    Brings the counters up to date with journal entries, as an RSVP listener.
+    """
+    for change in changes:
+      op = change['op']
+      if op == 'put':
+        self.put(change['id'], change['event'])
+      elif op == 'delete':
+        self.delete(change['id'])
+      elif op == 'rename_topic':
+        self.move(EventStore.join_id(change['stream'], change['old']),
+                  EventStore.join_id(change['stream'], change['new']))
+      elif op == 'rename_stream':
+        with self.lock:
+          old_ids = [event_id for event_id in self.counted
+                     if EventStore.split_id(event_id)[0] == change['old']]
+        for event_id in old_ids:
+          self.move(event_id, EventStore.join_id(change['new'], EventStore.split_id(event_id)[1]))
+
+
+def rebuild(storage):
+  """
+  Counts up every event saved in storage (see storage.py), in a single pass.
+  Storages with iter_events() are read one event at a time, so only the
+  counters have to fit in memory, not every event.
+  """
+  if hasattr(storage, 'iter_events'):
+    events = storage.iter_events()
+  else:
+    events = storage.load().iteritems()
+  stats = AttendanceStats()
+  for event_id, event in events:
+    if event_id == store.ALIASES_KEY:
+      continue
+    schema.migrate_event(event_id, event)
+    stats.put(event_id, event)
+  return stats
+
+
+def format_report(stream, report):
+  lines = [
+    '#%s: %d events' % (stream, report['events']),
+    '  turnout: %.1f yes, %.1f maybe per event' % (report['average_yes'], report['average_maybe']),
+    '  yes -> no: %.1f%%' % (report['yes_to_no_rate'] * 100),
+  ]
+  for slot, yes, events in report['popular_slots']:
+    lines.append('  %s: %d yes over %d events' % (describe_slot(slot), yes, events))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Attendance stats from an RSVPBot events file.')
+  parser.add_argument('filename', help='events.json')
+  parser.add_argument('--stream', help='only this stream')
+  args = parser.parse_args()
+
+  stats = rebuild(JSONFileStorage(args.filename))
+  streams = [args.stream] if args.stream else sorted(stats.streams)
+  for stream in streams:
+    print(format_report(stream, stats.stream_report(stream)).encode('utf-8'))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,160 @@
+from __future__ import with_statement
+import io
+import json
+
+"""
+
+Where RSVP keeps its events between runs.
+
+A storage has two methods: load() returns the saved {event_id: event} dict
+(empty if nothing was saved yet) and save(events) replaces it with a new one.
+RSVP loads once when it starts and saves after every commit. Anything with
+those two methods can be passed to RSVP as storage=.
+
+JSONFileStorage is the events.json file the bot has always used. Its
+iter_events() also reads the file one event at a time, for tools that only
+need to look at each event once (see stats.rebuild).
+MemoryStorage keeps everything in memory, for tests and benchmarks that
+don't need the disk: they run faster, and side by side without sharing a
+file. Two RSVPs given the same MemoryStorage see each other's saved events,
+like two given the same file would.
+
+"""
+
+class JSONFileStorage(object):
+  """
+  The whole store as one JSON document, rewritten on every save.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.saves = 0
+
+  def __repr__(self):
+    return 'JSONFileStorage(%r)' % self.filename
+
+  def load(self):
+    try:
+      with open(self.filename, "r") as f:
+        try:
+          return json.load(f)
+        except ValueError:
+          return {}
+    except IOError:
+      return {}
+
+  def save(self, events):
+    with open(self.filename, 'w+') as f:
+      json.dump(events, f)
+    self.saves += 1
+
+  def iter_events(self, chunk_size=65536):
+    """
+    Yields the saved (event_id, event) pairs one by one, decoding the file a
+    chunk at a time instead of all at once. Raises ValueError if the file
+    isn't a JSON object.
+    """
+    try:
+      f = io.open(self.filename, 'r', encoding='utf-8')
+    except IOError:
+      return
+    with f:
+      for pair in JSONObjectReader(f, chunk_size):
+        yield pair
+
+
+class JSONObjectReader(object):
+  """
+  The members of the JSON object in a file, one (key, value) pair at a time.
+  Only the member being decoded is held in memory, not the whole file.
+  """
+
+  def __init__(self, f, chunk_size=65536):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.decoder = json.JSONDecoder()
+    self.buffer = u''
+    self.eof = False
+
+  def more(self):
+    chunk = self.f.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+    self.buffer += chunk
+    return bool(chunk)
+
+  def peek(self):
+    self.buffer = self.buffer.lstrip()
+    while not self.buffer:
+      if not self.more():
+        raise ValueError('Unexpected end of JSON object')
+      self.buffer = self.buffer.lstrip()
+    return self.buffer[0]
+
+  def expect(self, chars):
+    char = self.peek()
+    if char not in chars:
+      raise ValueError('Expected one of %r, found %r' % (chars, char))
+    self.buffer = self.buffer[1:]
+    return char
+
+  def value(self):
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer)
+      except ValueError:
+        # Most likely cut off at the end of the chunk.
+        if not self.more():
+          raise
+        continue
+      # A number right at the end of the chunk may go on in the next one.
+      if end == len(self.buffer) and not self.eof and self.more():
+        continue
+      self.buffer = self.buffer[end:]
+      return value
+
+  def __iter__(self):
+    self.expect('{')
+    if self.peek() == '}':
+      return
+    while True:
+      key = self.value()
+      self.expect(':')
+      yield key, self.value()
+      if self.expect(',}') == '}':
+        return
+
+
+class MemoryStorage(object):
+  """
+  The store as a dict in memory, gone when the process exits.
+
+  Events are copied on the way in and out, so the saved events are not the
+  ones commands go on to change. The copies are one level deep: attendee
+  lists and other values inside an event are never changed in place (see
+  store.py), so they can be shared.
+  """
+
+  def __init__(self, events=None):
+    self.events = {}
+    self.saves = 0
+    if events:
+      self.events = self.copy(events)
+
+  def __repr__(self):
+    return 'MemoryStorage(%d events)' % len(self.events)
+
+  @staticmethod
+  def copy(events):
+    return dict((event_id, dict(event)) for event_id, event in events.items())
+
+  def load(self):
+    return self.copy(self.events)
+
+  def save(self, events):
+    self.events = self.copy(events)
+    self.saves += 1
+
+  def iter_events(self):
+    return self.load().iteritems()
@@ -0,0 +1,381 @@
+import collections
+
+"""
+
+The in-memory event store.
+
+Events are still addressed by their `stream/topic` id everywhere (see
+RSVP.event_id), but they are kept in a two-level stream -> topic -> event index
+so that everything in a stream can be listed or renamed without looking at
+every other event. Renamed streams and topics leave an alias behind, so
+messages that still carry the old name find the event at its new home. Reads
+and writes to existing events alike follow aliases: writing to an old id
+updates the event where it lives now, it doesn't start a second copy under
+the old name. A write that makes a new event goes to the id it was given,
+though, and drops the aliases that id went through (see claim): the old name
+is in use again, by a new thread. Aliases are saved along with the events
+(see dump).
+
+Every recorded change to an event bumps its version and keeps the previous
+version around (up to history_limit of them), which is what `rsvp undo` and
+point-in-time reads use. Versions are shallow copies of the event dict: they
+share the attendee lists with the live event, so commands must never change
+those lists in place. Replace them with a new list instead.
+
+The store also remembers what changed since the last drain_changes() call, so
+RSVP can tell its listeners (e.g. a standby replica) after every commit.
+
+"""
+
+class EventHistory(object):
+  """
+  The current version number of an event, and up to `limit` earlier versions
+  of it as (version, snapshot) pairs. A snapshot of None means the event did
+  not exist at that version.
+  """
+  def __init__(self, limit):
+    self.version = 0
+    self.snapshots = collections.deque(maxlen=limit)
+
+
+# Where dump() puts the aliases, next to the events. Event ids always have a
+# slash in them, so this can't be one.
+ALIASES_KEY = '_aliases'
+
+
+class EventStore(collections.MutableMapping):
+
+  def __init__(self, events=None, history_limit=10):
+    self.streams = {}
+    self.histories = {}
+    self.history_limit = history_limit
+    self.stream_aliases = {}
+    self.topic_aliases = {}
+    self.size = 0
+    self.changes = []
+    if events:
+      events = dict(events)
+      self.load_aliases(events.pop(ALIASES_KEY, None))
+      self.update(events)
+    # Loading isn't a change anyone needs to hear about.
+    self.changes = []
+
+  @staticmethod
+  def split_id(event_id):
+    """
+    Splits an event id into its stream and topic. Topics often contain slashes,
+    so we split on the first one.
+    """
+    stream, _, topic = event_id.partition('/')
+    return stream, topic
+
+  @staticmethod
+  def join_id(stream, topic):
+    return u'{}/{}'.format(stream, topic)
+
+  def resolve(self, stream, topic):
+    """
+    Follows stream and topic aliases until we reach an existing event, or run
+    out of aliases. Returns the (stream, topic) pair to look at.
+    """
+    # Every hop uses up an alias, so we can never need more hops than that.
+    for _ in range(len(self.stream_aliases) + len(self.topic_aliases) + 1):
+      if topic in self.streams.get(stream, ()):
+        break
+      if (stream, topic) in self.topic_aliases:
+        topic = self.topic_aliases[(stream, topic)]
+      elif stream in self.stream_aliases:
+        stream = self.stream_aliases[stream]
+      else:
+        break
+    return stream, topic
+
+  def canonical_id(self, event_id):
+    """
+    The id an event is actually kept under, following aliases.
+    """
+    return self.join_id(*self.resolve(*self.split_id(event_id)))
+
+  def resolve_stream(self, stream):
+    for _ in range(len(self.stream_aliases) + 1):
+      if stream in self.streams or stream not in self.stream_aliases:
+        break
+      stream = self.stream_aliases[stream]
+    return stream
+
+  def __getitem__(self, event_id):
+    stream, topic = self.resolve(*self.split_id(event_id))
+    try:
+      return self.streams[stream][topic]
+    except KeyError:
+      raise KeyError(event_id)
+
+  def __setitem__(self, event_id, event):
+    stream, topic = self.resolve(*self.split_id(event_id))
+    if topic not in self.streams.get(stream, ()):
+      stream, topic = self.claim(event_id)
+      self.size += 1
+    self.streams.setdefault(stream, {})[topic] = event
+    self.changes.append(('put', self.join_id(stream, topic)))
+
+  def claim(self, event_id):
+    """
+    Drops the aliases that would take event_id to another event, so a new
+    event can be made under it, e.g. by `rsvp init` in a new topic named
+    like one renamed earlier. Returns the (stream, topic) of event_id.
+    """
+    stream, topic = self.split_id(event_id)
+    self.topic_aliases.pop((stream, topic), None)
+    if topic not in self.streams.get(stream, ()):
+      # A stream of that name exists again, and it has a new event.
+      self.stream_aliases.pop(stream, None)
+    return stream, topic
+
+  def __delitem__(self, event_id):
+    stream, topic = self.resolve(*self.split_id(event_id))
+    try:
+      topics = self.streams[stream]
+      del topics[topic]
+    except KeyError:
+      raise KeyError(event_id)
+    self.size -= 1
+    if not topics:
+      del self.streams[stream]
+    self.changes.append(('delete', self.join_id(stream, topic)))
+
+  def __iter__(self):
+    for stream, topics in self.streams.items():
+      for topic in topics:
+        yield self.join_id(stream, topic)
+
+  def __len__(self):
+    return self.size
+
+  def stream_events(self, stream):
+    """
+    Returns a {topic: event} dict of every event in a stream.
+    """
+    return dict(self.streams.get(self.resolve_stream(stream), {}))
+
+  def rename_stream(self, old_name, new_name):
+    """
+    Moves every event in old_name over to new_name. Ids using the old name keep
+    working through an alias.
+    """
+    if old_name == new_name:
+      return
+    topics = self.streams.pop(old_name, None)
+    if topics is not None:
+      existing = self.streams.get(new_name)
+      if existing:
+        # Someone made events in the new stream before we heard about the
+        # rename. Keep theirs, they are more recent.
+        self.size -= len(set(topics) & set(existing))
+        topics.update(existing)
+      self.streams[new_name] = topics
+
+    histories = self.histories.pop(old_name, None)
+    if histories is not None:
+      histories.update(self.histories.get(new_name, {}))
+      self.histories[new_name] = histories
+
+    self.stream_aliases.pop(new_name, None)
+    self.stream_aliases[old_name] = new_name
+    self.changes.append(('rename_stream', old_name, new_name))
+
+  def rename_topic(self, stream, old_topic, new_topic):
+    """
+    Moves the event in stream/old_topic over to stream/new_topic, leaving an
+    alias behind. Does nothing if there is no event there.
+    """
+    stream, old_topic = self.resolve(stream, old_topic)
+    topics = self.streams.get(stream, {})
+    if old_topic == new_topic or old_topic not in topics or new_topic in topics:
+      return
+
+    event = topics.pop(old_topic)
+    topics[new_topic] = event
+    histories = self.histories.get(stream, {})
+    if old_topic in histories:
+      histories[new_topic] = histories.pop(old_topic)
+    if event.get('name') == old_topic:
+      event['name'] = new_topic
+      self.history(self.join_id(stream, new_topic), create=True).version += 1
+    self.topic_aliases.pop((stream, new_topic), None)
+    self.topic_aliases[(stream, old_topic)] = new_topic
+    self.changes.append(('rename_topic', stream, old_topic, new_topic))
+
+  def move(self, old_id, new_id):
+    """
+    Moves an event, and its history, to another id. Unlike renames, this
+    leaves no alias: the old thread is no longer an event.
+    """
+    old_stream, old_topic = self.resolve(*self.split_id(old_id))
+    self[new_id] = self.pop(old_id)
+    history = self.histories.get(old_stream, {}).pop(old_topic, None)
+    if history is not None:
+      new_stream, new_topic = self.split_id(new_id)
+      self.histories.setdefault(new_stream, {})[new_topic] = history
+
+  def history(self, event_id, create=False):
+    """
+    The EventHistory of an event, or None if nothing was ever recorded for it.
+    Histories outlive their events, so a canceled event can be brought back.
+    """
+    stream, topic = self.resolve(*self.split_id(event_id))
+    if create:
+      return self.histories.setdefault(stream, {}).setdefault(topic, EventHistory(self.history_limit))
+    return self.histories.get(stream, {}).get(topic)
+
+  def version(self, event_id):
+    history = self.history(event_id)
+    return history.version if history else 0
+
+  def snapshot(self, event_id):
+    """
+    A consistent copy of the current version of an event (or None), safe to
+    read while commands keep changing the live event.
+    """
+    event = self.get(event_id)
+    if event is None:
+      return None
+    return dict(event)
+
+  def at(self, event_id, version):
+    """
+    The event as it was at the given version, or None if that version is too
+    old to still be around (or the event didn't exist then).
+    """
+    history = self.history(event_id)
+    if history is None or version == history.version:
+      return self.snapshot(event_id)
+    for old_version, snapshot in history.snapshots:
+      if old_version == version:
+        return snapshot
+    return None
+
+  def record(self, event_id, before):
+    """
+    Called after a command ran, with the snapshot taken before it ran. If the
+    event changed, the old version is kept and the version number bumped.
+    Returns whether anything changed.
+    """
+    # The attendee lists are shared between versions, so this is cheap.
+    if before == self.get(event_id):
+      return False
+    history = self.history(event_id, create=True)
+    history.snapshots.append((history.version, before))
+    history.version += 1
+    self.changes.append(('put', self.canonical_id(event_id)))
+    return True
+
+  def last_snapshot(self, event_id):
+    history = self.history(event_id)
+    return history.snapshots[-1][1]
+
+  def can_undo(self, event_id):
+    history = self.history(event_id)
+    return bool(history and history.snapshots)
+
+  def undo(self, event_id, keep=()):
+    """
+    Puts the previous version of an event back in place, keeping the event
+    dict itself so anyone holding on to it sees the change.
+
+    Fields named in keep stay as they are now, if there is an event now.
+    """
+    history = self.history(event_id)
+    _, snapshot = history.snapshots.pop()
+    event = self.get(event_id)
+
+    if snapshot is not None and event is not None:
+      snapshot = dict(snapshot)
+      for key in keep:
+        if key in event:
+          snapshot[key] = event[key]
+
+    if snapshot is None:
+      del self[event_id]
+    elif event is None:
+      self[event_id] = dict(snapshot)
+    else:
+      event.clear()
+      event.update(snapshot)
+      self.changes.append(('put', self.canonical_id(event_id)))
+
+    history.version += 1
+
+  def drain_changes(self):
+    """
+    Returns what changed since the last call, in order, as journal entries:
+      {'op': 'put', 'id': event_id, 'event': snapshot}
+      {'op': 'delete', 'id': event_id}
+      {'op': 'rename_stream', 'old': old_name, 'new': new_name}
+      {'op': 'rename_topic', 'stream': stream, 'old': old_topic, 'new': new_topic}
+    Puts carry the event as it is now, so replaying them is idempotent.
+    """
+    changes, self.changes = self.changes, []
+    entries = []
+    previous = None
+
+    for change in changes:
+      if change == previous:
+        continue
+      previous = change
+
+      op = change[0]
+      if op in ('put', 'delete'):
+        event = self.snapshot(change[1])
+        if event is None:
+          entries.append({'op': 'delete', 'id': change[1]})
+        else:
+          entries.append({'op': 'put', 'id': change[1], 'event': event})
+      elif op == 'rename_stream':
+        entries.append({'op': op, 'old': change[1], 'new': change[2]})
+      elif op == 'rename_topic':
+        entries.append({'op': op, 'stream': change[1], 'old': change[2], 'new': change[3]})
+
+    return entries
+
+  def apply(self, entry):
+    """
+    Replays a journal entry made by drain_changes() on another store.
+    """
+    op = entry['op']
+    if op == 'put':
+      self[entry['id']] = entry['event']
+    elif op == 'delete':
+      self.pop(entry['id'], None)
+    elif op == 'rename_stream':
+      self.rename_stream(entry['old'], entry['new'])
+    elif op == 'rename_topic':
+      self.rename_topic(entry['stream'], entry['old'], entry['new'])
+
+  def to_dict(self):
+    """
+    A flat {event_id: event} dict of every event.
+    """
+    return dict(
+      (self.join_id(stream, topic), event)
+      for stream, topics in self.streams.items()
+      for topic, event in topics.items()
+    )
+
+  def dump(self):
+    """
+    What is written to disk: to_dict(), and the aliases under ALIASES_KEY if
+    there are any. EventStore(store.dump()) is the same store again, minus
+    its history.
+    """
+    events = self.to_dict()
+    if self.stream_aliases or self.topic_aliases:
+      events[ALIASES_KEY] = {
+        'streams': dict(self.stream_aliases),
+        'topics': [[stream, old, new] for (stream, old), new in self.topic_aliases.items()],
+      }
+    return events
+
+  def load_aliases(self, aliases):
+    if aliases:
+      self.stream_aliases.update(aliases.get('streams', {}))
+      self.topic_aliases.update(((stream, old), new) for stream, old, new in aliases.get('topics', []))
@@ -6,14 +6,31 @@ MSG_STRING_ATTR_SET            = "The %s for this event has been set to **%s**!\
 MSG_ATTENDANCE_LIMIT_SET       = "The attendance limit for this event has been set to **%d**! Hurry up and `rsvp yes` now!.\n`rsvp help` for more options"
 MSG_EVENT_CANCELED             = "The event has been canceled!"
 MSG_EVENT_MOVED                = "This event has been moved to [%s](%s)!"
+MSG_SUMMARY_UNPINNED           = "The summary for this event will no longer be kept up to date."
+MSG_UNDONE                     = "The last change to this event has been undone."
+MSG_COMMANDS_RELOADED          = "Reloaded %d commands."
+MSG_DURATION_SET               = 'This event now lasts **%d:%02d**.\n`rsvp help` for more options.'
+MSG_SCHEDULE_CONFLICT          = "Heads up, @**%s**: you also said yes to %s, at the same time."
+MSG_SEARCH_RESULTS             = "Events in this stream matching **%s**:"
+MSG_NO_SEARCH_RESULTS          = "No events in this stream match **%s**."
+MSG_REPEAT_SET                 = "This event now repeats **%s**. Once an occurrence is over, RSVPs start over for the next one."
+MSG_REPEAT_OFF                 = "This event no longer repeats."
+MSG_BUSY                       = "I'm a bit swamped right now! I'll get to your `rsvp` shortly."
 
 ERROR_INVALID_COMMAND          = "`%s` is not a valid RSVPBot command! Type `rsvp help` for the correct syntax."
 ERROR_NOT_AN_EVENT             = "This thread is not an RSVPBot event!. Type `rsvp init` to make it into an event."
 ERROR_NOT_AUTHORIZED_TO_DELETE = "Oops! You cannot cancel this event! Only the event's original creator can do so."
+ERROR_NOT_AUTHORIZED_TO_UNDO   = "Oops! Only the event's original creator can undo changes to it."
+ERROR_RELOAD_FAILED            = "Oops! Reloading the commands failed, so I'm sticking with the old ones: %s"
+ERROR_NOTHING_TO_UNDO          = "Oops! There's nothing left to undo for this event."
 ERROR_ALREADY_AN_EVENT         = "Oops! This thread is already an RSVPBot event!"
 ERROR_TIME_NOT_VALID           = "Oops! **%02d:%02d** is not a valid time!"
+ERROR_DURATION_NOT_VALID       = "Oops! **%d:%02d** is not a valid duration!"
 ERROR_DATE_NOT_VALID           = "Oops! **%02d/%02d/%04d** is not a valid date in the **future**!"
+ERROR_REPEAT_NEEDS_DATE        = "Oops! A repeating event needs a date. `rsvp set date mm/dd/yyyy` first."
 ERROR_LIMIT_REACHED            = "Oh no! The **limit** for this event has been reached!"
+ERROR_AMBIGUOUS_DECISION       = "Oops! Is that a yes, a no or a maybe? Please `rsvp` again with just one of them."
+ERROR_TOO_BUSY                 = "Oh no! I'm too swamped to get to your `rsvp` at all. Please try again in a minute."
 ERROR_MISSING_MOVE_DESTINATION = "`rsvp move` requires a Zulip stream URL destination (e.g. 'https://zulip.com/#narrow/stream/announce/topic/All.20Hands.20Meeting')"
 ERROR_BAD_MOVE_DESTINATION     = "`%s` is not a valid move destination URL!`rsvp move` requires a Zulip stream URL destination (e.g. 'https://zulip.com/#narrow/stream/announce/topic/All.20Hands.20Meeting') Type `rsvp help` for the correct syntax."
 ERROR_MOVE_ALREADY_AN_EVENT    = "Oops! `%s` is already an RSVPBot event!"
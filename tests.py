@@ -1,25 +1,55 @@
 import unittest
 import rsvp
+import commands
 import os
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
 import datetime
 from collections import Counter
 
+import bot
+import calendar_feed
+import aggregate
+import schema
+import ingress
+import tracing
+import realms
+import cache
+import benchmarks
+import pinned_summary
+import recurrence
+import schedule
+import ratelimit
+import outbox
+import search
+import stats
+import storage
+import user_groups
+from debounce import Debouncer, Scheduler
+import loadtest
+import replication
+from fake_zulip import FakeZulipServer
+from store import EventStore
+
 def testRSVP():
-    return rsvp.RSVP(filename='test.json')
+    return rsvp.RSVP(storage=storage.MemoryStorage())
 
 class RSVPTest(unittest.TestCase):
 
     def setUp(self):
-        self.rsvp = rsvp.RSVP('rsvp', filename='test.json')
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
         self.issue_command('rsvp init')
         self.event = self.get_test_event()
 
-    def tearDown(self):
-        try:
-            os.remove('test.json')
-        except OSError:
-            pass
-
     def create_input_message(self, content='', sender_full_name='Tester', subject='Testing', display_recipient='test-stream', sender_id='12345', message_type='stream', sender_email='a@example.com'):
         return {
             'content': content,
@@ -176,6 +206,27 @@ class RSVPTest(unittest.TestCase):
         count_dict = Counter(self.event['maybe'])
         self.assertEqual(0, count_dict['Tester'])
 
+    def test_read_only_commands_do_not_commit(self):
+        commits = self.rsvp.commits
+        saves = self.rsvp.storage.saves
+        for command in ('rsvp help', 'rsvp summary', 'rsvp status', 'rsvp ping', 'rsvp credits'):
+            self.issue_command(command)
+        self.assertEqual(commits, self.rsvp.commits)
+        self.assertEqual(saves, self.rsvp.storage.saves)
+
+        self.issue_command('rsvp yes')
+        self.assertEqual(commits + 1, self.rsvp.commits)
+
+    def test_read_only_commands_see_a_snapshot(self):
+        class Meddling(commands.RSVPSummaryCommand):
+            def run(self, events, *args, **kwargs):
+                kwargs['event']['name'] = 'Changed'
+                return commands.RSVPSummaryCommand.run(self, events, *args, **kwargs)
+
+        self.rsvp.command_list = (Meddling('rsvp'),) + self.rsvp.command_list
+        self.issue_command('rsvp summary')
+        self.assertEqual('Testing', self.get_test_event()['name'])
+
     def test_set_limit(self):
         output = self.issue_command('rsvp set limit 1')
 
@@ -452,11 +503,2186 @@ class RSVPTest(unittest.TestCase):
         self.assertEqual('private', output[0]['type'])
         self.assertEqual('a@example.com', output[0]['sender_email'])
 
+    def test_undo_rsvp(self):
+        self.issue_command('rsvp yes')
+        output = self.issue_command('rsvp undo')
+        self.assertIn('has been undone', output[0]['body'])
+        self.assertNotIn('Tester', self.event['yes'])
+
+    def test_undo_cancel(self):
+        self.issue_command('rsvp set place Hopper!')
+        self.issue_command('rsvp cancel')
+        self.issue_command('rsvp undo')
+        self.assertEqual('Hopper!', self.get_test_event()['place'])
+
+    def test_undo_init(self):
+        self.issue_command('rsvp undo')
+        self.assertNotIn('test-stream/Testing', self.rsvp.events)
+        output = self.issue_command('rsvp undo')
+        self.assertIn('is not an RSVPBot event', output[0]['body'])
+
+    def test_undo_only_by_creator(self):
+        self.issue_custom_command('rsvp yes', sender_full_name='A', sender_id='6789')
+        output = self.issue_custom_command('rsvp undo', sender_id='6789')
+        self.assertIn('Only the event\'s original creator', output[0]['body'])
+        self.assertIn('A', self.event['yes'])
+
+    def test_nothing_left_to_undo(self):
+        # History is only kept in memory, so nothing survives a restart.
+        self.rsvp = rsvp.RSVP('rsvp', storage=self.rsvp.storage)
+        output = self.issue_command('rsvp undo')
+        self.assertIn('nothing left to undo', output[0]['body'])
+
+    def test_read_only_commands_do_not_create_versions(self):
+        version = self.rsvp.events.version('test-stream/Testing')
+        self.issue_command('rsvp summary')
+        self.issue_command('rsvp yes')
+        self.issue_command('rsvp yes')
+        self.assertEqual(version + 1, self.rsvp.events.version('test-stream/Testing'))
+
+    def test_pin_summary(self):
+        output = self.issue_command('rsvp summary pin')
+        self.assertEqual('test-stream/Testing', output[0]['pin'])
+        self.assertIn('**Where**|N/A', output[0]['body'])
+        self.assertTrue(self.event['pinned_summary'])
+
+        output = self.issue_command('rsvp summary unpin')
+        self.assertNotIn('pin', output[0])
+        self.assertFalse(self.event['pinned_summary'])
+
+    def test_rsvp_after_stream_rename(self):
+        self.rsvp.rename_stream('test-stream', 'renamed-stream')
+        self.issue_command('rsvp yes')
+        self.assertIn('Tester', self.rsvp.events['renamed-stream/Testing']['yes'])
+
+        output = self.issue_custom_command('rsvp summary', display_recipient='renamed-stream')
+        self.assertIn('Tester', output[0]['body'])
+
+        # Still one event, saved and indexed once, under its new name.
+        self.assertEqual(['renamed-stream/Testing'], list(EventStore(self.rsvp.storage.load())))
+        self.assertEqual(1, self.rsvp.stats.stream_report('renamed-stream')['yes'])
+        self.assertEqual(0, self.rsvp.stats.stream_report('test-stream')['events'])
+
+    def test_changes_from_other_threads_wait_their_turn(self):
+        class Overlaps(storage.MemoryStorage):
+            saving = 0
+            overlaps = 0
+
+            def save(self, events):
+                self.saving += 1
+                if self.saving > 1:
+                    self.overlaps += 1
+                time.sleep(0.001)
+                storage.MemoryStorage.save(self, events)
+                self.saving -= 1
+
+        self.rsvp = rsvp.RSVP('rsvp', storage=Overlaps())
+        self.issue_command('rsvp init')
+
+        # Group syncs run on a debouncer thread, pinned summary ids are set
+        # by the outbox thread.
+        def sync():
+            for idx in range(50):
+                self.rsvp.set_user_group('test-stream/Testing', {'id': idx, 'name': 'g', 'members': []})
+
+        def pin():
+            for idx in range(50):
+                self.rsvp.set_summary_message('test-stream/Testing', idx)
+        threads = [threading.Thread(target=sync), threading.Thread(target=pin)]
+        for thread in threads:
+            thread.start()
+        for idx in range(50):
+            self.issue_command('rsvp yes' if idx % 2 else 'rsvp no')
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(0, self.rsvp.storage.overlaps)
+        saved = self.rsvp.storage.load()['test-stream/Testing']
+        self.assertEqual((49, 49), (saved['user_group']['id'], saved['summary_message_id']))
+
+    def test_rsvp_after_topic_rename(self):
+        self.rsvp.rename_topic('test-stream', 'Testing', 'Renamed')
+        self.issue_command('rsvp yes')
+        self.assertEqual(['test-stream/Renamed'], list(EventStore(self.rsvp.storage.load())))
+        self.assertIn('Tester', self.rsvp.events['test-stream/Renamed']['yes'])
+        self.assertEqual(['test-stream/Renamed'], self.rsvp.search.search('renamed'))
+
+    def test_renames_are_remembered_after_a_restart(self):
+        self.rsvp.rename_stream('test-stream', 'renamed-stream')
+        self.rsvp.rename_topic('renamed-stream', 'Testing', 'Renamed')
+        self.rsvp = rsvp.RSVP('rsvp', storage=self.rsvp.storage)
+        self.issue_command('rsvp yes')
+        self.assertIn('Tester', self.rsvp.events['renamed-stream/Renamed']['yes'])
+        self.assertEqual(1, len(self.rsvp.events))
+
+    def test_init_under_a_renamed_topics_old_name(self):
+        self.rsvp.rename_topic('test-stream', 'Testing', 'Renamed')
+        self.issue_command('rsvp yes')
+        output = self.issue_command('rsvp init')
+        self.assertIn('now an RSVPBot event', output[0]['body'])
+        self.issue_command('rsvp maybe')
+
+        self.assertEqual(['Tester'], self.rsvp.events['test-stream/Renamed']['yes'])
+        self.assertEqual(['Tester'], self.rsvp.events['test-stream/Testing']['maybe'])
+        self.assertEqual([], self.rsvp.events['test-stream/Testing']['yes'])
+        self.assertEqual(set(['test-stream/Testing', 'test-stream/Renamed']), set(self.rsvp.storage.load()))
+
     def test_rsvp_stream_message(self):
         output = self.issue_custom_command('rsvp yes', message_type='stream')
         self.assertEqual('stream', output[0]['type'])
         self.assertEqual('test-stream', output[0]['display_recipient'])
 
+class SchemaMigrationTest(unittest.TestCase):
+
+    LEGACY_EVENT = {
+        'name': 'Testing', 'description': None, 'place': None, 'creator': '12345',
+        'yes': ['Ada'], 'no': [], 'time': None, 'date': '2015-01-01',
+    }
+
+    def setUp(self):
+        self.storage = storage.MemoryStorage({'test-stream/Testing': self.LEGACY_EVENT})
+
+    def issue(self, instance, content):
+        return instance.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def test_legacy_events_are_migrated_on_load(self):
+        event = rsvp.RSVP('rsvp', storage=self.storage).events['test-stream/Testing']
+        self.assertEqual(schema.SCHEMA_VERSION, event['schema_version'])
+        self.assertEqual([], event['maybe'])
+        self.assertEqual(None, event['limit'])
+        self.assertEqual(['Ada'], event['yes'])
+
+    def test_migration_is_written_back(self):
+        rsvp.RSVP('rsvp', storage=self.storage)
+        event = self.storage.load()['test-stream/Testing']
+        self.assertEqual(schema.SCHEMA_VERSION, event['schema_version'])
+
+    def test_commands_work_on_migrated_events(self):
+        instance = rsvp.RSVP('rsvp', storage=self.storage)
+        self.assertIn('might be attending', self.issue(instance, 'rsvp maybe')[0]['body'])
+        self.assertIn('MAYBE(1)', self.issue(instance, 'rsvp summary')[0]['body'])
+
+    def test_new_events_are_stamped(self):
+        instance = rsvp.RSVP('rsvp', storage=self.storage)
+        instance.process_message({
+            'content': 'rsvp init', 'subject': 'New', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+        self.assertEqual(schema.SCHEMA_VERSION, instance.events['test-stream/New']['schema_version'])
+
+    def test_migrating_twice_does_nothing(self):
+        events = {'test-stream/Testing': dict(self.LEGACY_EVENT)}
+        self.assertEqual(1, schema.migrate(events))
+        self.assertEqual(0, schema.migrate(events))
+
+
+class RSVPConfirmScanTest(unittest.TestCase):
+
+    def test_decision_past_scan_limit_is_ignored(self):
+        confirm = commands.RSVPConfirmCommand('rsvp', max_scan_length=20)
+        self.assertIsNone(confirm.match('rsvp ' + 'blah ' * 10 + 'yes'))
+        self.assertEqual('yes', confirm.match('rsvp blah yes').groupdict()['decision'])
+
+    def test_word_cut_by_scan_limit_is_not_a_decision(self):
+        confirm = commands.RSVPConfirmCommand('rsvp', max_scan_length=3)
+        self.assertIsNone(confirm.match('rsvp yesterday'))
+        self.assertIsNotNone(confirm.match('rsvp yes!'))
+
+    def test_ambiguous_decisions_keep_first_by_default(self):
+        groups = commands.RSVPConfirmCommand('rsvp').match('rsvp yes no').groupdict()
+        self.assertEqual('yes', groups['decision'])
+        self.assertFalse(groups['ambiguous'])
+
+    def test_ambiguous_decisions_can_be_rejected(self):
+        confirm = commands.RSVPConfirmCommand('rsvp', ambiguous='reject')
+        groups = confirm.match('rsvp yes, no, maybe').groupdict()
+        self.assertTrue(groups['ambiguous'])
+        self.assertFalse(confirm.match('rsvp yes yes!').groupdict()['ambiguous'])
+
+        event = {'limit': None, 'yes': [], 'no': [], 'maybe': []}
+        response = confirm.execute({'e': event}, event=event, event_id='e', sender_full_name='A', **groups)
+        self.assertIn('Is that a yes, a no or a maybe?', response.messages[0].body)
+        self.assertEqual([], event['yes'])
+
+    def test_unknown_ambiguous_setting_is_refused(self):
+        self.assertRaises(ValueError, commands.RSVPConfirmCommand, 'rsvp', ambiguous='rejct')
+        self.assertRaises(ValueError, rsvp.RSVP, 'rsvp', storage=storage.MemoryStorage(), ambiguous='First')
+
+    def test_rsvp_passes_its_options_on(self):
+        instance = rsvp.RSVP('rsvp', storage=storage.MemoryStorage(), ambiguous='reject', max_scan_length=50)
+        instance.reload_commands()
+        confirm = instance.command_list[-1]
+        self.assertEqual(('reject', 50), (confirm.ambiguous, confirm.max_scan_length))
+
+        message = {
+            'content': 'rsvp init', 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }
+        instance.process_message(message)
+        output = instance.process_message(dict(message, content='rsvp yes no'))
+        self.assertIn('Is that a yes, a no or a maybe?', output[0]['body'])
+
+
+class EventStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = EventStore({
+            'stream-a/lunch': {'name': 'lunch'},
+            'stream-a/dinner/late': {'name': 'dinner/late'},
+            'stream-b/lunch': {'name': 'lunch'},
+        })
+
+    def test_ids_split_on_first_slash(self):
+        self.assertEqual({'name': 'dinner/late'}, self.store['stream-a/dinner/late'])
+        self.assertEqual(3, len(self.store))
+        self.assertEqual(set(['stream-a/lunch', 'stream-a/dinner/late', 'stream-b/lunch']), set(self.store))
+
+    def test_stream_events(self):
+        self.assertEqual(set(['lunch', 'dinner/late']), set(self.store.stream_events('stream-a')))
+        self.assertEqual({}, self.store.stream_events('nope'))
+
+    def test_rename_stream_moves_events_and_keeps_old_ids_working(self):
+        lunch = self.store['stream-a/lunch']
+        self.store.rename_stream('stream-a', 'stream-c')
+
+        self.assertIs(lunch, self.store['stream-c/lunch'])
+        self.assertIs(lunch, self.store['stream-a/lunch'])
+        self.assertNotIn('stream-a/lunch', set(self.store))
+        self.assertEqual(set(['lunch', 'dinner/late']), set(self.store.stream_events('stream-a')))
+        self.assertEqual(3, len(self.store))
+
+    def test_rename_stream_onto_existing_stream(self):
+        self.store.rename_stream('stream-a', 'stream-b')
+        self.assertEqual(2, len(self.store))
+        self.assertEqual(set(['lunch', 'dinner/late']), set(self.store.stream_events('stream-b')))
+
+    def test_rename_topic_redirects_old_id(self):
+        self.store.rename_topic('stream-a', 'lunch', 'brunch')
+        self.assertEqual('brunch', self.store['stream-a/brunch']['name'])
+        self.assertIs(self.store['stream-a/brunch'], self.store['stream-a/lunch'])
+
+        # Writes follow the redirect too, instead of making a second event.
+        self.store['stream-a/lunch'] = {'name': 'brunch', 'yes': ['A']}
+        self.assertEqual(['A'], self.store['stream-a/brunch']['yes'])
+        self.assertEqual(set(['stream-a/brunch', 'stream-a/dinner/late', 'stream-b/lunch']),
+                         set(self.store.to_dict()))
+        self.assertEqual(3, len(self.store))
+        self.assertEqual([{'op': 'put', 'id': 'stream-a/brunch', 'event': {'name': 'brunch', 'yes': ['A']}}],
+                         self.store.drain_changes()[1:])
+
+    def test_new_event_under_an_old_name_drops_the_alias(self):
+        self.store.rename_stream('stream-b', 'stream-c')
+        self.store.rename_topic('stream-a', 'lunch', 'brunch')
+        # An existing event is reached through the alias unless the id is claimed.
+        self.store.claim('stream-a/lunch')
+        self.store['stream-a/lunch'] = {'name': 'second lunch'}
+        # No event there: a new one goes to the id it was given.
+        self.store['stream-b/tea'] = {'name': 'tea'}
+
+        self.assertEqual('brunch', self.store['stream-a/brunch']['name'])
+        self.assertEqual('second lunch', self.store['stream-a/lunch']['name'])
+        self.assertEqual('tea', self.store['stream-b/tea']['name'])
+        self.assertNotIn('stream-b/lunch', self.store)
+        self.assertEqual(5, len(self.store))
+
+    def test_aliases_are_dumped_with_the_events(self):
+        self.store.rename_stream('stream-b', 'stream-c')
+        self.store.rename_topic('stream-a', 'lunch', 'brunch')
+        dumped = json.loads(json.dumps(self.store.dump()))
+        loaded = EventStore(dumped)
+
+        self.assertEqual(self.store.to_dict(), loaded.to_dict())
+        self.assertEqual('brunch', loaded['stream-a/lunch']['name'])
+        self.assertIs(loaded['stream-c/lunch'], loaded['stream-b/lunch'])
+        self.assertEqual(3, len(loaded))
+
+    def test_delete_through_alias(self):
+        self.store.rename_stream('stream-b', 'stream-c')
+        del self.store['stream-b/lunch']
+        self.assertNotIn('stream-c/lunch', self.store)
+        self.assertEqual(2, len(self.store))
+
+
+class EventStoreHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = EventStore(history_limit=3)
+        self.store['s/t'] = {'yes': []}
+
+    def change(self, **fields):
+        before = self.store.snapshot('s/t')
+        self.store['s/t'].update(fields)
+        return self.store.record('s/t', before)
+
+    def test_snapshots_are_isolated_from_later_changes(self):
+        snapshot = self.store.snapshot('s/t')
+        self.change(yes=['A'])
+        self.assertEqual([], snapshot['yes'])
+        self.assertEqual(['A'], self.store['s/t']['yes'])
+
+    def test_unchanged_events_keep_their_version(self):
+        self.assertFalse(self.change())
+        self.assertEqual(0, self.store.version('s/t'))
+
+    def test_point_in_time_reads(self):
+        self.change(yes=['A'])
+        self.change(yes=['A', 'B'])
+        self.assertEqual([], self.store.at('s/t', 0)['yes'])
+        self.assertEqual(['A'], self.store.at('s/t', 1)['yes'])
+        self.assertEqual(['A', 'B'], self.store.at('s/t', 2)['yes'])
+
+    def test_undo_keeps_fields_asked_for(self):
+        self.change(yes=['A'], group=1)
+        self.change(group=2)
+        self.change(yes=['A', 'B'])
+        self.store.undo('s/t', keep=('group',))
+        self.assertEqual({'yes': ['A'], 'group': 2}, self.store['s/t'])
+
+    def test_history_is_capped(self):
+        for idx in range(5):
+            self.change(yes=[str(idx)])
+        self.assertEqual(3, len(self.store.history('s/t').snapshots))
+        self.assertIsNone(self.store.at('s/t', 0))
+
+    def test_undo_keeps_event_identity(self):
+        event = self.store['s/t']
+        self.change(yes=['A'])
+        self.store.undo('s/t')
+        self.assertIs(event, self.store['s/t'])
+        self.assertEqual([], event['yes'])
+
+    def test_history_follows_renames(self):
+        self.change(yes=['A'])
+        self.store.rename_stream('s', 'r')
+        self.store.undo('r/t')
+        self.assertEqual([], self.store['r/t']['yes'])
+
+
+PRIMARY_SCRIPT = """
+import sys
+import replication
+import rsvp
+
+def message(content, sender):
+    return {
+        'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+        'sender_id': sender, 'sender_full_name': sender, 'sender_email': 'a@example.com', 'type': 'stream',
+    }
+
+primary = rsvp.RSVP('rsvp', filename=sys.argv[1])
+replication.JournalPublisher('127.0.0.1', int(sys.argv[2])).attach(primary)
+primary.process_message(message('rsvp init', 'creator'))
+
+idx = 0
+while True:
+    name = 'user-%d' % idx
+    primary.process_message(message('rsvp yes', name))
+    # The reply has been handed back: this RSVP is acknowledged.
+    sys.stdout.write(name + '\\n')
+    sys.stdout.flush()
+    idx += 1
+"""
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.takeovers = []
+        self.standby = replication.Standby(
+            filename=os.path.join(self.workdir, 'standby.json'),
+            failover_timeout=0.2,
+            on_takeover=self.takeovers.append,
+        ).start()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_no_acknowledged_rsvp_is_lost_when_primary_dies(self):
+        primary = subprocess.Popen(
+            [sys.executable, '-c', PRIMARY_SCRIPT, os.path.join(self.workdir, 'primary.json'), str(self.standby.address[1])],
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+
+        acknowledged = []
+        while len(acknowledged) < 200:
+            acknowledged.append(primary.stdout.readline().strip())
+        os.kill(primary.pid, signal.SIGKILL)
+        acknowledged.extend(line.strip() for line in primary.stdout.readlines())
+        primary.wait()
+
+        self.assertTrue(self.standby.took_over.wait(5))
+        event = self.takeovers[0]['test-stream/Testing']
+        self.assertEqual([], [name for name in acknowledged if name not in event['yes']])
+
+        with open(os.path.join(self.workdir, 'standby.json')) as f:
+            self.assertEqual(event['yes'], json.load(f)['test-stream/Testing']['yes'])
+
+    def message(self, content):
+        return {
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '1', 'sender_full_name': 'A', 'sender_email': 'a@example.com', 'type': 'stream',
+        }
+
+    def test_primary_keeps_going_without_standby(self):
+        primary = rsvp.RSVP('rsvp', filename=os.path.join(self.workdir, 'primary.json'))
+        publisher = replication.JournalPublisher('127.0.0.1', 1, timeout=0.1).attach(primary)
+        try:
+            output = primary.process_message(self.message('rsvp init'))
+        finally:
+            publisher.stop()
+        self.assertIn('now an RSVPBot event', output[0]['body'])
+
+    def test_slow_standby_doesnt_hold_up_other_changes(self):
+        # Accepts the connection but never acknowledges anything.
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        primary = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        publisher = replication.JournalPublisher('127.0.0.1', silent.getsockname()[1], timeout=1).attach(primary)
+        try:
+            replies = []
+            thread = threading.Thread(target=lambda: replies.extend(primary.process_message(self.message('rsvp init'))))
+            thread.start()
+            self.assertTrue(loadtest.wait_for(lambda: publisher.queued == 2))
+
+            started = time.time()
+            primary.set_summary_message('test-stream/Testing', 1)
+            self.assertTrue(time.time() - started < 0.5)
+            # The reply itself waited for the standby.
+            self.assertEqual([], replies)
+            thread.join()
+            self.assertIn('now an RSVPBot event', replies[0]['body'])
+        finally:
+            publisher.stop()
+            silent.close()
+
+    def test_takeover_saves_to_storage(self):
+        saved = storage.MemoryStorage()
+        standby = replication.Standby(failover_timeout=0.2, storage=saved).start()
+        primary = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        publisher = replication.JournalPublisher('127.0.0.1', standby.address[1]).attach(primary)
+        primary.process_message(self.message('rsvp init'))
+        primary.process_message(self.message('rsvp yes'))
+        publisher.stop()
+
+        self.assertTrue(standby.took_over.wait(5))
+        self.assertEqual(['A'], saved.load()['test-stream/Testing']['yes'])
+
+
+class CalendarFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        self.server = calendar_feed.CalendarFeedServer(self.rsvp).start()
+        for subject in ('Lunch', 'Dinner'):
+            self.issue('rsvp init', subject)
+        self.issue('rsvp set date 02/25/2100', 'Lunch')
+        self.issue('rsvp set time 12:30', 'Lunch')
+        self.issue('rsvp set place Hopper, 4th floor', 'Lunch')
+        self.issue('rsvp yes', 'Lunch', sender_full_name='Ada Lovelace')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def issue(self, content, subject, sender_full_name='Tester', instance=None):
+        return (instance or self.rsvp).process_message({
+            'content': content, 'subject': subject, 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': sender_full_name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def get(self, path, etag=None, token=None):
+        if token is None:
+            token = calendar_feed.feed_token(self.server.secret, urllib.unquote(path).decode('utf-8'))
+        request = urllib2.Request(self.server.url + path + '?token=' + token)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        try:
+            response = urllib2.urlopen(request)
+            return response.getcode(), response.info().getheader('ETag'), response.read()
+        except urllib2.HTTPError as error:
+            return error.code, error.info().getheader('ETag'), None
+
+    def test_stream_feed(self):
+        status, _, body = self.get('/streams/test-stream.ics')
+        self.assertEqual(200, status)
+        self.assertEqual(2, body.count('BEGIN:VEVENT'))
+        self.assertIn('DTSTART:21000225T123000', body)
+        self.assertIn('LOCATION:Hopper\\, 4th floor', body)
+
+    def test_user_feed(self):
+        _, _, body = self.get('/users/Ada%20Lovelace.ics')
+        self.assertEqual(1, body.count('BEGIN:VEVENT'))
+        self.assertIn('SUMMARY:Lunch', body)
+
+    def test_etag_answers_304_until_something_changes(self):
+        _, etag, _ = self.get('/streams/test-stream.ics')
+        self.assertEqual(304, self.get('/streams/test-stream.ics', etag)[0])
+
+        self.issue('rsvp yes', 'Dinner')
+        status, new_etag, _ = self.get('/streams/test-stream.ics', etag)
+        self.assertEqual(200, status)
+        self.assertNotEqual(etag, new_etag)
+
+    def test_only_changed_events_are_rendered_again(self):
+        self.get('/streams/test-stream.ics')
+        self.assertEqual(2, self.server.cache.renders)
+
+        self.issue('rsvp yes', 'Dinner')
+        self.get('/streams/test-stream.ics')
+        self.get('/users/Tester.ics')
+        self.assertEqual(3, self.server.cache.renders)
+
+    def test_feeds_need_their_own_token(self):
+        ada_token = calendar_feed.feed_token(self.server.secret, u'/users/Ada Lovelace.ics')
+        self.assertEqual(403, self.get('/users/Ada%20Lovelace.ics', token='')[0])
+        self.assertEqual(403, self.get('/users/Tester.ics', token=ada_token)[0])
+        self.assertEqual(403, self.get('/streams/test-stream.ics', token=ada_token)[0])
+
+        url = self.server.feed_url('users', u'Ada Lovelace')
+        self.assertIn('SUMMARY:Lunch', urllib2.urlopen(url).read())
+
+    def test_etag_comes_from_the_body(self):
+        saved = storage.MemoryStorage()
+        first = rsvp.RSVP('rsvp', storage=saved)
+        self.issue('rsvp init', 'Picnic', instance=first)
+        self.issue('rsvp set place Park', 'Picnic', instance=first)
+        etag, _ = calendar_feed.FeedCache(first).render(first.events.items())
+
+        # After a restart versions count from 0 again: the same version is a different event now.
+        second = rsvp.RSVP('rsvp', storage=saved)
+        self.issue('rsvp set place Beach', 'Picnic', instance=second)
+        self.issue('rsvp set place Beach house', 'Picnic', instance=second)
+        self.assertEqual(first.events.version('test-stream/Picnic'), second.events.version('test-stream/Picnic'))
+        self.assertNotEqual(etag, calendar_feed.FeedCache(second).render(second.events.items())[0])
+
+    def test_until_matches_the_start_value_type(self):
+        event = {'name': 'Standup', 'date': '2100-01-01', 'time': None, 'yes': [], 'maybe': [],
+                 'recurrence': {'frequency': 'daily', 'day': 1, 'until': '2100-02-01'}}
+        self.assertIn('RRULE:FREQ=DAILY;UNTIL=21000201\r\n', calendar_feed.render_event(u's/t', event))
+        event['time'] = '09:30'
+        self.assertIn('RRULE:FREQ=DAILY;UNTIL=21000201T235959\r\n', calendar_feed.render_event(u's/t', event))
+
+    def test_gone_events_leave_the_cache_and_feeds(self):
+        self.get('/streams/test-stream.ics')
+        self.issue('rsvp move https://zulip.example.com/#narrow/stream/test-stream/topic/Brunch', 'Lunch')
+        self.issue('rsvp cancel', 'Dinner')
+        self.assertEqual([], sorted(self.server.cache.entries))
+
+        _, _, body = self.get('/users/Ada%20Lovelace.ics')
+        self.assertIn('SUMMARY:Brunch', body)
+        self.issue('rsvp no', 'Brunch', sender_full_name='Ada Lovelace')
+        _, _, body = self.get('/users/Ada%20Lovelace.ics')
+        self.assertEqual(0, body.count('BEGIN:VEVENT'))
+
+    def test_long_lines_are_folded(self):
+        event = {'name': u'caf\xe9 ' * 30, 'date': '2100-01-01'}
+        schema.migrate_event(u's/t', event)
+        for line in calendar_feed.render_event(u's/t', event).split('\r\n'):
+            self.assertTrue(len(line.encode('utf-8')) <= 75)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DebouncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+        self.debouncer = Debouncer(10, self.calls.append, clock=self.clock)
+
+    def test_touches_within_window_are_coalesced(self):
+        for _ in range(100):
+            self.debouncer.touch('a')
+            self.clock.now += 0.5
+            self.debouncer.run_due()
+        # 50 seconds of constant touching, one call per 10 seconds.
+        self.assertEqual(['a'] * 5, self.calls)
+        self.assertEqual(0, self.debouncer.flush())
+        self.debouncer.touch('a')
+        self.assertEqual(1, self.debouncer.flush())
+
+    def test_keys_are_independent(self):
+        self.debouncer.touch('a')
+        self.clock.now += 5
+        self.debouncer.touch('b')
+        self.clock.now += 5
+        self.assertEqual(1, self.debouncer.run_due())
+        self.assertEqual(['a'], self.calls)
+
+    def test_scheduler_runs_every_debouncer(self):
+        other_calls = []
+        other = Debouncer(2, other_calls.append, clock=self.clock)
+        scheduler = Scheduler(interval=1)
+        scheduler.add(self.debouncer)
+        scheduler.add(other)
+        self.assertEqual(0.5, scheduler.interval)
+
+        self.debouncer.touch('a')
+        other.touch('b')
+        self.clock.now += 2
+        self.assertEqual(1, scheduler.run_due())
+        self.clock.now += 8
+        self.assertEqual(1, scheduler.run_due())
+        self.assertEqual((['a'], ['b']), (self.calls, other_calls))
+
+    def test_stop_ends_the_thread(self):
+        debouncer = Debouncer(0.01, self.calls.append).start()
+        debouncer.touch('a')
+        self.assertTrue(loadtest.wait_for(lambda: self.calls == ['a']))
+        debouncer.stop()
+        self.assertFalse(debouncer.thread.is_alive())
+        debouncer.touch('b')
+        time.sleep(0.05)
+        self.assertEqual(['a'], self.calls)
+
+
+class PinnedSummariesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        self.edits = []
+        self.pinned = pinned_summary.PinnedSummaries(self.rsvp, lambda *edit: self.edits.append(edit))
+        self.issue('rsvp init')
+        output = self.issue('rsvp summary pin')
+        self.pinned.pinned(output[0]['pin'], 42, output[0]['body'])
+
+    def issue(self, content, sender_full_name='Tester'):
+        return self.rsvp.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': sender_full_name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def test_burst_of_rsvps_produces_one_edit(self):
+        for idx in range(100):
+            self.issue('rsvp yes', sender_full_name='Person %d' % idx)
+        self.pinned.debouncer.flush()
+
+        self.assertEqual(1, len(self.edits))
+        self.assertEqual(42, self.edits[0][0])
+        self.assertIn('YES (100)', self.edits[0][1])
+
+    def test_no_edit_when_summary_is_unchanged(self):
+        self.issue('rsvp yes')
+        self.issue('rsvp undo')
+        self.pinned.debouncer.flush()
+        self.assertEqual([], self.edits)
+
+    def test_unpinned_summaries_are_left_alone(self):
+        self.issue('rsvp summary unpin')
+        self.issue('rsvp yes')
+        self.pinned.debouncer.flush()
+        self.assertEqual([], self.edits)
+
+
+class BotTestCase(unittest.TestCase):
+    ''' Runs each test against its own FakeZulipServer and working directory, and stops every
+        bot started with start_bot() afterwards.
+    '''
+    streams = ['test-stream']
+    server_options = {'poll_timeout': 0.1}
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = FakeZulipServer(streams=self.streams, **self.server_options).start()
+        self.bots = []
+
+    def tearDown(self):
+        for started in self.bots:
+            started.stop()
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def start_bot(self, **kwargs):
+        started = loadtest.start_bot(self.server, self.workdir, **kwargs)
+        self.bots.append(started)
+        return started
+
+
+class PinnedSummaryBotTest(BotTestCase):
+
+    def test_rsvps_edit_the_pinned_summary(self):
+        self.start_bot(summary_window=0.1)
+        self.server.inject_message('rsvp init')
+        self.server.inject_message('rsvp summary pin')
+        for idx in range(20):
+            self.server.inject_message('rsvp yes', sender_full_name='Person %d' % idx)
+        self.server.state.wait_for_sent(22)
+        loadtest.wait_for(lambda: self.server.state.edits and 'YES (20)' in self.server.state.edits[-1]['content'])
+
+        summary_id = self.server.sent[1]['id']
+        self.assertTrue(all(edit['message_id'] == str(summary_id) for edit in self.server.state.edits))
+        self.assertIn('YES (20)', self.server.state.edits[-1]['content'])
+        self.assertTrue(len(self.server.state.edits) < 20)
+
+
+class ReplyAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        self.sent = []
+        self.replies = aggregate.ReplyAggregator(self.sent.append, window=5)
+        self.issue('rsvp init')
+
+    def issue(self, content, sender_full_name='Tester', subject='Testing'):
+        messages = self.rsvp.process_message({
+            'content': content, 'subject': subject, 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': sender_full_name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+        for message in messages:
+            self.replies.send(message)
+
+    def test_burst_is_merged_into_one_reply(self):
+        del self.sent[:]
+        for idx in range(40):
+            self.issue('rsvp yes', sender_full_name='Person %d' % idx)
+        self.assertEqual([], self.sent)
+
+        self.replies.flush()
+        self.assertEqual(1, len(self.sent))
+        self.assertEqual(
+            '@**Person 0**, @**Person 1**, @**Person 2** and 37 others are attending!',
+            self.sent[0]['body'])
+        self.assertEqual('Testing', self.sent[0]['subject'])
+
+    def test_single_reply_keeps_its_wording(self):
+        del self.sent[:]
+        self.issue('rsvp yes')
+        self.replies.flush()
+        self.assertEqual(['@**Tester** is attending!'], [message['body'] for message in self.sent])
+
+    def test_decisions_and_events_are_merged_separately(self):
+        self.issue('rsvp init', subject='Other')
+        del self.sent[:]
+        self.issue('rsvp yes', sender_full_name='A')
+        self.issue('rsvp yes', sender_full_name='B')
+        self.issue('rsvp no', sender_full_name='C')
+        self.issue('rsvp no', sender_full_name='D')
+        self.issue('rsvp yes', sender_full_name='E', subject='Other')
+        self.replies.flush()
+
+        bodies = sorted(message['body'] for message in self.sent)
+        self.assertEqual([
+            '@**A** and @**B** are attending!',
+            '@**C** and @**D** are **not** attending!',
+            '@**E** is attending!',
+        ], bodies)
+
+    def test_changing_your_mind_only_counts_the_last_decision(self):
+        del self.sent[:]
+        self.issue('rsvp yes', sender_full_name='A')
+        self.issue('rsvp yes', sender_full_name='B')
+        self.issue('rsvp no', sender_full_name='A')
+        self.replies.flush()
+
+        bodies = sorted(message['body'] for message in self.sent)
+        self.assertEqual(['@**A** is **not** attending!', '@**B** is attending!'], bodies)
+
+    def test_limit_reached_is_sent_right_away(self):
+        self.issue('rsvp set limit 1')
+        self.issue('rsvp yes', sender_full_name='A')
+        del self.sent[:]
+        self.issue('rsvp yes', sender_full_name='B')
+        self.assertEqual(1, len(self.sent))
+        self.assertIn('The **limit** for this event has been reached!', self.sent[0]['body'])
+
+    def test_no_window_sends_everything_right_away(self):
+        self.replies = aggregate.ReplyAggregator(self.sent.append, window=0)
+        del self.sent[:]
+        self.issue('rsvp yes', sender_full_name='A')
+        self.issue('rsvp yes', sender_full_name='B')
+        self.assertEqual(2, len(self.sent))
+
+
+class IngressQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.overloads = []
+        self.queue = ingress.IngressQueue('rsvp', maxsize=4, overload_ratio=0.5, on_overload=self.overloads.append)
+
+    def message(self, content, subject='Testing'):
+        return {'type': 'message', 'message': {
+            'content': content, 'subject': subject, 'display_recipient': 'test-stream',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }}
+
+    def drain(self):
+        events = []
+        while len(self.queue):
+            events.append(self.queue.get()['message']['content'])
+        return events
+
+    def test_classify(self):
+        self.assertEqual(ingress.CHATTER, ingress.classify(self.message('lunch anyone?'), 'rsvp'))
+        self.assertEqual(ingress.READ_ONLY, ingress.classify(self.message('RSVP help'), 'rsvp'))
+        self.assertEqual(ingress.COMMAND, ingress.classify(self.message('rsvp summary pin'), 'rsvp'))
+        self.assertEqual(ingress.COMMAND, ingress.classify(self.message(' rsvp yes'), 'rsvp'))
+        self.assertEqual(ingress.COMMAND, ingress.classify({'type': 'stream', 'op': 'update'}, 'rsvp'))
+
+    def test_chatter_is_never_queued(self):
+        self.assertFalse(self.queue.put(self.message('lunch anyone?')))
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual(1, self.queue.stats['shed_chatter'])
+
+    def test_duplicate_summaries_are_dropped(self):
+        self.queue.put(self.message('rsvp summary'))
+        self.queue.put(self.message('rsvp summary'))
+        self.queue.put(self.message('rsvp summary', subject='Other'))
+        self.assertEqual(2, len(self.queue))
+        self.assertEqual(1, self.queue.stats['deduplicated'])
+
+    def test_stats_are_answered_for_everyone(self):
+        # Each sender gets their own numbers, so a second `rsvp stats` isn't redundant.
+        self.assertTrue(self.queue.put(self.message('rsvp stats')))
+        self.assertTrue(self.queue.put(self.message('rsvp stats')))
+        self.assertEqual(0, self.queue.stats['deduplicated'])
+
+    def test_commands_push_out_read_only_commands(self):
+        self.queue.put(self.message('rsvp help'))
+        self.queue.put(self.message('rsvp yes'))
+        self.queue.put(self.message('rsvp credits'))
+        self.queue.put(self.message('rsvp no'))
+        self.queue.put(self.message('rsvp maybe'))
+        self.assertFalse(self.queue.put(self.message('rsvp summary')))
+
+        self.assertEqual(['rsvp yes', 'rsvp credits', 'rsvp no', 'rsvp maybe'], self.drain())
+        self.assertEqual(2, self.queue.stats['shed_read_only'])
+
+    def test_overload_is_signalled_until_drained(self):
+        self.queue.put(self.message('rsvp yes'))
+        self.assertEqual([], self.overloads)
+        self.queue.put(self.message('rsvp no'))
+        self.assertEqual(1, len(self.overloads))
+        self.assertTrue(self.queue.overloaded)
+
+        self.drain()
+        self.assertFalse(self.queue.overloaded)
+        self.assertEqual(1, self.queue.stats['overloads'])
+        self.assertEqual(2, self.queue.stats['high_watermark'])
+
+    def test_commands_are_dropped_rather_than_blocking_for_long(self):
+        dropped = []
+        queue = ingress.IngressQueue('rsvp', maxsize=2, put_timeout=0.05, on_drop=dropped.append)
+        queue.put(self.message('rsvp yes'))
+        queue.put(self.message('rsvp no'))
+
+        started = time.time()
+        self.assertFalse(queue.put(self.message('rsvp maybe')))
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(['rsvp maybe'], [message['content'] for message in dropped])
+        self.assertEqual(1, queue.stats['dropped_commands'])
+
+        # Renames can't be retried by anyone, so they are queued anyway.
+        self.assertTrue(queue.put({'type': 'stream', 'op': 'update'}))
+        self.assertEqual(3, len(queue))
+
+    def test_commands_wait_briefly_for_room(self):
+        queue = ingress.IngressQueue('rsvp', maxsize=1, put_timeout=5)
+        queue.put(self.message('rsvp yes'))
+        threading.Timer(0.05, queue.get).start()
+        self.assertTrue(queue.put(self.message('rsvp no')))
+        self.assertEqual(0, queue.stats['dropped_commands'])
+
+
+
+class BusyNoticeTest(BotTestCase):
+
+    def test_busy_notice_is_sent_once_per_thread(self):
+        test_bot = self.start_bot(busy_notice=True)
+        message = {
+            'content': 'rsvp yes', 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }
+        test_bot.send_busy_notice(message)
+        test_bot.send_busy_notice(message)
+        test_bot.send_busy_notice(dict(message, subject='Other'))
+
+        self.assertEqual(2, self.server.state.wait_for_sent(2))
+        self.assertIn('swamped', self.server.sent[0]['content'])
+
+    def test_dropped_notice_is_sent_even_after_a_busy_notice(self):
+        test_bot = self.start_bot(busy_notice=True)
+        message = {
+            'content': 'rsvp yes', 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }
+        test_bot.send_busy_notice(message)
+        test_bot.send_dropped_notice(message)
+        test_bot.send_dropped_notice(message)
+
+        self.assertEqual(2, self.server.state.wait_for_sent(2))
+        self.assertIn('try again', self.server.sent[1]['content'])
+
+
+class TracingTest(BotTestCase):
+
+    def setUp(self):
+        BotTestCase.setUp(self)
+        self.trace_filename = os.path.join(self.workdir, 'traces.jsonl')
+
+    def issue(self, instance, content):
+        return instance.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def traced_rsvp(self, sample_rate):
+        tracer = tracing.Tracer(self.trace_filename, sample_rate)
+        return tracer, rsvp.RSVP('rsvp', storage=storage.MemoryStorage(), tracer=tracer)
+
+    def test_sampled_message_records_a_span_tree(self):
+        tracer, instance = self.traced_rsvp(1.0)
+        with tracer.trace('message', stream='test-stream', subject='Testing'):
+            self.issue(instance, 'rsvp init')
+
+        traces = tracing.load_traces(self.trace_filename)
+        self.assertEqual(1, len(traces))
+        self.assertEqual('test-stream', traces[0]['attrs']['stream'])
+        self.assertEqual(['route', 'execute', 'commit'], [span['name'] for span in traces[0]['children']])
+        self.assertEqual('RSVPInitCommand', traces[0]['children'][1]['attrs']['command'])
+
+    def test_unsampled_messages_are_not_written(self):
+        tracer, instance = self.traced_rsvp(0.0)
+        with tracer.trace('message'):
+            self.issue(instance, 'rsvp init')
+        self.assertFalse(os.path.exists(self.trace_filename))
+
+    def test_summarize(self):
+        tracer, instance = self.traced_rsvp(1.0)
+        for content in ('rsvp init', 'rsvp yes', 'rsvp summary'):
+            with tracer.trace('message', stream='test-stream', subject='Testing'):
+                self.issue(instance, content)
+
+        summary = tracing.summarize(tracing.load_traces(self.trace_filename), slowest=2)
+        self.assertIn('3 traces', summary)
+        self.assertEqual(2, summary.count('test-stream/Testing'))
+        for stage in ('route', 'execute', 'commit', 'total'):
+            self.assertIn(stage, summary)
+
+    def test_bot_traces_sends(self):
+        self.start_bot(trace_filename=self.trace_filename, trace_sample_rate=1.0)
+        self.server.inject_message('rsvp init')
+        self.server.state.wait_for_sent(1)
+        loadtest.wait_for(lambda: os.path.exists(self.trace_filename))
+
+        trace = tracing.load_traces(self.trace_filename)[0]
+        self.assertEqual(['route', 'execute', 'commit', 'send'], [span['name'] for span in trace['children']])
+        self.assertEqual(['post'], [span['name'] for span in trace['children'][3]['children']])
+
+    def test_outbox_sends_are_traced(self):
+        self.start_bot(trace_filename=self.trace_filename, trace_sample_rate=1.0,
+                       outbox_filename=os.path.join(self.workdir, 'outbox.jsonl'))
+        self.server.inject_message('rsvp init')
+        self.server.state.wait_for_sent(1)
+        loadtest.wait_for(lambda: os.path.exists(self.trace_filename)
+                          and len(tracing.load_traces(self.trace_filename)) == 2)
+
+        traces = dict((trace['name'], trace) for trace in tracing.load_traces(self.trace_filename))
+        self.assertEqual(['route', 'execute', 'commit', 'send'], [span['name'] for span in traces['message']['children']])
+        self.assertEqual(['post'], [span['name'] for span in traces['reply']['children']])
+        self.assertEqual('test-stream', traces['reply']['attrs']['stream'])
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def message(self, content):
+        return {'type': 'message', 'message': {
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }}
+
+    def setUp(self):
+        self.pool = ingress.WorkerPool(3).start()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_queues_share_workers_and_keep_their_order(self):
+        pool = self.pool
+        handled = {'a': [], 'b': []}
+        queues = {}
+        for name in handled:
+            queues[name] = ingress.IngressQueue('rsvp').attach(pool, lambda event, name=name: handled[name].append(
+                event['message']['content']))
+
+        for idx in range(200):
+            for name in handled:
+                queues[name].put(self.message('rsvp yes %d' % idx))
+
+        expected = ['rsvp yes %d' % idx for idx in range(200)]
+        loadtest.wait_for(lambda: handled == {'a': expected, 'b': expected})
+        self.assertEqual({'a': expected, 'b': expected}, handled)
+
+
+class RealmRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.servers = [FakeZulipServer(streams=['test-stream'], poll_timeout=0.1).start() for _ in range(2)]
+
+        self.runners = []
+
+    def tearDown(self):
+        for runner in self.runners:
+            runner.stop()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.datadir)
+
+    def test_realms_are_isolated(self):
+        runner = realms.RealmRunner([
+            {'name': 'first', 'email': 'bot@first.example.com', 'key': 'key', 'site': self.servers[0].url},
+            {'name': 'second', 'email': 'bot@second.example.com', 'key': 'key', 'site': self.servers[1].url},
+        ], datadir=self.datadir, workers=2)
+        self.runners.append(runner.start())
+        for server in self.servers:
+            loadtest.wait_for(lambda: server.state.queues)
+
+        self.servers[0].inject_message('rsvp init')
+        self.servers[1].inject_message('rsvp yes')
+        self.servers[0].state.wait_for_sent(1)
+        self.servers[1].state.wait_for_sent(1)
+
+        self.assertIn('now an RSVPBot event', self.servers[0].sent[0]['content'])
+        self.assertIn('is not an RSVPBot event', self.servers[1].sent[0]['content'])
+        self.assertIn('test-stream/Testing', runner.bots['first'].rsvp.events)
+        self.assertNotIn('test-stream/Testing', runner.bots['second'].rsvp.events)
+        with open(os.path.join(self.datadir, 'first', 'events.json')) as f:
+            self.assertIn('test-stream/Testing', json.load(f))
+
+    def test_bad_realm_names_are_refused(self):
+        runner = realms.RealmRunner([], datadir=self.datadir)
+        self.assertRaises(ValueError, runner.add, {'name': '../elsewhere', 'email': 'e', 'key': 'k'})
+
+    def test_reload_reads_the_modules_once_for_every_realm(self):
+        runner = realms.RealmRunner([
+            {'name': 'first', 'email': 'bot@first.example.com', 'key': 'key', 'site': self.servers[0].url},
+            {'name': 'second', 'email': 'bot@second.example.com', 'key': 'key', 'site': self.servers[1].url},
+        ], datadir=self.datadir, workers=2)
+        self.runners.append(runner.start())
+        old_commands = dict((name, realm_bot.rsvp.command_list) for name, realm_bot in runner.bots.items())
+
+        reloads = []
+        original = rsvp.reload_command_modules
+        def counted():
+            reloads.append(True)
+            original()
+        rsvp.reload_command_modules = counted
+        try:
+            runner.watch_for_reload()
+            runner.reload_requested.set()
+            for name, realm_bot in runner.bots.items():
+                self.assertTrue(loadtest.wait_for(lambda: realm_bot.rsvp.command_list is not old_commands[name]))
+        finally:
+            rsvp.reload_command_modules = original
+
+        self.assertEqual(1, len(reloads))
+        self.assertTrue(all(realm_bot.reload_thread is None for realm_bot in runner.bots.values()))
+
+
+class ReloadCommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        self.issue('rsvp init')
+
+    def issue(self, content):
+        return self.rsvp.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def test_reload_swaps_commands_and_keeps_events(self):
+        old_commands = self.rsvp.command_list
+        events = self.rsvp.events
+
+        self.assertEqual(len(old_commands), self.rsvp.reload_commands())
+        self.assertIsNot(type(old_commands[0]), type(self.rsvp.command_list[0]))
+        self.assertIs(events, self.rsvp.events)
+        self.assertIn('is attending!', self.issue('rsvp yes')[0]['body'])
+
+    def test_failed_reload_keeps_the_old_commands(self):
+        def broken():
+            raise SyntaxError('invalid syntax')
+        old_commands = self.rsvp.command_list
+        original, rsvp.reload_command_modules = rsvp.reload_command_modules, broken
+        try:
+            self.assertRaises(SyntaxError, self.rsvp.reload_commands)
+        finally:
+            rsvp.reload_command_modules = original
+        self.assertIs(old_commands, self.rsvp.command_list)
+
+
+class ReloadBotTest(BotTestCase):
+
+    def setUp(self):
+        BotTestCase.setUp(self)
+        self.bot = self.start_bot(admins=['admin@example.com'])
+
+    def test_admin_pm_reloads(self):
+        old_commands = self.bot.rsvp.command_list
+        self.server.inject_message('rsvp reload', sender_email='someone@example.com', message_type='private')
+        self.server.inject_message('rsvp  reload', sender_email='admin@example.com', message_type='private')
+        self.server.state.wait_for_sent(2)
+
+        self.assertNotIn('Reloaded', self.server.sent[0]['content'])
+        self.assertIn('Reloaded %d commands' % len(old_commands), self.server.sent[1]['content'])
+        self.assertEqual('admin@example.com', self.server.sent[1]['to'])
+        self.assertIsNot(old_commands, self.bot.rsvp.command_list)
+
+    def test_signal_reloads(self):
+        old_commands = self.bot.rsvp.command_list
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            self.bot.reload_on_signal(signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertTrue(loadtest.wait_for(lambda: self.bot.rsvp.command_list is not old_commands))
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+
+
+class EventCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.backing = cache.DbmBacking(os.path.join(self.workdir, 'events'))
+        for idx in range(5):
+            self.backing.put(u's/%d' % idx, {'name': u'%d' % idx, 'yes': []})
+        self.backing.writes = 0
+        self.cache = cache.EventCache(self.backing, max_events=2)
+
+    def tearDown(self):
+        self.backing.close()
+        shutil.rmtree(self.workdir)
+
+    def test_hits_and_misses(self):
+        self.cache[u's/0']
+        self.cache[u's/0']
+        self.assertRaises(KeyError, lambda: self.cache[u's/missing'])
+        self.assertEqual(1, self.cache.stats['hits'])
+        self.assertEqual(2, self.cache.stats['misses'])
+        self.assertAlmostEqual(1 / 3.0, self.cache.hit_rate)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache[u's/0']
+        self.cache[u's/1']
+        self.cache[u's/0']
+        self.cache[u's/2']
+        self.assertEqual([u's/0', u's/2'], list(self.cache.entries))
+        self.assertEqual(1, self.cache.stats['evictions'])
+
+    def test_writes_go_to_storage_on_eviction_or_flush(self):
+        self.cache[u's/0'] = {'name': u'changed', 'yes': [u'Ada']}
+        self.cache[u's/1'] = {'name': u'changed too', 'yes': []}
+        self.assertEqual(0, self.backing.writes)
+
+        self.cache[u's/2']
+        self.assertEqual(u'changed', self.backing.get(u's/0')['name'])
+        # s/2 was handed out, so it may have been changed too.
+        self.assertEqual(2, self.cache.flush())
+        self.assertEqual(u'changed too', self.backing.get(u's/1')['name'])
+        self.assertEqual(3, self.cache.stats['writebacks'])
+        self.assertEqual(0, self.cache.flush())
+
+    def test_events_changed_in_place_are_written_back(self):
+        self.cache[u's/0']['yes'].append(u'Ada')
+        self.cache[u's/1']['name'] = u'renamed'
+        self.cache[u's/2']
+        self.assertEqual([u'Ada'], self.backing.get(u's/0')['yes'])
+
+        self.cache.flush()
+        self.assertEqual(u'renamed', self.backing.get(u's/1')['name'])
+
+    def test_byte_budget(self):
+        events = cache.EventCache(self.backing, max_events=100, max_bytes=60)
+        for idx in range(5):
+            events[u's/%d' % idx]
+        self.assertTrue(events.bytes <= 60)
+        self.assertTrue(len(events.entries) < 5)
+
+    def test_delete_and_iterate(self):
+        self.cache[u's/new'] = {'name': u'new', 'yes': []}
+        del self.cache[u's/0']
+        self.assertEqual(set([u's/1', u's/2', u's/3', u's/4', u's/new']), set(self.cache))
+        self.assertEqual(None, self.backing.get(u's/0'))
+        self.assertRaises(KeyError, lambda: self.cache.__delitem__(u's/0'))
+
+
+class BenchmarkSuiteTest(unittest.TestCase):
+
+    def test_every_command_has_a_case(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            cases = dict(benchmarks.suite_cases(workdir))
+            for command in rsvp.RSVP('rsvp', storage=storage.MemoryStorage()).command_list:
+                name = command.__class__.__name__
+                self.assertIn('match %s' % name, cases)
+                self.assertIn('execute %s, 100 attendees' % name, cases)
+            for name, func in cases.items():
+                if '10000' not in name:
+                    func()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'fast': 0.001, 'steady': 0.002}
+        results = {'fast': 0.0015, 'steady': 0.0021, 'brand new': 0.001}
+        lines, regressed = benchmarks.compare(results, baseline, threshold=0.25)
+        self.assertEqual(['fast'], regressed)
+        self.assertIn('new', [line for line in lines if line.startswith('brand new')][0])
+
+    def test_baseline_round_trip(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(workdir, 'baseline.json')
+            benchmarks.save_baseline(filename, {'case': 0.5})
+            self.assertEqual({'case': 0.5}, benchmarks.load_baseline(filename))
+        finally:
+            shutil.rmtree(workdir)
+
+
+class UserGroupsTest(BotTestCase):
+
+    def setUp(self):
+        BotTestCase.setUp(self)
+        # A window long enough that only flush() syncs anything.
+        self.bot = self.start_bot(group_window=60)
+
+    def issue(self, content, name='Tester', sender_id=1, subject='Testing'):
+        return self.bot.rsvp.process_message({
+            'content': content, 'subject': subject, 'display_recipient': 'test-stream',
+            'sender_id': sender_id, 'sender_full_name': name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def groups(self):
+        return self.server.state.user_groups.values()
+
+    def test_rsvps_are_batched_into_one_group(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.issue('rsvp yes', 'B', 2)
+        self.issue('rsvp maybe', 'C', 3)
+        self.issue('rsvp no', 'D', 4)
+        self.bot.user_groups.debouncer.flush()
+
+        self.assertEqual([('create', 1)], self.server.state.group_calls)
+        group = self.groups()[0]
+        self.assertEqual([1, 2, 3], group['members'])
+        self.assertEqual(user_groups.group_name('test-stream/Testing'), group['name'])
+
+        event = self.bot.rsvp.events['test-stream/Testing']
+        self.assertEqual({'id': 1, 'name': group['name'], 'members': ['A', 'B', 'C']}, event['user_group'])
+
+    def test_changes_are_synced_as_diffs(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.issue('rsvp yes', 'B', 2)
+        self.bot.user_groups.debouncer.flush()
+
+        self.issue('rsvp no', 'A', 1)
+        self.issue('rsvp yes', 'C', 3)
+        self.bot.user_groups.debouncer.flush()
+        self.assertEqual([2, 3], self.groups()[0]['members'])
+
+        # Nothing changed, nothing to send.
+        self.issue('rsvp yes', 'C', 3)
+        self.bot.user_groups.debouncer.flush()
+        self.assertEqual([('create', 1), ('members', 1)], self.server.state.group_calls)
+
+    def test_undo_leaves_the_group_alone(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.issue('rsvp yes', 'B', 2)
+        self.bot.user_groups.debouncer.flush()
+
+        self.assertIn('undone', self.issue('rsvp undo')[0]['body'])
+        self.bot.user_groups.debouncer.flush()
+        event = self.bot.rsvp.events['test-stream/Testing']
+        self.assertEqual(['A'], event['user_group']['members'])
+        self.assertEqual([1], self.groups()[0]['members'])
+        self.assertEqual([('create', 1), ('members', 1)], self.server.state.group_calls)
+
+    def test_undo_cancel_starts_a_new_group(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.bot.user_groups.debouncer.flush()
+        self.issue('rsvp cancel')
+        self.bot.user_groups.debouncer.flush()
+
+        self.issue('rsvp undo')
+        self.assertEqual(None, self.bot.rsvp.events['test-stream/Testing']['user_group'])
+        self.bot.user_groups.debouncer.flush()
+        self.assertEqual([('create', 1), ('delete', 1), ('create', 2)], self.server.state.group_calls)
+        self.assertEqual(2, self.bot.rsvp.events['test-stream/Testing']['user_group']['id'])
+
+    def test_group_left_over_from_a_crash_is_adopted(self):
+        name = user_groups.group_name('test-stream/Testing')
+        group_id = self.server.state.create_group(name, 'People going to Testing', [1, 9])
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.issue('rsvp yes', 'B', 2)
+        self.bot.user_groups.debouncer.flush()
+
+        self.assertEqual(1, len(self.groups()))
+        self.assertEqual([1, 2], self.groups()[0]['members'])
+        event = self.bot.rsvp.events['test-stream/Testing']
+        self.assertEqual({'id': group_id, 'name': name, 'members': ['A', 'B']}, event['user_group'])
+
+    def test_ping_mentions_the_group(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.issue('rsvp yes', 'B', 2)
+        self.bot.user_groups.debouncer.flush()
+        # Not synced yet, so still mentioned by name.
+        self.issue('rsvp maybe', 'C', 3)
+
+        body = self.issue('rsvp ping')[0]['body']
+        self.assertIn('@*%s*' % user_groups.group_name('test-stream/Testing'), body)
+        self.assertIn('@**C**', body)
+        self.assertNotIn('@**A**', body)
+
+    def test_cancel_deletes_the_group(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', 'A', 1)
+        self.bot.user_groups.debouncer.flush()
+
+        self.issue('rsvp cancel')
+        self.bot.user_groups.debouncer.flush()
+        self.assertEqual([], list(self.groups()))
+
+    def test_events_without_ids_get_no_group(self):
+        self.issue('rsvp init')
+        self.bot.user_groups.debouncer.flush()
+        self.assertEqual([], self.server.state.group_calls)
+
+
+class RecurrenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+        self.issue('rsvp init')
+
+    def issue(self, content, name='Tester'):
+        return self.rsvp.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    @property
+    def event(self):
+        return self.rsvp.events['test-stream/Testing']
+
+    def test_next_occurrence(self):
+        today = datetime.date(2016, 3, 10)
+        weekly = {'frequency': 'weekly', 'day': 1, 'until': None}
+        self.assertEqual(datetime.date(2016, 3, 14), recurrence.next_occurrence(datetime.date(2015, 3, 16), weekly, today))
+        self.assertEqual(datetime.date(2016, 3, 10), recurrence.next_occurrence(datetime.date(2016, 3, 3), weekly, today))
+        daily = {'frequency': 'daily', 'day': 1, 'until': None}
+        self.assertEqual(today, recurrence.next_occurrence(datetime.date(2010, 1, 1), daily, today))
+        # The 31st falls on the last day of shorter months.
+        monthly = {'frequency': 'monthly', 'day': 31, 'until': None}
+        self.assertEqual(datetime.date(2016, 3, 31), recurrence.next_occurrence(datetime.date(2016, 1, 31), monthly, today))
+        self.assertEqual(datetime.date(2016, 2, 29), recurrence.next_occurrence(datetime.date(2016, 1, 31), monthly, datetime.date(2016, 2, 2)))
+
+    def test_repeat_command(self):
+        output = self.issue('rsvp repeat weekly until 12/31/2100')
+        self.assertIn('weekly until 2100-12-31', output[0]['body'])
+        self.assertEqual('weekly', self.event['recurrence']['frequency'])
+        self.assertIn('**Repeats**|weekly until 2100-12-31', self.issue('rsvp summary')[0]['body'])
+
+        self.issue('rsvp repeat never')
+        self.assertIsNone(self.event['recurrence'])
+
+    def test_repeat_until_before_the_event(self):
+        self.issue('rsvp set date 02/25/2100')
+        output = self.issue('rsvp repeat daily until 02/24/2100')
+        self.assertIn('not a valid date', output[0]['body'])
+        self.assertIsNone(self.event['recurrence'])
+
+    def test_past_occurrence_rolls_forward_when_used(self):
+        self.issue('rsvp repeat weekly')
+        self.issue('rsvp yes', 'A')
+        last_week = datetime.date.today() - datetime.timedelta(days=7)
+        self.event['date'] = str(last_week)
+
+        self.issue('rsvp yes', 'B')
+        self.assertEqual(str(datetime.date.today()), self.event['date'])
+        self.assertEqual(['B'], self.event['yes'])
+        self.assertEqual([{'date': str(last_week), 'yes': ['A'], 'no': [], 'maybe': []}],
+                         self.event['past_occurrences'])
+
+    def test_rolling_forward_makes_a_new_version(self):
+        feeds = calendar_feed.FeedCache(self.rsvp)
+        self.issue('rsvp repeat weekly')
+        self.issue('rsvp yes', 'A')
+        self.rsvp.events['test-stream/Testing']['date'] = '2020-01-06'
+        version = self.rsvp.events.version('test-stream/Testing')
+        self.assertIn('20200106', feeds.entry('test-stream/Testing', self.event)[1])
+
+        # Even a read-only command rolls the event forward.
+        self.issue('rsvp summary')
+        self.assertEqual(version + 1, self.rsvp.events.version('test-stream/Testing'))
+        rendered = feeds.entry('test-stream/Testing', self.event)[1]
+        self.assertNotIn('20200106', rendered)
+        self.assertIn(self.event['date'].replace('-', ''), rendered)
+
+    def test_set_date_moves_the_monthly_anchor(self):
+        self.issue('rsvp set date 01/31/2100')
+        self.issue('rsvp repeat monthly')
+        self.issue('rsvp set date 02/10/2100')
+        self.assertEqual(10, self.event['recurrence']['day'])
+        rolled = recurrence.roll_forward(self.event, datetime.date(2100, 3, 2))
+        self.assertEqual('2100-03-10', rolled['date'])
+
+    def test_untouched_series_are_rolled_forward_for_the_indexes(self):
+        self.issue('rsvp repeat weekly')
+        self.issue('rsvp set description standup')
+        last_week = datetime.date.today() - datetime.timedelta(days=7)
+        self.event['date'] = str(last_week)
+
+        # A restart, or the first command of a new day in another thread.
+        restarted = rsvp.RSVP('rsvp', events=self.rsvp.events, storage=storage.MemoryStorage())
+        self.assertEqual(str(datetime.date.today()), self.event['date'])
+        self.assertEqual(['test-stream/Testing'], restarted.search.search('standup'))
+        self.assertEqual(search.date_key(self.event['date']), restarted.search.indexed['test-stream/Testing'][1])
+
+        self.event['date'] = str(last_week)
+        self.rsvp.rolled_on = None
+        self.issue('rsvp help')
+        self.assertEqual(str(datetime.date.today()), self.event['date'])
+        self.assertEqual(search.date_key(self.event['date']), self.rsvp.search.indexed['test-stream/Testing'][1])
+
+    def test_series_over(self):
+        self.issue('rsvp repeat weekly until %s' % datetime.date.today().strftime('%m/%d/%Y'))
+        self.event['date'] = str(datetime.date.today() - datetime.timedelta(days=1))
+        self.assertIsNone(recurrence.roll_forward(self.event))
+
+    def test_calendar_feed_has_the_rule(self):
+        self.issue('rsvp repeat monthly until 12/31/2100')
+        rendered = calendar_feed.render_event('test-stream/Testing', self.event)
+        self.assertIn('RRULE:FREQ=MONTHLY;UNTIL=21001231', rendered)
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+
+    def issue(self, content, subject='Testing', name='Tester', stream='test-stream'):
+        return self.rsvp.process_message({
+            'content': content, 'subject': subject, 'display_recipient': stream,
+            'sender_id': '12345', 'sender_full_name': name,
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def make_event(self, subject, time=None, duration=None):
+        self.issue('rsvp init', subject)
+        self.issue('rsvp set date 02/25/2100', subject)
+        if time:
+            self.issue('rsvp set time %s' % time, subject)
+        if duration:
+            self.issue('rsvp set duration %s' % duration, subject)
+
+    def test_event_interval(self):
+        event = {'date': '2100-02-25', 'time': '18:30', 'duration': 90}
+        self.assertEqual((datetime.datetime(2100, 2, 25, 18, 30), datetime.datetime(2100, 2, 25, 20, 0)),
+                         schedule.event_interval(event))
+        self.assertEqual(datetime.timedelta(days=1), schedule.event_interval({'date': '2100-02-25'})[1] -
+                         schedule.event_interval({'date': '2100-02-25'})[0])
+        self.assertIsNone(schedule.event_interval({'date': None}))
+
+    def test_overlapping_yes_is_pointed_out(self):
+        self.make_event('Dinner', '18:00', '3:00')
+        self.make_event('Talk', '20:00')
+        self.make_event('Breakfast', '08:00')
+        self.issue('rsvp yes', 'Dinner', 'A')
+        self.issue('rsvp yes', 'Breakfast', 'A')
+
+        output = self.issue('rsvp yes', 'Talk', 'A')
+        self.assertEqual(2, len(output))
+        self.assertIn('**Dinner** (#**test-stream>Dinner**)', output[1]['body'])
+        self.assertNotIn('Breakfast', output[1]['body'])
+
+        # Others aren't bothered.
+        self.assertEqual(1, len(self.issue('rsvp yes', 'Talk', 'B')))
+
+    def test_index_follows_changes(self):
+        self.make_event('Dinner', '18:00')
+        self.make_event('Talk', '18:30')
+        self.issue('rsvp yes', 'Dinner', 'A')
+        talk = self.rsvp.events['test-stream/Talk']
+        self.assertEqual(['test-stream/Dinner'], self.rsvp.schedule.conflicts('A', talk))
+
+        self.issue('rsvp set time 20:00', 'Dinner')
+        self.assertEqual([], self.rsvp.schedule.conflicts('A', talk))
+
+        self.issue('rsvp set time 18:15', 'Dinner')
+        self.rsvp.rename_topic('test-stream', 'Dinner', 'Supper')
+        self.assertEqual(['test-stream/Supper'], self.rsvp.schedule.conflicts('A', talk))
+
+        self.issue('rsvp no', 'Supper', 'A')
+        self.assertEqual([], self.rsvp.schedule.conflicts('A', talk))
+
+    def test_stream_renamed_onto_the_same_topic(self):
+        self.make_event('Dinner', '18:00')
+        self.issue('rsvp yes', 'Dinner', 'A')
+        self.issue('rsvp init', 'Dinner', stream='other-stream')
+        self.issue('rsvp set date 02/26/2100', 'Dinner', stream='other-stream')
+        self.issue('rsvp yes', 'Dinner', 'A', stream='other-stream')
+        self.issue('rsvp init', 'Lunch')
+        self.issue('rsvp init', 'Lunch', stream='other-stream')
+        self.issue('rsvp set date 02/25/2100', 'Lunch', stream='other-stream')
+        self.issue('rsvp yes', 'Lunch', 'B', stream='other-stream')
+
+        # Like the store, the indexes keep the events already in other-stream.
+        self.rsvp.rename_stream('test-stream', 'other-stream')
+        dinner = self.rsvp.events['other-stream/Dinner']
+        self.assertEqual('2100-02-26', dinner['date'])
+        self.assertEqual(['other-stream/Dinner'], self.rsvp.schedule.conflicts('A', dinner))
+        self.assertEqual([], self.rsvp.schedule.conflicts('A', {'date': '2100-02-25', 'time': '18:30'}))
+        self.assertEqual(['other-stream/Lunch'], self.rsvp.schedule.conflicts('B', {'date': '2100-02-25'}))
+        self.assertEqual(['other-stream/Dinner'], self.rsvp.search.search('dinner'))
+
+    def test_index_is_built_on_load(self):
+        self.make_event('Dinner', '18:00')
+        self.issue('rsvp yes', 'Dinner', 'A')
+        loaded = rsvp.RSVP('rsvp', storage=self.rsvp.storage)
+        event = {'date': '2100-02-25', 'time': '18:59'}
+        self.assertEqual(['test-stream/Dinner'], loaded.schedule.conflicts('A', event))
+
+    def test_set_duration(self):
+        self.make_event('Dinner')
+        self.assertIn('1:30', self.issue('rsvp set duration 1:30', 'Dinner')[0]['body'])
+        self.assertEqual(90, self.rsvp.events['test-stream/Dinner']['duration'])
+        self.assertIn('not a valid duration', self.issue('rsvp set duration 0:00', 'Dinner')[0]['body'])
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = ratelimit.RateLimiter('rsvp', clock=lambda: self.now)
+
+    def test_burst_then_refill(self):
+        for _ in range(3):
+            self.assertTrue(self.limiter.allow('1', 'test-stream/Testing', 'rsvp ping'))
+        self.assertFalse(self.limiter.allow('1', 'test-stream/Testing', 'rsvp ping'))
+        self.assertEqual(1, self.limiter.stats['limited_sender'])
+
+        self.now += 60
+        self.assertTrue(self.limiter.allow('1', 'test-stream/Testing', 'rsvp ping'))
+
+    def test_commands_have_separate_buckets(self):
+        for _ in range(3):
+            self.limiter.allow('1', 'test-stream/Testing', 'rsvp ping')
+        self.assertTrue(self.limiter.allow('1', 'test-stream/Testing', 'rsvp yes'))
+        self.assertTrue(self.limiter.allow('1', 'test-stream/Testing', 'rsvp set limit 5'))
+
+    def test_thread_limit_applies_across_senders(self):
+        for sender in range(3):
+            self.assertTrue(self.limiter.allow(str(sender), 'test-stream/Testing', 'rsvp ping'))
+        self.assertFalse(self.limiter.allow('4', 'test-stream/Testing', 'rsvp ping'))
+        self.assertEqual(1, self.limiter.stats['limited_thread'])
+        self.assertTrue(self.limiter.allow('4', 'test-stream/Other', 'rsvp ping'))
+
+    def test_chatter_is_not_limited(self):
+        for _ in range(100):
+            self.assertTrue(self.limiter.allow('1', 'test-stream/Testing', 'hello'))
+        self.assertEqual(0, len(self.limiter))
+
+    def test_idle_buckets_expire(self):
+        for sender in range(1000):
+            self.limiter.allow(str(sender), 'test-stream/Testing', 'rsvp yes')
+        self.assertEqual(1001, len(self.limiter))
+
+        self.now += self.limiter.idle_after
+        self.limiter.allow('1', 'test-stream/Testing', 'rsvp yes')
+        self.assertEqual(2, len(self.limiter))
+
+    def test_limited_commands_get_no_reply(self):
+        instance = rsvp.RSVP('rsvp', storage=storage.MemoryStorage(), limiter=self.limiter)
+        message = {
+            'content': 'rsvp ping', 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        }
+        instance.process_message(dict(message, content='rsvp init'))
+        replies = [instance.process_message(message) for _ in range(4)]
+        self.assertEqual([1, 1, 1, 0], [len(reply) for reply in replies])
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, 'outbox.jsonl')
+        self.now = 1000.0
+        self.delivered = []
+        self.failures = 0
+        self.lost = 0
+        self.retry_after = None
+        self.confirms = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def deliver(self, message):
+        if self.failures:
+            self.failures -= 1
+            if self.retry_after:
+                return {'result': 'error', 'code': 'RATE_LIMIT_HIT', 'retry-after': self.retry_after}
+            return {'result': 'error', 'code': 'RATE_LIMIT_HIT'}
+        self.delivered.append(message)
+        if self.lost:
+            # Posted, but the answer never made it back.
+            self.lost -= 1
+            return {'result': 'connection-error'}
+        return {'result': 'success'}
+
+    def confirm(self, message, since):
+        self.confirms.append(since)
+        return message in self.delivered
+
+    def make_outbox(self, **kwargs):
+        return outbox.Outbox(self.filename, self.deliver, clock=lambda: self.now, **kwargs)
+
+    def test_retries_with_backoff(self):
+        box = self.make_outbox(base_delay=1)
+        self.failures = 2
+        box.put({'body': 'hi'}, 'm1')
+
+        self.assertEqual(1, box.send_due())
+        self.assertEqual([], self.delivered)
+        # Not due again until its backoff is over.
+        self.now += 2
+        box.send_due()
+        self.now += 4
+        box.send_due()
+        self.assertEqual([{'body': 'hi'}], self.delivered)
+        self.assertEqual(2, box.stats['retried'])
+        self.assertEqual(0, len(box))
+
+    def test_gives_up(self):
+        box = self.make_outbox(max_attempts=3, base_delay=0)
+        self.failures = 10
+        box.put({'body': 'hi'})
+        box.send_due()
+        self.assertEqual(1, box.stats['dropped'])
+        self.assertEqual(0, len(box))
+
+    def test_duplicate_keys_are_sent_once(self):
+        box = self.make_outbox()
+        self.assertEqual('m1', box.put({'body': 'hi'}, 'm1'))
+        self.assertIsNone(box.put({'body': 'hi'}, 'm1'))
+        box.send_due()
+        self.assertIsNone(box.put({'body': 'hi'}, 'm1'))
+        self.assertEqual(1, len(self.delivered))
+        self.assertEqual(2, box.stats['duplicates'])
+
+    def test_pending_replies_survive_a_restart(self):
+        box = self.make_outbox()
+        box.put({'body': 'sent'}, 'm1')
+        box.send_due()
+        box.put({'body': 'not yet'}, 'm2')
+
+        restarted = self.make_outbox()
+        self.assertEqual(1, len(restarted))
+        self.assertIsNone(restarted.put({'body': 'sent'}, 'm1'))
+        restarted.send_due()
+        self.assertEqual(['sent', 'not yet'], [message['body'] for message in self.delivered])
+
+    def test_retry_after_is_honoured(self):
+        box = self.make_outbox(base_delay=1)
+        self.failures = 1
+        self.retry_after = 30
+        box.put({'body': 'hi'}, 'm1')
+        box.send_due()
+        self.now += 29
+        box.send_due()
+        self.assertEqual([], self.delivered)
+        self.now += 1
+        box.send_due()
+        self.assertEqual([{'body': 'hi'}], self.delivered)
+
+    def test_maybe_sent_replies_are_checked_before_sending_again(self):
+        box = self.make_outbox(base_delay=1, confirm=self.confirm)
+        self.lost = 1
+        box.put({'body': 'hi'}, 'm1')
+        box.send_due()
+        self.assertEqual(1, box.stats['maybe_sent'])
+        self.assertEqual(1, len(box))
+
+        # Journaled, so a restart still checks first.
+        restarted = self.make_outbox(base_delay=1, confirm=self.confirm)
+        restarted.send_due()
+        self.assertEqual([{'body': 'hi'}], self.delivered)
+        self.assertEqual(1, restarted.stats['confirmed'])
+        self.assertEqual(0, len(restarted))
+
+    def test_maybe_sent_replies_not_found_are_sent_again(self):
+        box = self.make_outbox(base_delay=1, confirm=lambda message, since: self.confirms.append(since))
+        self.lost = 1
+        box.put({'body': 'hi'}, 'm1')
+        box.send_due()
+        # confirm couldn't tell: ask again later, don't send.
+        self.now += 10
+        box.send_due()
+        self.assertEqual(1, len(self.confirms))
+        self.assertEqual(1, len(self.delivered))
+        self.assertEqual(1, len(box))
+
+        box.confirm = lambda message, since: False
+        self.now += 10
+        box.send_due()
+        self.assertEqual(2, len(self.delivered))
+        self.assertEqual(0, len(box))
+
+    def test_journal_is_compacted(self):
+        box = self.make_outbox(remember=10)
+        for idx in range(600):
+            box.put({'body': idx})
+            box.send_due()
+        self.assertTrue(box.stats['compactions'])
+        with open(self.filename) as f:
+            self.assertTrue(len(f.readlines()) < 1000)
+
+
+class OutboxBotTest(BotTestCase):
+    server_options = {'poll_timeout': 0.1, 'rate_limit_rate': 0.5, 'retry_after': 0.1, 'fault_paths': ['/v1/messages'],
+                      'seed': 1}
+
+    def test_flaky_server_doesnt_slow_down_handling(self):
+        test_bot = self.start_bot(outbox_filename=os.path.join(self.workdir, 'outbox.jsonl'))
+        test_bot.outbox.base_delay = 0.01
+        self.server.inject_message('rsvp init')
+        for idx in range(20):
+            self.server.inject_message('rsvp yes', sender_full_name='Person %d' % idx)
+
+        self.assertTrue(loadtest.wait_for(lambda: len(test_bot.rsvp.events.get('test-stream/Testing', {}).get('yes', [])) == 20))
+        self.assertTrue(test_bot.outbox.wait_until_empty(10))
+        self.assertTrue(self.server.rate_limited_count > 0)
+        bodies = [message['content'] for message in self.server.sent]
+        self.assertEqual(21, len(bodies))
+        self.assertEqual(21, len(set(bodies)))
+
+
+class OutboxLostRepliesTest(BotTestCase):
+    server_options = {'poll_timeout': 0.1, 'lost_reply_rate': 0.5, 'fault_paths': ['/v1/messages'], 'seed': 1}
+
+    def test_lost_replies_are_not_posted_twice(self):
+        test_bot = self.start_bot(outbox_filename=os.path.join(self.workdir, 'outbox.jsonl'))
+        test_bot.outbox.base_delay = 0.01
+        self.server.inject_message('rsvp init')
+        for idx in range(10):
+            self.server.inject_message('rsvp yes', sender_full_name='Person %d' % idx)
+
+        self.assertTrue(loadtest.wait_for(lambda: len(test_bot.rsvp.events.get('test-stream/Testing', {}).get('yes', [])) == 10))
+        self.assertTrue(test_bot.outbox.wait_until_empty(10))
+        self.assertTrue(self.server.lost_reply_count > 0)
+        self.assertTrue(test_bot.outbox.stats['confirmed'] > 0)
+        bodies = [message['content'] for message in self.server.sent]
+        self.assertEqual(11, len(bodies))
+        self.assertEqual(11, len(set(bodies)))
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+
+    def issue(self, content, subject='Testing', stream='test-stream'):
+        return self.rsvp.process_message({
+            'content': content, 'subject': subject, 'display_recipient': stream,
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def make_event(self, subject, date=None, description=None, place=None):
+        self.issue('rsvp init', subject)
+        if date:
+            self.issue('rsvp set date %s' % date, subject)
+        if description:
+            self.issue('rsvp set description %s' % description, subject)
+        if place:
+            self.issue('rsvp set place %s' % place, subject)
+
+    def test_ranking(self):
+        index = search.SearchIndex()
+        index.put('s/far', {'name': 'Board games', 'date': '2100-05-01'})
+        index.put('s/soon', {'name': 'Board games', 'date': '2100-01-01'})
+        index.put('s/past', {'name': 'Board games', 'date': '2000-01-01'})
+        index.put('s/older', {'name': 'Board games', 'date': '1999-01-01'})
+        index.put('s/undated', {'name': 'Board games'})
+        index.put('s/described', {'name': 'Lunch', 'description': 'then board games', 'date': '2100-01-01'})
+        index.put('s/other', {'name': 'Lunch', 'date': '2100-01-01'})
+
+        today = datetime.date(2016, 1, 1)
+        self.assertEqual(['s/soon', 's/far', 's/past', 's/older', 's/undated', 's/described'],
+                         index.search('board games', today=today))
+        self.assertEqual(['s/soon', 's/far'], index.search('BOARD', limit=2, today=today))
+        self.assertEqual([], index.search('karaoke', today=today))
+
+    def test_many_ties_walk_the_dates(self):
+        index = search.SearchIndex(dict(
+            ('s/%d' % idx, {'name': 'Coffee', 'date': '2100-01-%02d' % (idx % 28 + 1)})
+            for idx in range(500)
+        ))
+        index.put('s/tea', {'name': 'Tea', 'date': '2100-01-01'})
+        found = index.search('coffee', limit=3, today=datetime.date(2016, 1, 1))
+        self.assertEqual(3, len(found))
+        for event_id in found:
+            self.assertEqual(21000101, index.indexed[event_id][1])
+
+    def test_search_command(self):
+        self.make_event('Games', '02/25/2100', 'Board games and snacks', 'Hopper')
+        self.make_event('Lunch', '02/24/2100')
+
+        output = self.issue('rsvp search board games', 'Elsewhere')
+        self.assertIn('**Games** (#**test-stream>Games**) 2100-02-25', output[0]['body'])
+        self.assertNotIn('Lunch', output[0]['body'])
+
+    def test_search_stays_in_its_stream(self):
+        self.issue('rsvp init', 'Secret games', stream='private-stream')
+        self.issue('rsvp init', 'Games')
+
+        output = self.issue('rsvp search games', 'Elsewhere')
+        self.assertIn('test-stream>Games', output[0]['body'])
+        self.assertNotIn('Secret', output[0]['body'])
+        self.assertIn('Secret', self.issue('rsvp search games', stream='private-stream')[0]['body'])
+        self.assertEqual(['test-stream/Games'], self.rsvp.search.search('games', stream='test-stream'))
+        self.assertIn('No events in this stream match', self.issue('rsvp search karaoke')[0]['body'])
+
+    def test_index_follows_changes(self):
+        self.make_event('Games', '02/25/2100')
+        self.issue('rsvp set place Turing', 'Games')
+        self.assertEqual(['test-stream/Games'], self.rsvp.search.search('turing'))
+
+        self.rsvp.rename_stream('test-stream', 'events')
+        self.assertEqual(['events/Games'], self.rsvp.search.search('turing'))
+        self.rsvp.rename_topic('events', 'Games', 'Board games')
+        self.assertEqual(['events/Board games'], self.rsvp.search.search('turing'))
+
+        self.issue('rsvp cancel', 'Board games', 'events')
+        self.assertEqual([], self.rsvp.search.search('turing'))
+        self.assertEqual(0, len(self.rsvp.search))
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rsvp = rsvp.RSVP('rsvp', storage=storage.MemoryStorage())
+
+    def issue(self, content, subject='Testing', stream='test-stream', sender='Tester'):
+        return self.rsvp.process_message({
+            'content': content, 'subject': subject, 'display_recipient': stream,
+            'sender_id': sender, 'sender_full_name': sender,
+            'sender_email': '%s@example.com' % sender, 'type': 'stream',
+        })
+
+    def test_turnout_and_changed_minds(self):
+        self.issue('rsvp init', 'Lunch')
+        self.issue('rsvp init', 'Dinner')
+        self.issue('rsvp yes', 'Lunch', sender='Ada')
+        self.issue('rsvp yes', 'Lunch', sender='Bob')
+        self.issue('rsvp maybe', 'Dinner', sender='Ada')
+        self.issue('rsvp no', 'Lunch', sender='Bob')
+
+        self.assertEqual({'yes-no': 1}, self.rsvp.events['test-stream/Lunch']['changed_minds'])
+        report = self.rsvp.stats.stream_report('test-stream')
+        self.assertEqual(2, report['events'])
+        self.assertEqual(0.5, report['average_yes'])
+        self.assertEqual(0.5, report['average_maybe'])
+        self.assertEqual({'yes-no': 1}, report['changed_minds'])
+        self.assertEqual(0.5, report['yes_to_no_rate'])
+        self.assertEqual({'yes': 1, 'no': 0, 'maybe': 1}, self.rsvp.stats.person_report('Ada'))
+        self.assertEqual({'yes': 0, 'no': 1, 'maybe': 0}, self.rsvp.stats.person_report('Bob'))
+
+    def test_popular_slots(self):
+        for subject, date, people in [('A', '02/25/2100', 3), ('B', '03/04/2100', 2), ('C', '02/26/2100', 1)]:
+            self.issue('rsvp init', subject)
+            self.issue('rsvp set date %s' % date, subject)
+            self.issue('rsvp set time 18:30', subject)
+            for idx in range(people):
+                self.issue('rsvp yes', subject, sender='Person %d' % idx)
+
+        report = self.rsvp.stats.stream_report('test-stream')
+        # Both Thursdays at six, then the Friday.
+        self.assertEqual([((3, 18), 5, 2), ((4, 18), 1, 1)], report['popular_slots'])
+        self.assertEqual('Thursdays 18:00', stats.describe_slot((3, 18)))
+
+    def test_cancel_and_rename(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', sender='Ada')
+        self.rsvp.rename_stream('test-stream', 'renamed-stream')
+        self.assertEqual(0, self.rsvp.stats.stream_report('test-stream')['events'])
+        self.assertEqual(1, self.rsvp.stats.stream_report('renamed-stream')['yes'])
+
+        self.issue('rsvp cancel', stream='renamed-stream')
+        self.assertEqual(0, self.rsvp.stats.stream_report('renamed-stream')['events'])
+        self.assertEqual({'yes': 0, 'no': 0, 'maybe': 0}, self.rsvp.stats.person_report('Ada'))
+
+    def test_stats_command(self):
+        self.issue('rsvp init')
+        self.issue('rsvp yes', sender='Ada')
+        output = self.issue('rsvp stats', 'Elsewhere', sender='Ada')
+        self.assertTrue(output[0]['body'].startswith('**Stats for** #**test-stream**\n'))
+        self.assertIn('**Events**|1', output[0]['body'])
+        self.assertIn('**Your RSVPs**|1 yes, 0 no, 0 maybe', output[0]['body'])
+
+    def test_past_occurrences_still_count(self):
+        self.issue('rsvp init')
+        self.issue('rsvp set time 18:00')
+        self.issue('rsvp repeat weekly')
+        self.issue('rsvp yes', sender='Bob')
+        # A Monday long gone: the event rolls on to an upcoming Monday the next
+        # time it is used.
+        self.rsvp.events['test-stream/Testing']['date'] = '2020-01-06'
+        self.issue('rsvp summary')
+        self.issue('rsvp yes', sender='Ada')
+
+        self.assertEqual(1, len(self.rsvp.events['test-stream/Testing']['past_occurrences']))
+        report = self.rsvp.stats.stream_report('test-stream')
+        self.assertEqual((2, 2), (report['events'], report['yes']))
+        self.assertEqual({'yes': 1, 'no': 0, 'maybe': 0}, self.rsvp.stats.person_report('Bob'))
+        self.assertEqual([((0, 18), 2, 2)], report['popular_slots'])
+        self.assertEqual(report, stats.rebuild(self.rsvp.storage).stream_report('test-stream'))
+
+        self.issue('rsvp cancel')
+        self.assertEqual(0, self.rsvp.stats.stream_report('test-stream')['events'])
+        self.assertEqual({'yes': 0, 'no': 0, 'maybe': 0}, self.rsvp.stats.person_report('Bob'))
+
+    def test_rebuild_matches_live_counters(self):
+        self.issue('rsvp init', 'Lunch')
+        self.issue('rsvp set date 02/25/2100', 'Lunch')
+        self.issue('rsvp yes', 'Lunch', sender='Ada')
+        self.issue('rsvp maybe', 'Lunch', sender='Ada')
+        self.issue('rsvp init', 'Games', stream='other-stream')
+        self.issue('rsvp no', 'Games', stream='other-stream', sender='Bob')
+
+        rebuilt = stats.rebuild(self.rsvp.storage)
+        for stream in ['test-stream', 'other-stream']:
+            self.assertEqual(self.rsvp.stats.stream_report(stream), rebuilt.stream_report(stream))
+        for name in ['Ada', 'Bob']:
+            self.assertEqual(self.rsvp.stats.person_report(name), rebuilt.person_report(name))
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, 'events.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def issue(self, instance, content):
+        return instance.process_message({
+            'content': content, 'subject': 'Testing', 'display_recipient': 'test-stream',
+            'sender_id': '12345', 'sender_full_name': 'Tester',
+            'sender_email': 'a@example.com', 'type': 'stream',
+        })
+
+    def test_json_file_round_trip(self):
+        files = storage.JSONFileStorage(self.filename)
+        self.assertEqual({}, files.load())
+        files.save({'s/t': {'name': 't', 'yes': ['Ada']}})
+        self.assertEqual({'s/t': {'name': 't', 'yes': ['Ada']}}, files.load())
+
+        with open(self.filename, 'w+') as f:
+            f.write('{not json')
+        self.assertEqual({}, files.load())
+
+    def test_json_file_is_read_one_event_at_a_time(self):
+        files = storage.JSONFileStorage(self.filename)
+        self.assertEqual([], list(files.iter_events()))
+        events = dict((u's/t%d' % idx, {'name': u'caf\xe9 %d' % idx, 'yes': [u'Ada'], 'limit': idx * 1000})
+                      for idx in range(50))
+        events[u's/empty'] = {}
+        files.save(events)
+        # Chunks small enough to cut through names, numbers and escaped characters.
+        self.assertEqual(events, dict(files.iter_events(chunk_size=7)))
+
+        files.save({})
+        self.assertEqual([], list(files.iter_events(chunk_size=1)))
+        with open(self.filename, 'w+') as f:
+            f.write('{"s/t": {"name": ')
+        self.assertRaises(ValueError, list, files.iter_events())
+
+    def test_filename_still_means_a_json_file(self):
+        instance = rsvp.RSVP('rsvp', filename=self.filename)
+        self.issue(instance, 'rsvp init')
+        with open(self.filename) as f:
+            self.assertIn('test-stream/Testing', json.load(f))
+
+    def test_memory_keeps_what_was_saved(self):
+        memory = storage.MemoryStorage()
+        instance = rsvp.RSVP('rsvp', storage=memory)
+        self.issue(instance, 'rsvp init')
+        self.issue(instance, 'rsvp yes')
+        self.assertEqual(['Tester'], memory.load()['test-stream/Testing']['yes'])
+
+        # Changing the live event doesn't change what was saved, until it's saved.
+        instance.events['test-stream/Testing']['name'] = 'Changed'
+        self.assertEqual('Testing', memory.load()['test-stream/Testing']['name'])
+
+        restarted = rsvp.RSVP('rsvp', storage=memory)
+        self.assertEqual(['Tester'], restarted.events['test-stream/Testing']['yes'])
+        self.assertFalse(os.listdir(self.workdir))
+
+
+class FakeZulipServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeZulipServer(streams=['test-stream', 'other-stream'], poll_timeout=0.1).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def api(self, method, path, params=None):
+        data = urllib.urlencode(params or {})
+        url = self.server.url + '/api/v1/' + path
+        if method == 'GET':
+            request = urllib2.Request(url + '?' + data)
+        else:
+            request = urllib2.Request(url, data)
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request)
+            return response.getcode(), json.load(response), response.info()
+        except urllib2.HTTPError as error:
+            return error.code, json.load(error), error.info()
+
+    def test_lists_streams(self):
+        status, payload, _ = self.api('GET', 'streams')
+        self.assertEqual(200, status)
+        self.assertEqual(['test-stream', 'other-stream'], [stream['name'] for stream in payload['streams']])
+
+    def test_injected_messages_reach_registered_queue(self):
+        _, registration, _ = self.api('POST', 'register', {'event_types': '["message"]'})
+        self.server.inject_message('rsvp yes', sender_full_name='A')
+
+        status, payload, _ = self.api('GET', 'events', {
+            'queue_id': registration['queue_id'],
+            'last_event_id': registration['last_event_id'],
+        })
+
+        self.assertEqual(200, status)
+        self.assertEqual('message', payload['events'][0]['type'])
+        self.assertEqual('rsvp yes', payload['events'][0]['message']['content'])
+        self.assertEqual('A', payload['events'][0]['message']['sender_full_name'])
+
+    def test_event_poll_returns_heartbeat_when_idle(self):
+        _, registration, _ = self.api('POST', 'register')
+        _, payload, _ = self.api('GET', 'events', {
+            'queue_id': registration['queue_id'],
+            'last_event_id': registration['last_event_id'],
+        })
+        self.assertEqual('heartbeat', payload['events'][0]['type'])
+
+    def test_sent_messages_are_recorded(self):
+        status, payload, _ = self.api('POST', 'messages', {
+            'type': 'stream', 'to': 'test-stream', 'subject': 'Testing', 'content': 'hello',
+        })
+        self.assertEqual(200, status)
+        self.assertEqual(1, len(self.server.sent))
+        self.assertEqual('hello', self.server.sent[0]['content'])
+        self.assertEqual(payload['id'], self.server.sent[0]['id'])
+
+    def test_injects_rate_limiting(self):
+        self.server.rate_limit_rate = 1
+        self.server.retry_after = 3
+        status, payload, headers = self.api('POST', 'messages', {'content': 'hello'})
+        self.assertEqual(429, status)
+        self.assertEqual('RATE_LIMIT_HIT', payload['code'])
+        self.assertEqual('3', headers.getheader('Retry-After'))
+        self.assertEqual(0, len(self.server.sent))
+
+    def test_injects_server_errors_only_on_fault_paths(self):
+        self.server.error_rate = 1
+        self.server.fault_paths = ['/v1/messages']
+        self.assertEqual(200, self.api('GET', 'streams')[0])
+        self.assertEqual(500, self.api('POST', 'messages', {'content': 'hello'})[0])
+
+
+class BotSubscriptionTest(BotTestCase):
+    streams = ['stream-%d' % idx for idx in range(7)]
+
+    def subscribe_bot(self):
+        # Only subscribes: the main loop never runs.
+        new_bot = bot.bot(
+            'bot@example.com', 'key', 'rsvp',
+            zulip_site=self.server.url,
+            filename=os.path.join(self.workdir, 'events.json'),
+            subscriptions_filename=os.path.join(self.workdir, 'subscriptions.json'),
+            subscription_chunk_size=3,
+            subscription_workers=2,
+        )
+        self.bots.append(new_bot)
+        new_bot.subscriptions.join(10)
+        return new_bot
+
+    def test_subscribes_in_bounded_chunks(self):
+        self.subscribe_bot()
+        calls = self.server.state.subscribe_calls
+        self.assertEqual(3, len(calls))
+        self.assertTrue(all(len(call) <= 3 for call in calls))
+        self.assertEqual(7, len(self.server.state.subscriptions))
+
+    def test_skips_streams_in_snapshot(self):
+        self.subscribe_bot()
+        self.subscribe_bot()
+        self.assertEqual(3, len(self.server.state.subscribe_calls))
+
+    def test_failed_subscriptions_stop_the_main_loop(self):
+        self.server.rate_limit_rate = 1
+        self.server.fault_paths = ['/v1/users/me/subscriptions']
+        new_bot = self.subscribe_bot()
+        self.assertIsInstance(new_bot.subscription_error, RuntimeError)
+        self.assertRaises(RuntimeError, new_bot.main)
+        self.assertEqual({}, self.server.state.queues)
+
+    def test_subscribes_to_streams_created_later(self):
+        new_bot = self.start_bot()
+        new_bot.subscriptions.join(10)
+        self.server.inject_event({'type': 'stream', 'op': 'create', 'streams': [{'name': 'new-stream', 'stream_id': 8}]})
+        self.assertTrue(loadtest.wait_for(lambda: 'new-stream' in self.server.state.subscriptions))
+        self.assertIn('new-stream', new_bot.load_subscription_snapshot())
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def test_every_rsvp_gets_a_reply(self):
+        report = loadtest.run_load(count=20, rate=500, topics=2, reply_timeout=10)
+        self.assertEqual(20, report['replies'])
+        self.assertIsNotNone(report['latency_p99'])
+
+    def test_ack_window_sends_fewer_messages(self):
+        report = loadtest.run_load(count=20, rate=500, topics=2, reply_timeout=10, ack_window=0.2)
+        self.assertTrue(report['sent_messages'] < 20)
+        self.assertTrue(report['replies'] > 0)
+
 if __name__ == '__main__':
     unittest.main()
 
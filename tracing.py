@@ -0,0 +1,168 @@
+from __future__ import with_statement
+import argparse
+import contextlib
+import itertools
+import json
+import random
+import threading
+import time
+
+import util
+
+"""
+
+Sampled tracing of how long each incoming message takes to handle.
+
+A sampled message gets a tree of spans (route, execute, commit, send...),
+written as one JSON line per message when its root span ends:
+
+  {"trace_id": 3, "name": "message", "start": 1424.2, "duration": 0.0312,
+   "attrs": {"stream": "...", "subject": "..."},
+   "children": [{"name": "route", "duration": 0.0001, ...}, ...]}
+
+Messages that aren't sampled cost one random() call, and span() outside of a
+sampled trace does nothing.
+
+  python tracing.py summarize traces.jsonl
+
+prints the slowest traces and percentiles per stage.
+
+"""
+
+class Span(object):
+
+  def __init__(self, name, attrs):
+    self.name = name
+    self.attrs = attrs
+    self.start = time.time()
+    self.duration = None
+    self.children = []
+
+  def to_dict(self):
+    return {
+      'name': self.name,
+      'start': self.start,
+      'duration': self.duration,
+      'attrs': self.attrs,
+      'children': [child.to_dict() for child in self.children],
+    }
+
+
+class Tracer(object):
+
+  def __init__(self, filename=None, sample_rate=0.0):
+    self.filename = filename
+    self.sample_rate = sample_rate if filename else 0.0
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+
+  def current(self):
+    return getattr(self.local, 'stack', None)
+
+  @contextlib.contextmanager
+  def trace(self, name, **attrs):
+    """
+    Starts a new trace for this thread, if this one is sampled.
+    """
+    if not self.sample_rate or self.current() or random.random() >= self.sample_rate:
+      yield None
+      return
+
+    root = Span(name, attrs)
+    self.local.stack = [root]
+    try:
+      yield root
+    finally:
+      root.duration = time.time() - root.start
+      self.local.stack = None
+      self.write(root)
+
+  @contextlib.contextmanager
+  def span(self, name, **attrs):
+    """
+    Times a stage of the trace in progress in this thread, if there is one.
+    """
+    stack = self.current()
+    if not stack:
+      yield None
+      return
+
+    span = Span(name, attrs)
+    stack[-1].children.append(span)
+    stack.append(span)
+    try:
+      yield span
+    finally:
+      span.duration = time.time() - span.start
+      stack.pop()
+
+  def write(self, root):
+    record = root.to_dict()
+    record['trace_id'] = next(self.ids)
+    line = json.dumps(record) + '\n'
+    with self.lock:
+      with open(self.filename, 'a') as f:
+        f.write(line)
+
+
+def load_traces(filename):
+  traces = []
+  with open(filename) as f:
+    for line in f:
+      if line.strip():
+        traces.append(json.loads(line))
+  return traces
+
+
+def stage_durations(traces):
+  """
+  {span name: [durations]} over every span below the roots.
+  """
+  durations = {}
+
+  def visit(span):
+    for child in span['children']:
+      durations.setdefault(child['name'], []).append(child['duration'])
+      visit(child)
+
+  for trace in traces:
+    visit(trace)
+  return durations
+
+
+def summarize(traces, slowest=10):
+  lines = ['%d traces' % len(traces), '', 'slowest:']
+  for trace in sorted(traces, key=lambda trace: trace['duration'], reverse=True)[:slowest]:
+    stages = ', '.join('%s %.1fms' % (child['name'], child['duration'] * 1000) for child in trace['children'])
+    where = '/'.join(unicode(trace['attrs'].get(key, '')) for key in ('stream', 'subject'))
+    lines.append('  %8.1fms  %s  (%s)' % (trace['duration'] * 1000, where, stages))
+
+  lines += ['', '%-12s %6s %10s %10s %10s %10s' % ('stage', 'count', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)')]
+  durations = stage_durations(traces)
+  durations['total'] = [trace['duration'] for trace in traces]
+  for name in sorted(durations):
+    values = durations[name]
+    if not values:
+      continue
+    lines.append('%-12s %6d %10.2f %10.2f %10.2f %10.2f' % (
+      name, len(values),
+      util.percentile(values, 50) * 1000,
+      util.percentile(values, 90) * 1000,
+      util.percentile(values, 99) * 1000,
+      max(values) * 1000,
+    ))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Summarize RSVPBot traces.')
+  parser.add_argument('mode', choices=['summarize'])
+  parser.add_argument('filename')
+  parser.add_argument('--slowest', type=int, default=10, help='number of slowest traces to list')
+  args = parser.parse_args()
+  print(summarize(load_traces(args.filename), args.slowest).encode('utf-8'))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,174 @@
+from __future__ import with_statement
+import hashlib
+import sys
+import threading
+
+from debounce import Debouncer
+from store import EventStore
+
+"""
+
+Keeps a Zulip user group per event, so `rsvp ping` can mention one group
+instead of every attendee by name.
+
+The group holds whoever said yes or maybe and whose Zulip user id we know
+(see RSVPConfirmCommand). Like pinned summaries, syncing is debounced over
+`window` seconds: a signup rush becomes one members call per window instead
+of one per RSVP. Canceled events have their group deleted.
+
+A group can outlive the event's record of it: after a crash between creating
+the group and committing its id, or when a cancel is undone before its group
+is deleted. Its name is the event's, so creating it again fails, and the
+group already there is adopted instead.
+
+api(request, url, method) makes a Zulip API call, e.g. client.do_api_query.
+
+"""
+
+def group_name(event_id):
+  # Group names must be unique and short, topics are neither.
+  return u'rsvp-%s' % hashlib.sha1(event_id.encode('utf-8')).hexdigest()[:10]
+
+
+def wanted_members(event):
+  """
+  {name: user id} of everyone who should be in the event's group.
+  """
+  user_ids = event.get('user_ids') or {}
+  return dict((name, user_ids[name]) for name in event['yes'] + event['maybe'] if name in user_ids)
+
+
+class UserGroups(object):
+
+  def __init__(self, rsvp, api, window=2):
+    self.rsvp = rsvp
+    self.api = api
+    self.debouncer = Debouncer(window, self.sync)
+    self.lock = threading.Lock()
+    # event id -> id of its group, to find groups whose event went away.
+    self.groups = {}
+    for event_id in list(rsvp.events):
+      group = rsvp.events[event_id].get('user_group')
+      if group:
+        self.groups[event_id] = group['id']
+    rsvp.add_listener(self.changed)
+
+  def start(self):
+    self.debouncer.start()
+    return self
+
+  def changed(self, changes):
+    for change in changes:
+      op = change['op']
+      if op == 'put':
+        event = change['event']
+        group = event.get('user_group')
+        with self.lock:
+          if group:
+            self.groups[change['id']] = group['id']
+        synced = set(group['members']) if group else set()
+        if set(wanted_members(event)) != synced:
+          self.debouncer.touch(change['id'])
+      elif op == 'delete':
+        with self.lock:
+          group_id = self.groups.pop(change['id'], None)
+        if group_id is not None:
+          self.debouncer.touch(('delete', group_id))
+      elif op == 'rename_topic':
+        old_id = EventStore.join_id(change['stream'], change['old'])
+        with self.lock:
+          if old_id in self.groups:
+            self.groups[EventStore.join_id(change['stream'], change['new'])] = self.groups.pop(old_id)
+      elif op == 'rename_stream':
+        with self.lock:
+          for event_id in list(self.groups):
+            stream, topic = EventStore.split_id(event_id)
+            if stream == change['old']:
+              self.groups[EventStore.join_id(change['new'], topic)] = self.groups.pop(event_id)
+
+  def call(self, request, url, method='POST'):
+    result = self.api(request, url, method)
+    if result.get('result') != 'success':
+      sys.stderr.write('User group call to %s failed: %r\n' % (url, result))
+      return None
+    return result
+
+  def sync(self, key):
+    if isinstance(key, tuple):
+      return self.delete(key[1])
+
+    event = self.rsvp.events.snapshot(key)
+    if event is None:
+      return
+    wanted = wanted_members(event)
+    group = event.get('user_group')
+
+    if group is None:
+      if not wanted:
+        return
+      group = self.create(key, event, wanted)
+      if group is None:
+        return
+    else:
+      current = set(group['members'])
+      user_ids = event['user_ids']
+      add = sorted(user_ids[name] for name in set(wanted) - current)
+      delete = sorted(user_ids[name] for name in current - set(wanted) if name in user_ids)
+      if not add and not delete:
+        return
+      if self.call({'add': add, 'delete': delete}, 'v1/user_groups/%d/members' % group['id']) is None:
+        return
+
+    self.rsvp.set_user_group(key, {'id': group['id'], 'name': group['name'], 'members': sorted(wanted)})
+
+  def find(self, name):
+    groups = self.call({}, 'v1/user_groups', 'GET') or {}
+    for group in groups.get('user_groups', []):
+      if group['name'] == name:
+        return group
+    return None
+
+  def create(self, event_id, event, wanted):
+    name = group_name(event_id)
+    request = {
+      'name': name,
+      'description': u'People going to %s' % event['name'],
+      'members': sorted(wanted.values()),
+    }
+    result = self.api(request, 'v1/user_groups/create', 'POST')
+    if result.get('result') != 'success':
+      if 'already exists' in result.get('msg', ''):
+        return self.adopt(name, wanted)
+      sys.stderr.write('User group call to v1/user_groups/create failed: %r\n' % result)
+      return None
+
+    group_id = result.get('group_id')
+    if group_id is None:
+      # Older servers don't say which id the group got.
+      group = self.find(name)
+      group_id = group['id'] if group else None
+    if group_id is None:
+      return None
+    return {'id': group_id, 'name': name}
+
+  def adopt(self, name, wanted):
+    """
+    Takes over the group already called name, bringing its members in line.
+    """
+    group = self.find(name)
+    if group is None:
+      return None
+    current = set(group.get('members', []))
+    add = sorted(set(wanted.values()) - current)
+    delete = sorted(current - set(wanted.values()))
+    if add or delete:
+      if self.call({'add': add, 'delete': delete}, 'v1/user_groups/%d/members' % group['id']) is None:
+        return None
+    return {'id': group['id'], 'name': name}
+
+  def delete(self, group_id):
+    with self.lock:
+      # A moved event takes its group along.
+      if group_id in self.groups.values():
+        return
+    self.call({}, 'v1/user_groups/%d' % group_id, 'DELETE')
@@ -25,3 +25,14 @@ def stream_topic_to_narrow_url(stream, topic):
   url = base + zulipped_fragment
 
   return url
+
+def percentile(values, pct):
+  """
+  Nearest-rank percentile of a list of numbers (pct between 0 and 100).
+  Returns None for an empty list.
+  """
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+  return ordered[rank]